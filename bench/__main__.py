@@ -0,0 +1,625 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the models and API over a FakeSAMR domain, with simulated
+latency. Results are written as JSON, and can be compared with an earlier run:
+
+    python -m bench --users 100000 --output before.json
+    python -m bench --users 100000 --compare before.json
+
+The memory benchmarks measure the resident size of the structures kept for a
+domain, and are meant to be run at several domain sizes:
+
+    for users in 10000 100000 500000; do
+        python -m bench --users $users --latency-ms 0 \\
+            --benchmarks memory_name_index,memory_objects,memory_attr_cache
+    done
+"""
+import json
+import logging
+import platform
+import random
+import sys
+import threading
+import time
+
+from array import array
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from itertools import islice
+
+from bench.fake_samr import FakeDomain, FakeSAMR
+
+BENCH_FORMAT_VERSION = 1
+BENCHMARKS = (
+    'model_list_page',
+    'model_list_by_name',
+    'model_enumerate',
+    'model_detail_cold',
+    'model_detail_warm',
+    'model_detail_burst',
+    'model_export',
+    'http_list_page',
+    'http_list_expand',
+    'http_detail',
+    'http_export',
+    'memory_name_index',
+    'memory_objects',
+    'memory_attr_cache',
+    # Adds users to the fake domain, so it runs last
+    'model_batch_provision',
+)
+
+PARSER = ArgumentParser(description="Benchmark pydentity against a fake "
+                                    "SAMR server")
+PARSER.add_argument("--users", type=int, default=1000, metavar="COUNT",
+                    help="Number of users in the fake domain")
+PARSER.add_argument("--groups", type=int, default=None, metavar="COUNT",
+                    help="Number of groups (default users/50)")
+PARSER.add_argument("--aliases", type=int, default=None, metavar="COUNT",
+                    help="Number of aliases (default users/500)")
+PARSER.add_argument("--seed", type=int, default=0,
+                    help="Seed for the generated domain and request order")
+PARSER.add_argument("--latency-ms", type=float, default=1.0, metavar="MS",
+                    help="Simulated latency of every SAMR call")
+PARSER.add_argument("--jitter-ms", type=float, default=0.0, metavar="MS",
+                    help="Up to this much extra random latency per call")
+PARSER.add_argument("--iterations", type=int, default=50, metavar="COUNT",
+                    help="Samples for each per-request benchmark")
+PARSER.add_argument("--enum-iterations", type=int, default=3,
+                    metavar="COUNT",
+                    help="Samples for the full enumeration and export "
+                         "benchmarks")
+PARSER.add_argument("--page-size", type=int, default=20, metavar="COUNT",
+                    help="Objects per list page")
+PARSER.add_argument("--export-attrs", default=False, action='store_true',
+                    help="Include attrs in the export benchmarks")
+PARSER.add_argument("--samr-pool-size", type=int, default=4,
+                    metavar="COUNT",
+                    help="Number of SAMR connections to pool")
+PARSER.add_argument("--expand-concurrency", type=int, default=4,
+                    metavar="COUNT",
+                    help="Maximum concurrent attribute queries when "
+                         "expanding")
+PARSER.add_argument("--burst-size", type=int, default=16, metavar="COUNT",
+                    help="Concurrent readers of the same object in the "
+                         "burst benchmark")
+PARSER.add_argument("--memory-attrs", type=int, default=5000,
+                    metavar="COUNT",
+                    help="Users whose attrs are cached in the attr cache "
+                         "memory benchmark")
+PARSER.add_argument("--batch-size", type=int, default=100, metavar="COUNT",
+                    help="Users created per batch in the provisioning "
+                         "benchmark")
+PARSER.add_argument("--write-concurrency", type=int, default=4,
+                    metavar="COUNT",
+                    help="Maximum connections a batch of writes is spread "
+                         "over")
+PARSER.add_argument("--benchmarks", default=','.join(BENCHMARKS),
+                    help="Comma separated benchmarks to run")
+PARSER.add_argument("--output", metavar="FILE",
+                    help="Write results to this file instead of stdout")
+PARSER.add_argument("--compare", metavar="FILE",
+                    help="Print a comparison with the results in this file")
+
+def percentile(samples, pct):
+    """
+    Nearest rank percentile of a sorted list
+    """
+    if not samples:
+        return None
+
+    rank = int(round(pct / 100.0 * (len(samples) - 1)))
+    return samples[rank]
+
+def deep_sizeof(obj, exclude=()):
+    """
+    Total size in bytes of an object and everything it references, except
+    the objects in exclude and anything only reachable through them
+    """
+    seen = set(id(excluded) for excluded in exclude)
+    pending = [obj]
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif not isinstance(obj, (basestring, int, long, float, array)):
+            if hasattr(obj, '__dict__'):
+                pending.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for slot in cls.__dict__.get('__slots__', ()):
+                    if hasattr(obj, slot):
+                        pending.append(getattr(obj, slot))
+
+    return total
+
+def summarize_memory(name, size, items, samr_calls):
+    """
+    Result dict for a memory benchmark, from the size in bytes of the
+    structures kept for items objects
+    """
+    return {
+        'name': name,
+        'layer': 'memory',
+        'items': items,
+        'bytes': size,
+        'bytes_per_item': round(float(size) / items, 1) if items else None,
+        'samr_calls': samr_calls,
+    }
+
+def summarize(name, samples, items, samr_calls):
+    """
+    Result dict for a benchmark, from a list of sample durations in seconds
+    and the total number of objects they produced
+    """
+    samples = sorted(samples)
+    total = sum(samples)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'name': name,
+        'layer': name.split('_', 1)[0],
+        'iterations': len(samples),
+        'items': items,
+        'total_secs': round(total, 6),
+        'mean_ms': ms(total / len(samples)) if samples else None,
+        'p50_ms': ms(percentile(samples, 50)),
+        'p90_ms': ms(percentile(samples, 90)),
+        'p99_ms': ms(percentile(samples, 99)),
+        'max_ms': ms(samples[-1]) if samples else None,
+        'ops_per_sec': round(len(samples) / total, 3) if total else None,
+        'items_per_sec': round(items / total, 3) if total else None,
+        'samr_calls': samr_calls,
+    }
+
+
+class Bench(object):
+    """
+    A fake domain, and the connections made to it, shared by the benchmarks
+    """
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+
+        self.fake_domain = FakeDomain(users=args.users,
+                                      groups=args.groups,
+                                      aliases=args.aliases,
+                                      seed=args.seed)
+        self.connections = []
+
+        self._domain_model = None
+        self._client = None
+
+    def connection_factory(self, _):
+        """
+        Make a FakeSAMR connection, in place of samba_util.new_connection_obj
+        """
+        connection_obj = FakeSAMR(
+            self.fake_domain,
+            latency=self.args.latency_ms / 1000.0,
+            jitter=self.args.jitter_ms / 1000.0,
+            seed=self.args.seed + len(self.connections),
+        )
+        self.connections.append(connection_obj)
+        return connection_obj
+
+    def samr_calls(self):
+        """
+        Total calls made to each fake SAMR operation
+        """
+        totals = defaultdict(int)
+        for connection_obj in self.connections:
+            for name, count in connection_obj.calls.items():
+                totals[name] += count
+
+        return totals
+
+    @property
+    def domain_model(self):
+        """
+        Domain model over a connection pool, without the web app
+        """
+        if self._domain_model is None:
+            from pydentity.models.samba_ import Domain
+            from pydentity.samba_util import SAMRHandlePool
+
+            samr_handle = SAMRHandlePool(
+                None,
+                size=self.args.samr_pool_size,
+                connection_factory=self.connection_factory,
+            )
+            self._domain_model = Domain(
+                self.fake_domain.name,
+                samr_handle,
+                prefetch_concurrency=self.args.expand_concurrency,
+                write_concurrency=self.args.write_concurrency,
+            )
+
+        return self._domain_model
+
+    def new_domain_model(self):
+        """
+        Domain model with empty caches, sharing the connection pool
+        """
+        from pydentity.models.samba_ import Domain
+        return Domain(
+            self.fake_domain.name,
+            self.domain_model.samr_handle,
+            attr_cache_size=max(65536, self.args.memory_attrs * 4),
+            prefetch_concurrency=self.args.expand_concurrency,
+        )
+
+    @property
+    def client(self):
+        """
+        Flask test client for the app, connected to the fake domain
+        """
+        if self._client is None:
+            from pydentity import server
+
+            server.setup_samba({
+                'smbconf': None,
+                'smbdomain': self.fake_domain.name,
+                'samr_pool_size': self.args.samr_pool_size,
+                'samr_pool_timeout': 30,
+                'samr_workers': 0,
+                'handle_cache_size': 1024,
+                'handle_cache_ttl': 300,
+                'attr_cache_size': 65536,
+                'sequence_poll_interval': 5,
+                'expand_concurrency': self.args.expand_concurrency,
+                'coalesce_timeout': 30,
+                'etag_mode': 'domain',
+                'slow_call_ms': 0,
+                'snapshot': None,
+                'snapshot_interval': 0,
+                'change_watch_interval': 0,
+                'change_log_size': 0,
+                'shared_cache': None,
+                'token_key_file': None,
+                'token_client_file': None,
+                'discover_domains': False,
+                'allow_writes': False,
+                'write_concurrency': self.args.write_concurrency,
+                'writer_client_file': None,
+                'max_write_defer': 30,
+            }, connection_factory=self.connection_factory)
+            server.add_api_resources(None)
+            self._client = server.APP.test_client()
+
+        return self._client
+
+    def random_rids(self, kind, count):
+        """
+        Distinct random RIDs of a kind of object, or as many as there are
+        """
+        rids = self.fake_domain.rids[kind]
+        return self.rng.sample(rids, min(count, len(rids)))
+
+    def run(self, name):
+        """
+        Run a benchmark, returning its result dict
+        """
+        calls_before = self.samr_calls()
+        if name.startswith('model_') or name.startswith('memory_'):
+            # Like a request, the benchmark holds a pooled connection
+            with self.domain_model.samr_handle.connection():
+                result = getattr(self, name)()
+        else:
+            result = getattr(self, name)()
+        calls_after = self.samr_calls()
+
+        samr_calls = {
+            op: count - calls_before.get(op, 0)
+            for op, count in calls_after.items()
+            if count != calls_before.get(op, 0)
+        }
+        if name.startswith('memory_'):
+            return summarize_memory(name, result[0], result[1], samr_calls)
+
+        samples, items = result
+        return summarize(name, samples, items, samr_calls)
+
+    def timed(self, func, params):
+        """
+        Time func(param) for each param. func returns the number of objects
+        it produced
+        """
+        samples = []
+        items = 0
+        for param in params:
+            start = time.time()
+            items += func(param)
+            samples.append(time.time() - start)
+
+        return samples, items
+
+    def model_list_page(self):
+        from pydentity.models.samba_ import User
+
+        page_size = self.args.page_size
+        def list_page(rid):
+            return len(list(islice(
+                User.all_in_domain_iter(self.domain_model, rid, page_size),
+                page_size,
+            )))
+
+        return self.timed(list_page,
+                          self.random_rids('User', self.args.iterations))
+
+    def model_list_by_name(self):
+        from pydentity.models.samba_ import User
+
+        page_size = self.args.page_size
+        def list_page(rid):
+            name = self.fake_domain.objects[rid][1]
+            return len(self.domain_model.sorted_page(
+                User, 'name', (name.lower(), rid), None, page_size,
+            ))
+
+        return self.timed(list_page,
+                          self.random_rids('User', self.args.iterations))
+
+    def model_enumerate(self):
+        def enumerate_all(_):
+            return sum(1 for _ in self.domain_model.users_iter())
+
+        return self.timed(enumerate_all, range(self.args.enum_iterations))
+
+    def model_detail_cold(self):
+        from pydentity.models.samba_ import User
+
+        def detail(rid):
+            return len(User(self.domain_model, rid).attrs) and 1
+
+        return self.timed(detail,
+                          self.random_rids('User', self.args.iterations))
+
+    def model_detail_warm(self):
+        from pydentity.models.samba_ import User
+
+        rid = self.random_rids('User', 1)[0]
+        User(self.domain_model, rid).attrs
+
+        def detail(_):
+            return len(User(self.domain_model, rid).attrs) and 1
+
+        return self.timed(detail, range(self.args.iterations))
+
+    def model_detail_burst(self):
+        from pydentity.models.samba_ import User
+
+        def read(rid):
+            with self.domain_model.samr_handle.connection():
+                User(self.domain_model, rid).attrs
+
+        def burst(rid):
+            # Like a dashboard opening, many clients ask for the same cold
+            # object at once
+            threads = [
+                threading.Thread(target=read, args=(rid,))
+                for _ in range(self.args.burst_size)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            return len(threads)
+
+        return self.timed(burst,
+                          self.random_rids('User', self.args.iterations))
+
+    def model_export(self):
+        from pydentity.resources.export import EXPORT_TYPES, export_chunks
+
+        def export(_):
+            return sum(
+                chunk.count('\n')
+                for chunk in export_chunks(self.domain_model, EXPORT_TYPES,
+                                           self.args.export_attrs)
+            )
+
+        return self.timed(export, range(self.args.enum_iterations))
+
+    def model_batch_provision(self):
+        from pydentity.batch import run_batch
+
+        group_rids = self.fake_domain.rids['Group']
+        def provision(batch_idx):
+            items = [
+                {
+                    'op': 'create_user',
+                    'name': 'bench%d-%d' % (batch_idx, idx),
+                    'attrs': {
+                        'full_name': u'Bench User %d-%d' % (batch_idx, idx),
+                        'description': u'Provisioned by the benchmark',
+                    },
+                    'groups': [self.rng.choice(group_rids)],
+                }
+                for idx in range(self.args.batch_size)
+            ]
+            results = run_batch(self.domain_model, items)
+            return sum(1 for result in results if result['status'] == 201)
+
+        return self.timed(provision, range(self.args.enum_iterations))
+
+    def memory_name_index(self):
+        from pydentity.models.samba_ import MODELS_BY_NAME
+
+        domain = self.new_domain_model()
+        for model_cls in MODELS_BY_NAME.values():
+            for _ in model_cls.all_in_domain_iter(domain):
+                pass
+
+            # Serving lists builds the sorted views too
+            for sort in ('rid', 'name'):
+                domain.name_index.sorted_entries(model_cls.sid_name_use, sort)
+
+        return deep_sizeof(domain.name_index), len(domain.name_index)
+
+    def memory_objects(self):
+        from pydentity.models.samba_ import User
+
+        domain = self.new_domain_model()
+        objects = list(User.all_in_domain_iter(domain))
+        return deep_sizeof(objects, exclude=(domain,)), len(objects)
+
+    def memory_attr_cache(self):
+        from pydentity.models.samba_ import User
+
+        domain = self.new_domain_model()
+        objects = [
+            User(domain, rid)
+            for rid in self.random_rids('User', self.args.memory_attrs)
+        ]
+        domain.prefetch_attrs(objects)
+        # The domain may have fewer users than were asked for
+        count = len(objects)
+        del objects
+
+        return deep_sizeof(domain.attr_cache), count
+
+    def get(self, url):
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise Exception("GET %s returned %s" % (url,
+                                                    response.status_code))
+
+        return response
+
+    def http_list_page(self, expand=False):
+        url_format = '/api/v1/users?limit=%d&rid=%%d' % self.args.page_size
+        if expand:
+            url_format += '&expand=attrs'
+
+        def list_page(rid):
+            return len(json.loads(self.get(url_format % rid).data)['objects'])
+
+        return self.timed(list_page,
+                          self.random_rids('User', self.args.iterations))
+
+    def http_list_expand(self):
+        return self.http_list_page(expand=True)
+
+    def http_detail(self):
+        def detail(rid):
+            self.get('/api/v1/users/%d' % rid)
+            return 1
+
+        return self.timed(detail,
+                          self.random_rids('User', self.args.iterations))
+
+    def http_export(self):
+        url = '/api/v1/export?attrs=%d' % int(self.args.export_attrs)
+
+        def export(_):
+            return self.get(url).data.count('\n')
+
+        return self.timed(export, range(self.args.enum_iterations))
+
+
+def compare(results, baseline):
+    """
+    Lines comparing the p50 and throughput of each benchmark with a baseline
+    run
+    """
+    baseline_by_name = {
+        result['name']: result for result in baseline['results']
+    }
+
+    lines = ['%-20s %12s %12s %8s %14s %14s' % (
+        'benchmark', 'p50 before', 'p50 after', 'ratio',
+        'items/s before', 'items/s after',
+    )]
+    memory_header = '%-20s %12s %12s %8s %14s %14s' % (
+        'benchmark', 'bytes before', 'bytes after', 'ratio',
+        'B/item before', 'B/item after',
+    )
+    for result in results['results']:
+        before = baseline_by_name.get(result['name'])
+        if before is None:
+            continue
+
+        if result['layer'] == 'memory':
+            if memory_header:
+                lines.append(memory_header)
+                memory_header = None
+            lines.append('%-20s %12s %12s %8s %14s %14s' % (
+                result['name'],
+                before['bytes'], result['bytes'],
+                '%.2fx' % (float(result['bytes']) / before['bytes'])
+                if before['bytes'] else '-',
+                before['bytes_per_item'], result['bytes_per_item'],
+            ))
+            continue
+
+        ratio = None
+        if before['p50_ms'] and result['p50_ms'] is not None:
+            ratio = result['p50_ms'] / before['p50_ms']
+
+        lines.append('%-20s %12s %12s %8s %14s %14s' % (
+            result['name'],
+            before['p50_ms'], result['p50_ms'],
+            '-' if ratio is None else '%.2fx' % ratio,
+            before['items_per_sec'], result['items_per_sec'],
+        ))
+
+    return lines
+
+def main():
+    args = PARSER.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    names = [name.strip() for name in args.benchmarks.split(',')
+             if name.strip()]
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        PARSER.error("Unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+
+    bench = Bench(args)
+    results = {
+        'version': BENCH_FORMAT_VERSION,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'config': {
+            key: value for key, value in vars(args).items()
+            if key not in ('output', 'compare')
+        },
+        'domain': {
+            kind.lower(): len(rids)
+            for kind, rids in bench.fake_domain.rids.items()
+        },
+        'results': [],
+    }
+    for name in names:
+        logging.info("Running %s", name)
+        results['results'].append(bench.run(name))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output)
+            handle.write('\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+
+        sys.stderr.write('\n'.join(compare(results, baseline)) + '\n')
+
+if __name__ == '__main__':
+    main()
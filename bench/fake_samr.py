@@ -0,0 +1,779 @@
+import random
+import threading
+import time
+
+from bisect import bisect_right
+from collections import defaultdict
+
+from samba.dcerpc import lsa, security
+
+from pydentity.samba_util import NT_STATUS_NONE_MAPPED
+
+# Bytes of max_size per enumeration entry (SAMR_ENUM_USERS_MULTIPLIER)
+SAMR_ENUM_USERS_MULTIPLIER = 54
+
+NT_STATUS_INVALID_HANDLE = 0xC0000008
+NT_STATUS_USER_EXISTS = 0xC0000063
+NT_STATUS_NO_SUCH_USER = 0xC0000064
+NT_STATUS_NO_SUCH_GROUP = 0xC0000066
+NT_STATUS_MEMBER_IN_GROUP = 0xC0000067
+NT_STATUS_NO_SUCH_DOMAIN = 0xC00000DF
+NT_STATUS_INVALID_INFO_CLASS = 0xC0000003
+NT_STATUS_NO_SUCH_ALIAS = 0xC0000151
+NT_STATUS_MEMBER_IN_ALIAS = 0xC0000153
+
+FAKE_DOMAIN_NAME = 'FAKE'
+FAKE_DOMAIN_SID = 'S-1-5-21-1004336348-1177238915-682003330'
+FAKE_FOREIGN_SID = 'S-1-5-32'
+
+FIRST_USER_RID = 1000
+FIRST_GROUP_RID = 1000000
+FIRST_ALIAS_RID = 2000000
+
+# Fields of each Query*Info level's reply, from the information classes in
+# MS-SAMR 2.2.3.16, 2.2.4.7, 2.2.5.6 and 2.2.6.28, under the Samba bindings'
+# attribute names. This is deliberately independent of the models' own
+# tables, so that projecting fields onto levels is checked against the
+# protocol rather than against the models
+INFO_LEVEL_FIELDS = {
+    'Domain': {
+        1: ('min_password_length', 'password_history_length',
+            'password_properties', 'max_password_age', 'min_password_age'),
+        2: ('force_logoff_time', 'oem_information', 'domain_name', 'primary',
+            'sequence_num', 'domain_server_state', 'role', 'unknown3',
+            'num_users', 'num_groups', 'num_aliases'),
+        3: ('force_logoff_time',),
+        4: ('oem_information',),
+        5: ('domain_name',),
+        6: ('primary',),
+        7: ('role',),
+        8: ('sequence_num', 'domain_create_time'),
+        9: ('domain_server_state',),
+        11: ('general', 'lockout_duration', 'lockout_window',
+             'lockout_threshold'),
+        12: ('lockout_duration', 'lockout_window', 'lockout_threshold'),
+        13: ('sequence_num', 'domain_create_time',
+             'modified_count_at_last_promotion'),
+    },
+    'User': {
+        1: ('account_name', 'full_name', 'primary_gid', 'description',
+            'comment'),
+        2: ('comment', 'reserved', 'country_code', 'code_page'),
+        3: ('account_name', 'full_name', 'rid', 'primary_gid',
+            'home_directory', 'home_drive', 'logon_script', 'profile_path',
+            'workstations', 'last_logon', 'last_logoff',
+            'last_password_change', 'allow_password_change',
+            'force_password_change', 'logon_hours', 'bad_password_count',
+            'logon_count', 'acct_flags'),
+        4: ('logon_hours',),
+        5: ('account_name', 'full_name', 'rid', 'primary_gid',
+            'home_directory', 'home_drive', 'logon_script', 'profile_path',
+            'description', 'workstations', 'last_logon', 'last_logoff',
+            'logon_hours', 'bad_password_count', 'logon_count',
+            'last_password_change', 'acct_expiry', 'acct_flags'),
+        6: ('account_name', 'full_name'),
+        7: ('account_name',),
+        8: ('full_name',),
+        9: ('primary_gid',),
+        10: ('home_directory', 'home_drive'),
+        11: ('logon_script',),
+        12: ('profile_path',),
+        13: ('description',),
+        14: ('workstations',),
+        16: ('acct_flags',),
+        17: ('acct_expiry',),
+        20: ('parameters',),
+        21: ('last_logon', 'last_logoff', 'last_password_change',
+             'acct_expiry', 'allow_password_change', 'force_password_change',
+             'account_name', 'full_name', 'home_directory', 'home_drive',
+             'logon_script', 'profile_path', 'description', 'workstations',
+             'comment', 'parameters', 'lm_owf_password', 'nt_owf_password',
+             'private_data', 'buf_count', 'buffer', 'rid', 'primary_gid',
+             'acct_flags', 'fields_present', 'logon_hours',
+             'bad_password_count', 'logon_count', 'country_code',
+             'code_page', 'lm_password_set', 'nt_password_set',
+             'password_expired', 'private_data_sensitive'),
+    },
+    'Group': {
+        1: ('name', 'attributes', 'num_members', 'description'),
+        2: ('name',),
+        3: ('attributes',),
+        4: ('description',),
+        # GroupReplicationInformation always reports no members
+        5: ('name', 'attributes', 'description'),
+    },
+    'Alias': {
+        1: ('name', 'num_members', 'description'),
+        2: ('name',),
+        3: ('description',),
+    },
+}
+# Levels whose reply is a bare string, rather than a struct -> the field
+STRING_INFO_LEVELS = {
+    'Group': {2: 'name', 4: 'description'},
+    'Alias': {2: 'name', 3: 'description'},
+}
+# Field renaming an object when it's set
+NAME_FIELDS = {'User': 'account_name', 'Group': 'name', 'Alias': 'name'}
+
+# Arbitrary NTTIME values for generated timestamps
+NTTIME_2014 = 130330944000000000
+NTTIME_DAY = 864000000000
+
+def nt_error(status, message):
+    """
+    RuntimeError as raised by the samba bindings for an NTSTATUS
+    """
+    return RuntimeError(status, message)
+
+def lsa_string(value):
+    string_obj = lsa.String()
+    string_obj.string = value
+    return string_obj
+
+class FakeStruct(object):
+    """
+    Plain attribute holder for reply structures the models only read from
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeHandle(object):
+    """
+    Policy handle for an object in the fake domain
+    """
+    def __init__(self, kind, rid=None):
+        self.kind = kind
+        self.rid = rid
+        self.closed = False
+
+    def __repr__(self):
+        return '<FakeHandle %s %s>' % (self.kind, self.rid)
+
+
+# (kind, level) -> info class, so that each level has a distinct type like
+# the samba bindings do
+INFO_CLASSES = {}
+INFO_CLASSES_LOCK = threading.Lock()
+
+def info_class(kind, level):
+    key = (kind, level)
+    info_cls = INFO_CLASSES.get(key)
+    if info_cls is None:
+        with INFO_CLASSES_LOCK:
+            info_cls = INFO_CLASSES.setdefault(key, type(
+                'Fake%sInfo%d' % (kind, level), (FakeStruct,), {},
+            ))
+
+    return info_cls
+
+
+class FakeDomain(object):
+    """
+    Generated users, groups and aliases, with group and alias membership.
+    The same seed and sizes always generate the same domain
+    """
+    def __init__(self, users=1000, groups=None, aliases=None, seed=0,
+                 name=FAKE_DOMAIN_NAME, sid=FAKE_DOMAIN_SID):
+        if groups is None:
+            groups = max(1, users // 50)
+        if aliases is None:
+            aliases = max(1, users // 500)
+
+        self.name = name
+        self.sid = sid
+        self.sequence = 1
+        self.created = NTTIME_2014
+
+        self._lock = threading.Lock()
+        rng = random.Random(seed)
+
+        # kind -> sorted RIDs, and RID -> (kind, name)
+        self.rids = {}
+        self.objects = {}
+        for kind, first_rid, count, prefix in (
+                ('User', FIRST_USER_RID, users, 'user'),
+                ('Group', FIRST_GROUP_RID, groups, 'group'),
+                ('Alias', FIRST_ALIAS_RID, aliases, 'alias')):
+            self.rids[kind] = list(range(first_rid, first_rid + count))
+            for idx, rid in enumerate(self.rids[kind]):
+                self.objects[rid] = (kind, '%s%d' % (prefix, idx))
+
+        # Group RID -> list of member RIDs. Users are in 1-3 groups, and some
+        # groups are nested in a lower group
+        self.group_members = defaultdict(list)
+        group_rids = self.rids['Group']
+        for rid in self.rids['User']:
+            for group_rid in rng.sample(group_rids,
+                                        min(len(group_rids),
+                                            rng.randint(1, 3))):
+                self.group_members[group_rid].append(rid)
+        for idx, group_rid in enumerate(group_rids[1:]):
+            if rng.random() < 0.2:
+                self.group_members[group_rids[rng.randint(0, idx)]].append(
+                    group_rid,
+                )
+
+        # Alias RID -> list of member SID strings. Aliases contain a few
+        # groups, some users, and a foreign SID
+        self.alias_members = defaultdict(list)
+        user_rids = self.rids['User']
+        for alias_rid in self.rids['Alias']:
+            members = rng.sample(group_rids, min(len(group_rids), 3))
+            members += rng.sample(user_rids, min(len(user_rids), 10))
+            self.alias_members[alias_rid] = (
+                ['%s-%d' % (sid, rid) for rid in members] +
+                ['%s-%d' % (FAKE_FOREIGN_SID, 545)]
+            )
+
+        # RID -> attrs set through SetInfo calls
+        self.overrides = defaultdict(dict)
+
+        self._group_parents = None
+        self._alias_parents = None
+        self._lower_names = None
+
+    def kind(self, rid):
+        entry = self.objects.get(rid)
+        return entry and entry[0]
+
+    def modify(self, rid=None):
+        """
+        Simulate a change to the domain, bumping its sequence number. If a
+        RID is given, that object is renamed
+        """
+        with self._lock:
+            self.sequence += 1
+            if rid in self.objects:
+                kind, name = self.objects[rid]
+                self.objects[rid] = (kind, '%s-%d' % (name, self.sequence))
+
+    def _name_taken(self, name):
+        """
+        Whether an object has the name. Must hold the lock
+        """
+        if self._lower_names is None:
+            self._lower_names = set(
+                existing.lower() for _, existing in self.objects.values()
+            )
+
+        return name.lower() in self._lower_names
+
+    def _rename(self, rid, name):
+        """
+        Rename an object. Must hold the lock
+        """
+        kind, old_name = self.objects[rid]
+        self.objects[rid] = (kind, name)
+        if self._lower_names is not None:
+            self._lower_names.discard(old_name.lower())
+            self._lower_names.add(name.lower())
+
+    def create_user(self, name, acct_flags):
+        """
+        Add a user with the next free user RID, bumping the sequence number.
+        Returns the RID
+        """
+        with self._lock:
+            if self._name_taken(name):
+                raise nt_error(NT_STATUS_USER_EXISTS, "User exists")
+
+            rid = self.rids['User'][-1] + 1
+            self.rids['User'].append(rid)
+            self.objects[rid] = ('User', name)
+            self._lower_names.add(name.lower())
+            self.overrides[rid]['acct_flags'] = acct_flags
+            self.sequence += 1
+
+        return rid
+
+    def set_info(self, kind, rid, level, info):
+        """
+        Apply a Set{kind}Info call, bumping the sequence number
+        """
+        string_field = STRING_INFO_LEVELS.get(kind, {}).get(level)
+        if string_field is not None:
+            values = {string_field: info}
+        else:
+            values = {
+                attr_name: getattr(info, attr_name)
+                for attr_name in INFO_LEVEL_FIELDS[kind].get(level, ())
+                if hasattr(info, attr_name)
+            }
+        if not values:
+            raise nt_error(NT_STATUS_INVALID_INFO_CLASS, "Invalid info class")
+
+        with self._lock:
+            name = values.pop(NAME_FIELDS[kind], None)
+            if name is not None:
+                self._rename(rid, name.string)
+            self.overrides[rid].update(values)
+            self.sequence += 1
+
+    def add_group_member(self, group_rid, rid):
+        with self._lock:
+            if self.kind(rid) not in ('User', 'Group'):
+                raise nt_error(NT_STATUS_NO_SUCH_USER, "No such user")
+            if rid in self.group_members[group_rid]:
+                raise nt_error(NT_STATUS_MEMBER_IN_GROUP, "Member in group")
+
+            self.group_members[group_rid].append(rid)
+            self._group_parents = None
+            self.sequence += 1
+
+    def add_alias_member(self, alias_rid, sid):
+        with self._lock:
+            if sid in self.alias_members[alias_rid]:
+                raise nt_error(NT_STATUS_MEMBER_IN_ALIAS, "Member in alias")
+
+            self.alias_members[alias_rid].append(sid)
+            self._alias_parents = None
+            self.sequence += 1
+
+    @property
+    def group_parents(self):
+        """
+        Member RID -> list of the RIDs of groups that directly contain it
+        """
+        if self._group_parents is None:
+            parents = defaultdict(list)
+            for group_rid, members in self.group_members.items():
+                for rid in members:
+                    parents[rid].append(group_rid)
+
+            self._group_parents = parents
+
+        return self._group_parents
+
+    @property
+    def alias_parents(self):
+        """
+        Member SID string -> list of the RIDs of aliases that directly
+        contain it
+        """
+        if self._alias_parents is None:
+            parents = defaultdict(list)
+            for alias_rid, members in self.alias_members.items():
+                for sid in members:
+                    parents[sid].append(alias_rid)
+
+            self._alias_parents = parents
+
+        return self._alias_parents
+
+    def user_attrs(self, rid):
+        _, name = self.objects[rid]
+        parameters = lsa.BinaryString()
+        parameters.array = []
+        attrs = dict(
+            account_name=lsa_string(name),
+            full_name=lsa_string(name.title()),
+            description=lsa_string(''),
+            comment=lsa_string(''),
+            reserved=lsa_string(''),
+            home_directory=lsa_string(''),
+            home_drive=lsa_string(''),
+            logon_script=lsa_string(''),
+            profile_path=lsa_string(''),
+            workstations=lsa_string(''),
+            parameters=parameters,
+            logon_hours=FakeStruct(units_per_week=168, bits=[0xff] * 21),
+            rid=rid,
+            primary_gid=513,
+            acct_flags=0x10,
+            fields_present=0,
+            last_logon=NTTIME_2014 + (rid % 365) * NTTIME_DAY,
+            last_logoff=0,
+            last_password_change=NTTIME_2014 + (rid % 90) * NTTIME_DAY,
+            acct_expiry=0x7fffffffffffffff,
+            allow_password_change=0,
+            force_password_change=0x7fffffffffffffff,
+            bad_password_count=0,
+            logon_count=rid % 100,
+            country_code=0,
+            code_page=0,
+            password_expired=0,
+        )
+        attrs.update(self.overrides.get(rid, {}))
+        return attrs
+
+    def group_attrs(self, rid):
+        _, name = self.objects[rid]
+        attrs = dict(
+            name=lsa_string(name),
+            description=lsa_string('Generated group %s' % name),
+            attributes=7,
+            num_members=len(self.group_members.get(rid, ())),
+        )
+        attrs.update(self.overrides.get(rid, {}))
+        return attrs
+
+    def alias_attrs(self, rid):
+        _, name = self.objects[rid]
+        attrs = dict(
+            name=lsa_string(name),
+            description=lsa_string('Generated alias %s' % name),
+            num_members=len(self.alias_members.get(rid, ())),
+        )
+        attrs.update(self.overrides.get(rid, {}))
+        return attrs
+
+    def domain_attrs(self, _):
+        general = dict(
+            force_logoff_time=0x8000000000000000,
+            oem_information=lsa_string(''),
+            domain_name=lsa_string(self.name),
+            primary=lsa_string(''),
+            sequence_num=self.sequence,
+            domain_server_state=1,
+            role=3,
+            unknown3=1,
+            num_users=len(self.rids['User']),
+            num_groups=len(self.rids['Group']),
+            num_aliases=len(self.rids['Alias']),
+        )
+        return dict(
+            general,
+            general=info_class('Domain', 2)(**general),
+            lockout_duration=-18000000000,
+            lockout_window=-18000000000,
+            lockout_threshold=0,
+            domain_create_time=self.created,
+            modified_count_at_last_promotion=0,
+            min_password_length=7,
+            password_history_length=24,
+            password_properties=1,
+            max_password_age=-37108517437440,
+            min_password_age=-864000000000,
+        )
+
+    def query_info(self, kind, rid, level):
+        """
+        Reply to a Query{kind}Info call, with the fields the protocol has at
+        the level
+        """
+        fields = INFO_LEVEL_FIELDS[kind].get(level)
+        if fields is None:
+            raise nt_error(NT_STATUS_INVALID_INFO_CLASS,
+                           "Invalid info class")
+
+        attrs = getattr(self, '%s_attrs' % kind.lower())(rid)
+        attr_name = STRING_INFO_LEVELS.get(kind, {}).get(level)
+        if attr_name is not None:
+            return attrs[attr_name]
+
+        return info_class(kind, level)(**{
+            attr_name: attrs[attr_name]
+            for attr_name in fields
+            if attr_name in attrs
+        })
+
+
+class FakeSAMR(object):
+    """
+    In-process stand-in for a samr connection object, implementing the calls
+    the models make over a FakeDomain, for benchmarking without a domain
+    controller. Every call sleeps for the
+    latency, plus up to jitter more, to simulate round trips. Latencies for
+    individual calls can be overridden by name
+    """
+    def __init__(self, domain, latency=0, jitter=0, call_latency=None,
+                 seed=None):
+        self.domain = domain
+        self.latency = latency
+        self.jitter = jitter
+        self.call_latency = call_latency or {}
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = defaultdict(int)
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+            delay = self.call_latency.get(name, self.latency)
+            if self.jitter:
+                delay += self._rng.uniform(0, self.jitter)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _check_handle(self, handle, kind):
+        if not isinstance(handle, FakeHandle) or handle.closed or \
+                handle.kind != kind:
+            raise nt_error(NT_STATUS_INVALID_HANDLE, "Invalid handle")
+
+    def _open(self, kind, parent, rid, missing_status):
+        self._check_handle(parent, 'Domain')
+        if self.domain.kind(rid) != kind:
+            raise nt_error(missing_status, "No such %s" % kind.lower())
+
+        return FakeHandle(kind, rid)
+
+    def _enum(self, kind, domain_handle, resume_handle, max_size):
+        """
+        Entries after the RID in resume_handle, sized like Samba does.
+        The new resume handle is the last RID returned
+        """
+        self._check_handle(domain_handle, 'Domain')
+        rids = self.domain.rids[kind]
+        start = bisect_right(rids, resume_handle)
+        if max_size < 0:
+            count = len(rids)
+        else:
+            count = 1 + max_size // SAMR_ENUM_USERS_MULTIPLIER
+
+        entries = [
+            FakeStruct(idx=rid, name=lsa_string(self.domain.objects[rid][1]))
+            for rid in rids[start:start + count]
+        ]
+        if entries:
+            resume_handle = entries[-1].idx
+
+        return (resume_handle,
+                FakeStruct(count=len(entries), entries=entries),
+                len(entries))
+
+    def Connect(self, system_name, access_mask):
+        self._call('Connect')
+        return FakeHandle('Connect')
+
+    def Close(self, handle):
+        self._call('Close')
+        if isinstance(handle, FakeHandle):
+            handle.closed = True
+        return handle
+
+    def EnumDomains(self, connect_handle, resume_handle, buf_size):
+        self._call('EnumDomains')
+        self._check_handle(connect_handle, 'Connect')
+        entries = [FakeStruct(idx=0, name=lsa_string(self.domain.name))]
+        return 0, FakeStruct(count=1, entries=entries), 1
+
+    def LookupDomain(self, connect_handle, domain_name):
+        self._call('LookupDomain')
+        self._check_handle(connect_handle, 'Connect')
+        if domain_name.string.lower() != self.domain.name.lower():
+            raise nt_error(NT_STATUS_NO_SUCH_DOMAIN, "No such domain")
+
+        return security.dom_sid(self.domain.sid)
+
+    def OpenDomain(self, connect_handle, access_mask, sid):
+        self._call('OpenDomain')
+        self._check_handle(connect_handle, 'Connect')
+        if str(sid) != self.domain.sid:
+            raise nt_error(NT_STATUS_NO_SUCH_DOMAIN, "No such domain")
+
+        return FakeHandle('Domain')
+
+    def QueryDomainInfo(self, domain_handle, level):
+        self._call('QueryDomainInfo')
+        self._check_handle(domain_handle, 'Domain')
+        return self.domain.query_info('Domain', None, level)
+
+    def EnumDomainUsers(self, domain_handle, resume_handle, acct_flags,
+                        max_size):
+        self._call('EnumDomainUsers')
+        return self._enum('User', domain_handle, resume_handle, max_size)
+
+    def EnumDomainGroups(self, domain_handle, resume_handle, max_size):
+        self._call('EnumDomainGroups')
+        return self._enum('Group', domain_handle, resume_handle, max_size)
+
+    def EnumDomainAliases(self, domain_handle, resume_handle, max_size):
+        self._call('EnumDomainAliases')
+        return self._enum('Alias', domain_handle, resume_handle, max_size)
+
+    def OpenUser(self, domain_handle, access_mask, rid):
+        self._call('OpenUser')
+        return self._open('User', domain_handle, rid, NT_STATUS_NO_SUCH_USER)
+
+    def OpenGroup(self, domain_handle, access_mask, rid):
+        self._call('OpenGroup')
+        return self._open('Group', domain_handle, rid,
+                          NT_STATUS_NO_SUCH_GROUP)
+
+    def OpenAlias(self, domain_handle, access_mask, rid):
+        self._call('OpenAlias')
+        return self._open('Alias', domain_handle, rid,
+                          NT_STATUS_NO_SUCH_ALIAS)
+
+    def QueryUserInfo(self, user_handle, level):
+        self._call('QueryUserInfo')
+        self._check_handle(user_handle, 'User')
+        return self.domain.query_info('User', user_handle.rid, level)
+
+    def QueryGroupInfo(self, group_handle, level):
+        self._call('QueryGroupInfo')
+        self._check_handle(group_handle, 'Group')
+        return self.domain.query_info('Group', group_handle.rid, level)
+
+    def QueryAliasInfo(self, alias_handle, level):
+        self._call('QueryAliasInfo')
+        self._check_handle(alias_handle, 'Alias')
+        return self.domain.query_info('Alias', alias_handle.rid, level)
+
+    def CreateUser2(self, domain_handle, account_name, acct_flags,
+                    access_mask):
+        self._call('CreateUser2')
+        self._check_handle(domain_handle, 'Domain')
+        rid = self.domain.create_user(account_name.string, acct_flags)
+        return FakeHandle('User', rid), access_mask, rid
+
+    def SetUserInfo(self, user_handle, level, info):
+        self._call('SetUserInfo')
+        self._check_handle(user_handle, 'User')
+        self.domain.set_info('User', user_handle.rid, level, info)
+
+    def SetGroupInfo(self, group_handle, level, info):
+        self._call('SetGroupInfo')
+        self._check_handle(group_handle, 'Group')
+        self.domain.set_info('Group', group_handle.rid, level, info)
+
+    def SetAliasInfo(self, alias_handle, level, info):
+        self._call('SetAliasInfo')
+        self._check_handle(alias_handle, 'Alias')
+        self.domain.set_info('Alias', alias_handle.rid, level, info)
+
+    def AddGroupMember(self, group_handle, rid, flags):
+        self._call('AddGroupMember')
+        self._check_handle(group_handle, 'Group')
+        self.domain.add_group_member(group_handle.rid, rid)
+
+    def AddAliasMember(self, alias_handle, sid):
+        self._call('AddAliasMember')
+        self._check_handle(alias_handle, 'Alias')
+        self.domain.add_alias_member(alias_handle.rid, str(sid))
+
+    def LookupNames(self, domain_handle, names):
+        self._call('LookupNames')
+        self._check_handle(domain_handle, 'Domain')
+        by_name = self.domain_names()
+        rids = []
+        types = []
+        for name in names:
+            entry = by_name.get(name.string.lower())
+            if entry is None:
+                rids.append(0)
+                types.append(lsa.SID_NAME_UNKNOWN)
+            else:
+                rids.append(entry[0])
+                types.append(entry[1])
+
+        if names and not any(rids):
+            raise nt_error(NT_STATUS_NONE_MAPPED, "None mapped")
+
+        return FakeStruct(count=len(rids), ids=rids), \
+            FakeStruct(count=len(types), ids=types)
+
+    def LookupRids(self, domain_handle, rids):
+        self._call('LookupRids')
+        self._check_handle(domain_handle, 'Domain')
+        names = []
+        types = []
+        for rid in rids:
+            entry = self.domain.objects.get(rid)
+            if entry is None:
+                names.append(lsa_string(None))
+                types.append(lsa.SID_NAME_UNKNOWN)
+            else:
+                names.append(lsa_string(entry[1]))
+                types.append(SID_NAME_USE_BY_KIND[entry[0]])
+
+        if rids and all(sid_name_use == lsa.SID_NAME_UNKNOWN
+                        for sid_name_use in types):
+            raise nt_error(NT_STATUS_NONE_MAPPED, "None mapped")
+
+        return FakeStruct(count=len(names), names=names), \
+            FakeStruct(count=len(types), ids=types)
+
+    def GetGroupsForUser(self, user_handle):
+        self._call('GetGroupsForUser')
+        self._check_handle(user_handle, 'User')
+        return FakeStruct(rids=[
+            FakeStruct(rid=group_rid, attributes=7)
+            for group_rid in self.domain.group_parents.get(user_handle.rid,
+                                                           ())
+        ])
+
+    def QueryGroupMember(self, group_handle):
+        self._call('QueryGroupMember')
+        self._check_handle(group_handle, 'Group')
+        rids = list(self.domain.group_members.get(group_handle.rid, ()))
+        return FakeStruct(count=len(rids), rids=rids,
+                          attributes=[7] * len(rids))
+
+    def GetMembersInAlias(self, alias_handle):
+        self._call('GetMembersInAlias')
+        self._check_handle(alias_handle, 'Alias')
+        return FakeStruct(sids=[
+            FakeStruct(sid=security.dom_sid(sid))
+            for sid in self.domain.alias_members.get(alias_handle.rid, ())
+        ])
+
+    def GetAliasMembership(self, domain_handle, sid_array):
+        self._call('GetAliasMembership')
+        self._check_handle(domain_handle, 'Domain')
+        alias_rids = set()
+        for sid_ptr in sid_array.sids:
+            alias_rids.update(self.domain.alias_parents.get(str(sid_ptr.sid),
+                                                            ()))
+
+        return FakeStruct(count=len(alias_rids), ids=sorted(alias_rids))
+
+    def QueryDisplayInfo(self, domain_handle, level, start_idx, max_entries,
+                         buf_size):
+        self._call('QueryDisplayInfo')
+        self._check_handle(domain_handle, 'Domain')
+        kind = DISPLAY_KINDS.get(level)
+        if kind is None:
+            raise nt_error(NT_STATUS_INVALID_INFO_CLASS,
+                           "Invalid info class")
+
+        rids = self.domain.rids[kind][start_idx:start_idx + max_entries]
+        entries = []
+        for offset, rid in enumerate(rids):
+            attrs = getattr(self.domain, '%s_attrs' % kind.lower())(rid)
+            entry = FakeStruct(
+                idx=start_idx + offset + 1,
+                rid=rid,
+                acct_flags=attrs.get('acct_flags', attrs.get('attributes')),
+                account_name=attrs.get('account_name', attrs.get('name')),
+                description=attrs['description'],
+            )
+            if 'full_name' in attrs:
+                entry.full_name = attrs['full_name']
+            entries.append(entry)
+
+        size = len(entries) * SAMR_ENUM_USERS_MULTIPLIER
+        return size, size, FakeStruct(count=len(entries), entries=entries)
+
+    _names = None
+    _names_sequence = None
+
+    def domain_names(self):
+        """
+        Lower case name -> (rid, sid_name_use) for the domain
+        """
+        if self._names is None or self._names_sequence != self.domain.sequence:
+            self._names_sequence = self.domain.sequence
+            self._names = {
+                name.lower(): (rid, SID_NAME_USE_BY_KIND[kind])
+                for rid, (kind, name) in self.domain.objects.items()
+            }
+
+        return self._names
+
+
+# QueryDisplayInfo level -> kind of object listed
+DISPLAY_KINDS = {
+    1: 'User',
+    3: 'Group',
+}
+
+SID_NAME_USE_BY_KIND = {
+    'User': lsa.SID_NAME_USER,
+    'Group': lsa.SID_NAME_DOM_GRP,
+    'Alias': lsa.SID_NAME_ALIAS,
+}
@@ -0,0 +1,174 @@
+import logging
+
+from samba.dcerpc import samr, security
+
+from pydentity.models.samba_ import Alias, Group, INT_TYPES, User
+from pydentity.samba_util import ntstatus, PoolTimeout, run_shared
+
+MAX_BATCH_ITEMS = 10000
+
+# NTSTATUS of a failed write -> HTTP status reported for its item
+NTSTATUS_HTTP_STATUS = {
+    0xC000000D: 400,  # NT_STATUS_INVALID_PARAMETER
+    0xC0000022: 403,  # NT_STATUS_ACCESS_DENIED
+    0xC0000063: 409,  # NT_STATUS_USER_EXISTS
+    0xC0000064: 404,  # NT_STATUS_NO_SUCH_USER
+    0xC0000065: 409,  # NT_STATUS_GROUP_EXISTS
+    0xC0000066: 404,  # NT_STATUS_NO_SUCH_GROUP
+    0xC0000067: 409,  # NT_STATUS_MEMBER_IN_GROUP
+    0xC0000151: 404,  # NT_STATUS_NO_SUCH_ALIAS
+    0xC0000153: 409,  # NT_STATUS_MEMBER_IN_ALIAS
+    0xC0000154: 409,  # NT_STATUS_ALIAS_EXISTS
+    0xC000017A: 404,  # NT_STATUS_NO_SUCH_MEMBER
+}
+
+def item_value(item, key, value_types, default=None, required=True):
+    """
+    Value of a key in a batch item, checking its type. Raises ValueError if
+    it's required and missing, or of the wrong type
+    """
+    value = item.get(key, default)
+    if value is None and not required:
+        return value
+
+    if not isinstance(value, value_types):
+        raise ValueError("%s is %s" % (
+            key, "invalid" if key in item else "required",
+        ))
+
+    return value
+
+def item_rids(item, key):
+    """
+    List of RIDs in an optional key of a batch item
+    """
+    rids = item_value(item, key, list, [])
+    if not all(isinstance(rid, INT_TYPES) for rid in rids):
+        raise ValueError("%s must be a list of RIDs" % key)
+
+    return rids
+
+def create_user(domain, item, result):
+    """
+    Create a user, then set its attrs and add it to groups and aliases, all
+    with the handle it was created with
+    """
+    user = domain.create_user(
+        item_value(item, 'name', basestring),
+        item_value(item, 'acct_flags', INT_TYPES, samr.ACB_NORMAL),
+    )
+    result['rid'] = user.rid
+
+    attrs = item_value(item, 'attrs', dict, required=False)
+    if attrs:
+        user.set_attrs(attrs)
+    for group_rid in item_rids(item, 'groups'):
+        Group(domain, group_rid).add_member(user.rid)
+    for alias_rid in item_rids(item, 'aliases'):
+        Alias(domain, alias_rid).add_member(user.sid_obj)
+
+    return 201
+
+def set_attrs_op(model_cls):
+    def set_attrs(domain, item, result):
+        obj = model_cls(domain, item_value(item, 'rid', INT_TYPES))
+        result['rid'] = obj.rid
+        obj.set_attrs(item_value(item, 'attrs', dict))
+        return 200
+
+    return set_attrs
+
+def add_group_member(domain, item, result):
+    group = Group(domain, item_value(item, 'group', INT_TYPES))
+    result['rid'] = group.rid
+    group.add_member(item_value(item, 'member', INT_TYPES))
+    return 200
+
+def add_alias_member(domain, item, result):
+    alias = Alias(domain, item_value(item, 'alias', INT_TYPES))
+    result['rid'] = alias.rid
+
+    member = item_value(item, 'member', INT_TYPES, required=False)
+    if member is not None:
+        sid_obj = domain.sid_for_rid(member)
+    else:
+        try:
+            sid_obj = security.dom_sid(item_value(item, 'sid', basestring))
+        except TypeError:
+            raise ValueError("sid is invalid")
+
+    alias.add_member(sid_obj)
+    return 200
+
+OPERATIONS = {
+    'create_user': create_user,
+    'set_user': set_attrs_op(User),
+    'set_group': set_attrs_op(Group),
+    'set_alias': set_attrs_op(Alias),
+    'add_group_member': add_group_member,
+    'add_alias_member': add_alias_member,
+}
+
+def run_item(domain, idx, item):
+    """
+    Run one batch item on the current thread's connection, returning its
+    result dict. Failures are reported in the result, rather than raised
+    """
+    result = {'index': idx}
+    try:
+        if not isinstance(item, dict):
+            raise ValueError("Item must be an object")
+
+        if 'id' in item:
+            result['id'] = item['id']
+        result['op'] = item.get('op')
+        operation = OPERATIONS.get(result['op'])
+        if operation is None:
+            raise ValueError("Unknown op %r" % (result['op'],))
+
+        result['status'] = operation(domain, item, result)
+    except ValueError as ex:
+        result.update(status=400, error=str(ex))
+    except PoolTimeout as ex:
+        result.update(status=503, error=str(ex))
+    except RuntimeError as ex:
+        code = ntstatus(ex)
+        result.update(
+            status=NTSTATUS_HTTP_STATUS.get(code, 500),
+            error=ex.args[-1] if ex.args else str(ex),
+        )
+        if code is not None:
+            result['ntstatus'] = '0x%08X' % code
+
+    return result
+
+def run_batch(domain, items):
+    """
+    Run a list of batch items, returning a result dict for each, in the same
+    order. Items are run one after another on the caller's connection, and
+    on up to write_concurrency - 1 more connections that are spare, so a
+    busy pool slows a batch down rather than failing it. Each thread reuses
+    the handles its items open. Items run in no particular order relative to
+    each other, but the steps of an item run in order. Caches are updated in
+    place as items complete
+    """
+    if len(items) > MAX_BATCH_ITEMS:
+        raise ValueError("At most %d items can be run in a batch" %
+                         MAX_BATCH_ITEMS)
+
+    results = [None] * len(items)
+    if not items:
+        return results
+
+    def run(indexed_item):
+        idx, item = indexed_item
+        results[idx] = run_item(domain, idx, item)
+
+    with domain.writing():
+        threads = run_shared(domain.samr_handle, domain.write_pool, run,
+                             enumerate(items), domain.write_concurrency - 1)
+
+    failed = sum(1 for result in results if result['status'] >= 400)
+    logging.info("Ran batch of %d items on %d connections: %d failed",
+                 len(items), threads, failed)
+    return results
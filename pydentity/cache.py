@@ -0,0 +1,726 @@
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from pydentity.columns import intern_lower, PrincipalTable
+
+class HandleCache(object):
+    """
+    Bounded LRU cache of open handles. Handles that fall off the end of the
+    cache, or that have been idle longer than the TTL, are passed to the close
+    function
+    """
+    def __init__(self, close_func, max_size=1024, ttl=300):
+        self._close_func = close_func
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # key -> (handle, last used time), least recently used first
+        self._handles = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, open_func):
+        """
+        Get the handle for key, calling open_func to open it if it's not
+        already cached
+        """
+        now = time.time()
+        with self._lock:
+            evicted = self._expired(now)
+            entry = self._handles.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                self._handles[key] = (entry[0], now)
+
+        if entry is None:
+            handle = open_func()
+            with self._lock:
+                self.misses += 1
+                if key in self._handles:
+                    # Lost a race to open the same handle; keep the first one
+                    evicted.append(handle)
+                    handle = self._handles[key][0]
+                self._handles[key] = (handle, now)
+                evicted.extend(self._overflow())
+        else:
+            handle = entry[0]
+
+        self._close(evicted)
+        return handle
+
+    def discard(self, key):
+        """
+        Remove the handle for key from the cache, and close it
+        """
+        with self._lock:
+            entry = self._handles.pop(key, None)
+
+        if entry is not None:
+            self._close([entry[0]])
+
+    def close_all(self):
+        """
+        Close every cached handle, leaving the cache empty
+        """
+        with self._lock:
+            handles = [handle for handle, _ in self._handles.values()]
+            self._handles.clear()
+
+        self._close(handles)
+
+    @property
+    def hit_rate(self):
+        """
+        Ratio of gets that were served from the cache
+        """
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+
+        return float(self.hits) / total
+
+    def stats(self):
+        """
+        Dict of cache statistics
+        """
+        return {
+            'size': len(self._handles),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
+
+    def _expired(self, now):
+        """
+        Remove idle handles from the cache, returning them. Must hold the lock
+        """
+        expired = []
+        if not self.ttl:
+            return expired
+
+        # Ordered by last use, so stop at the first that isn't idle
+        for key, (handle, last_used) in list(self._handles.items()):
+            if now - last_used < self.ttl:
+                break
+
+            del self._handles[key]
+            expired.append(handle)
+
+        self.evictions += len(expired)
+        return expired
+
+    def _overflow(self):
+        """
+        Remove least recently used handles over the size limit, returning
+        them. Must hold the lock
+        """
+        overflow = []
+        while len(self._handles) > self.max_size:
+            _, (handle, _) = self._handles.popitem(last=False)
+            overflow.append(handle)
+
+        self.evictions += len(overflow)
+        return overflow
+
+    def _close(self, handles):
+        for handle in handles:
+            try:
+                self._close_func(handle)
+            except Exception:
+                logging.exception("Error closing handle")
+
+
+class AttrCache(object):
+    """
+    Bounded LRU cache of attribute dicts, valid for a single sequence number.
+    Setting a different sequence number flushes the cache
+
+    Dicts are stored packed, as a tuple of values and a tuple of their names
+    that's shared by every dict with the same names, and unpacked into a new
+    dict when they're read
+    """
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self.sequence = None
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Tuple of names -> the same tuple, shared by packed entries
+        self._layouts = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.rebases = 0
+
+    def _pack(self, value):
+        names = tuple(sorted(value))
+        layout = self._layouts.setdefault(names, names)
+        return (layout, tuple(value[name] for name in layout))
+
+    @staticmethod
+    def _unpack(packed):
+        return dict(zip(*packed))
+
+    def get(self, key):
+        """
+        Get the cached value for key, or None
+        """
+        with self._lock:
+            packed = self._entries.pop(key, None)
+            if packed is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries[key] = packed
+
+        return self._unpack(packed)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def set(self, key, value, sequence=None):
+        """
+        Cache value for key. If a sequence number is given, the value is only
+        cached if it matches the cache's sequence number
+        """
+        with self._lock:
+            if sequence is not None and sequence != self.sequence:
+                return
+
+            self._entries.pop(key, None)
+            self._entries[key] = self._pack(value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def update(self, key, values, sequence=None):
+        """
+        Replace the values of the attrs in values that the cached dict for key
+        has, if it's cached. If a sequence number is given, nothing is changed
+        unless it matches the cache's sequence number
+        """
+        with self._lock:
+            if sequence is not None and sequence != self.sequence:
+                return
+
+            packed = self._entries.get(key)
+            if packed is None:
+                return
+
+            attrs = self._unpack(packed)
+            attrs.update(
+                (name, value) for name, value in values.items()
+                if name in attrs
+            )
+            self._entries[key] = self._pack(attrs)
+
+    def discard(self, key):
+        """
+        Remove the cached value for key, if there is one
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def set_sequence(self, sequence):
+        """
+        Update the sequence number that entries are valid for, flushing all
+        entries if it's changed. Returns whether a flush happened
+        """
+        with self._lock:
+            if sequence == self.sequence:
+                return False
+
+            self.sequence = sequence
+            if self._entries:
+                self._entries.clear()
+                self._layouts.clear()
+                self.flushes += 1
+
+        return True
+
+    def rebase(self, old_sequence, sequence):
+        """
+        Move the entries from one sequence number to another without
+        flushing them, for when the caller has applied every change between
+        the two. Returns whether the entries were valid for old_sequence
+        """
+        with self._lock:
+            if old_sequence != self.sequence:
+                return False
+
+            self.sequence = sequence
+            self.rebases += 1
+
+        return True
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        with self._lock:
+            self._entries.clear()
+            self._layouts.clear()
+
+    def dump(self):
+        """
+        Tuple of the sequence number, and a list of (key, value) entries
+        from least to most recently used
+        """
+        with self._lock:
+            sequence = self.sequence
+            entries = list(self._entries.items())
+
+        return sequence, [
+            (key, self._unpack(packed)) for key, packed in entries
+        ]
+
+    def load(self, entries, sequence):
+        """
+        Add dumped entries, if they were valid for the cache's sequence
+        number. Returns whether they were added
+        """
+        with self._lock:
+            if sequence != self.sequence:
+                return False
+
+            for key, value in entries:
+                self._entries.pop(key, None)
+                self._entries[key] = self._pack(value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return True
+
+    def stats(self):
+        """
+        Dict of cache statistics
+        """
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'sequence': self.sequence,
+            'hits': self.hits,
+            'misses': self.misses,
+            'flushes': self.flushes,
+            'rebases': self.rebases,
+        }
+
+
+class NameIndex(object):
+    """
+    Bidirectional index of names and RIDs, valid for a single sequence
+    number. Names are matched case insensitively. Once every object of a type
+    has been indexed, RIDs of that type missing from the index are known not
+    to exist
+
+    Entries are kept in a compact PrincipalTable of columns per type, and a
+    dict of lower case names to RIDs that shares the name strings where it
+    can
+    """
+    def __init__(self):
+        self.sequence = None
+
+        self._lock = threading.Lock()
+        # sid_name_use -> PrincipalTable
+        self._tables = {}
+        self._by_name = {}
+        self._missing_rids = set()
+        self._missing_names = set()
+        self._complete_types = set()
+        # (sid_name_use, sort) -> (keys, entries), rebuilt after changes
+        self._sorted = {}
+        self._version = 0
+
+    def set_sequence(self, sequence):
+        """
+        Update the sequence number that the index is valid for, emptying it if
+        it's changed
+        """
+        with self._lock:
+            if sequence == self.sequence:
+                return
+
+            self.sequence = sequence
+            self._tables = {}
+            self._by_name = {}
+            self._missing_rids.clear()
+            self._missing_names.clear()
+            self._complete_types.clear()
+            self._changed()
+
+    def rebase(self, old_sequence, sequence):
+        """
+        Move the index from one sequence number to another without emptying
+        it, for when the caller has applied every change between the two.
+        Returns whether it was valid for old_sequence
+        """
+        with self._lock:
+            if old_sequence != self.sequence:
+                return False
+
+            self.sequence = sequence
+
+        return True
+
+    def _changed(self):
+        """
+        Drop the sorted views after the index changes. Must hold the lock
+        """
+        self._sorted.clear()
+        self._version += 1
+
+    def add(self, rid, name, sid_name_use, sequence=None):
+        """
+        Index an object. If a sequence number is given, the object is only
+        indexed if it matches the index's sequence number
+        """
+        with self._lock:
+            if sequence is not None and sequence != self.sequence:
+                return
+
+            self._add(rid, name, sid_name_use)
+
+    def _add(self, rid, name, sid_name_use):
+        """
+        Index an object. Must hold the lock
+        """
+        entry = self.by_rid(rid)
+        if entry != (name, sid_name_use):
+            if entry is not None:
+                old_name, old_type = entry
+                if old_type != sid_name_use:
+                    self._tables[old_type].remove(rid)
+                if self._by_name.get(old_name.lower()) == rid:
+                    del self._by_name[old_name.lower()]
+
+            table = self._tables.get(sid_name_use)
+            if table is None:
+                # Copied so that readers can iterate the tables unlocked
+                table = PrincipalTable()
+                self._tables = dict(self._tables)
+                self._tables[sid_name_use] = table
+            table.set(rid, name)
+            self._changed()
+
+        key = intern_lower(name)
+        self._by_name[key] = rid
+        self._missing_rids.discard(rid)
+        self._missing_names.discard(key)
+
+    def add_missing_rid(self, rid, sequence=None):
+        """
+        Record that a RID doesn't exist
+        """
+        with self._lock:
+            if sequence is None or sequence == self.sequence:
+                if self.by_rid(rid) is None:
+                    self._missing_rids.add(rid)
+
+    def add_missing_name(self, name, sequence=None):
+        """
+        Record that a name doesn't exist
+        """
+        with self._lock:
+            if sequence is None or sequence == self.sequence:
+                if name.lower() not in self._by_name:
+                    self._missing_names.add(name.lower())
+
+    def mark_complete(self, sid_name_use, sequence):
+        """
+        Record that every object of a type has been indexed at the given
+        sequence number
+        """
+        with self._lock:
+            if sequence == self.sequence:
+                self._complete_types.add(sid_name_use)
+
+    def is_complete(self, sid_name_use):
+        """
+        Whether every object of a type has been indexed
+        """
+        return sid_name_use in self._complete_types
+
+    def sorted_entries(self, sid_name_use, sort):
+        """
+        Tuple of (keys, entries) for the indexed objects of a type, in 'rid'
+        or 'name' order. Entries are (rid, name) tuples, and keys are the
+        RIDs, or (lower case name, rid) tuples, for bisecting. Both are read
+        only views over the type's columns. Built once and reused until the
+        index changes
+        """
+        cache_key = (sid_name_use, sort)
+        result = self._sorted.get(cache_key)
+        if result is not None:
+            return result
+
+        with self._lock:
+            table = self._tables.get(sid_name_use) or PrincipalTable()
+            result = self._sorted[cache_key] = table.sorted_entries(sort)
+
+        return result
+
+    def by_rid(self, rid):
+        """
+        Tuple of (name, sid_name_use) for a RID, or None if not indexed
+        """
+        for sid_name_use, table in self._tables.items():
+            name = table.get(rid)
+            if name is not None:
+                return (name, sid_name_use)
+
+        return None
+
+    def by_name(self, name):
+        """
+        Tuple of (rid, sid_name_use) for a name, or None if not indexed
+        """
+        rid = self._by_name.get(name.lower())
+        if rid is None:
+            return None
+
+        entry = self.by_rid(rid)
+        if entry is None:
+            return None
+
+        return (rid, entry[1])
+
+    def rid_missing(self, rid, sid_name_use=None):
+        """
+        Whether the RID is known not to exist (as the given type)
+        """
+        if rid in self._missing_rids:
+            return True
+
+        if sid_name_use is None:
+            return False
+
+        entry = self.by_rid(rid)
+        if entry is not None:
+            return entry[1] != sid_name_use
+
+        return sid_name_use in self._complete_types
+
+    def name_missing(self, name, sid_name_use=None):
+        """
+        Whether the name is known not to exist (as the given type)
+        """
+        if name.lower() in self._missing_names:
+            return True
+
+        if sid_name_use is None:
+            return False
+
+        entry = self.by_name(name)
+        if entry is not None:
+            return entry[1] != sid_name_use
+
+        return sid_name_use in self._complete_types
+
+    def __len__(self):
+        return sum(len(table) for table in self._tables.values())
+
+    def dump(self):
+        """
+        Tuple of the sequence number, a list of (rid, name, sid_name_use)
+        entries, and a list of the complete types
+        """
+        with self._lock:
+            return (
+                self.sequence,
+                [
+                    (rid, name, sid_name_use)
+                    for sid_name_use, table in self._tables.items()
+                    for rid, name in table.items()
+                ],
+                list(self._complete_types),
+            )
+
+    def load(self, entries, complete_types, sequence):
+        """
+        Add dumped entries, if they were valid for the index's sequence
+        number. Returns whether they were added
+        """
+        with self._lock:
+            if sequence != self.sequence:
+                return False
+
+            for rid, name, sid_name_use in entries:
+                self._add(rid, name, sid_name_use)
+            self._complete_types.update(complete_types)
+            self._changed()
+
+        return True
+
+
+class MembershipIndex(object):
+    """
+    Adjacency index of group and alias membership, with memoized transitive
+    expansions, valid for a single sequence number. Nodes are any hashable
+    identifiers for members and containers
+    """
+    def __init__(self):
+        self.sequence = None
+
+        self._lock = threading.Lock()
+        self._adjacent = {}
+        self._closures = {}
+
+    def set_sequence(self, sequence):
+        """
+        Update the sequence number that the index is valid for, emptying it if
+        it's changed
+        """
+        with self._lock:
+            if sequence == self.sequence:
+                return
+
+            self.sequence = sequence
+            self._adjacent.clear()
+            self._closures.clear()
+
+    def rebase(self, old_sequence, sequence):
+        """
+        Move the index from one sequence number to another without emptying
+        it, for when the caller has applied every change between the two.
+        Returns whether it was valid for old_sequence
+        """
+        with self._lock:
+            if old_sequence != self.sequence:
+                return False
+
+            self.sequence = sequence
+
+        return True
+
+    def add_adjacent(self, relation, node, added, sequence=None):
+        """
+        Record that added is now directly related to node, if node's
+        relations are indexed. Memoized expansions are dropped, since any of
+        them may include node
+        """
+        key = (relation, node)
+        with self._lock:
+            if sequence is not None and sequence != self.sequence:
+                return
+
+            nodes = self._adjacent.get(key)
+            if nodes is not None and added not in nodes:
+                self._adjacent[key] = nodes + (added,)
+            self._closures.clear()
+
+    def discard(self, relation, node):
+        """
+        Forget node's direct relations, so they're loaded again when needed.
+        Memoized expansions are dropped too
+        """
+        with self._lock:
+            self._adjacent.pop((relation, node), None)
+            self._closures.clear()
+
+    def clear(self):
+        """
+        Forget all relations, keeping the sequence number
+        """
+        with self._lock:
+            self._adjacent.clear()
+            self._closures.clear()
+
+    def adjacent(self, relation, node, load_func, sequence=None):
+        """
+        Tuple of nodes directly related to node (for example, the direct
+        members of a group). load_func(node) is called to get them if they're
+        not already indexed
+        """
+        key = (relation, node)
+        nodes = self._adjacent.get(key)
+        if nodes is None:
+            nodes = tuple(load_func(node))
+            with self._lock:
+                if sequence is None or sequence == self.sequence:
+                    self._adjacent[key] = nodes
+
+        return nodes
+
+    def dump(self):
+        """
+        Tuple of the sequence number, and a list of (relation, node, nodes)
+        direct relations. Memoized expansions aren't included
+        """
+        with self._lock:
+            return self.sequence, [
+                (relation, node, nodes)
+                for (relation, node), nodes in self._adjacent.items()
+            ]
+
+    def load(self, entries, sequence):
+        """
+        Add dumped direct relations, if they were valid for the index's
+        sequence number. Returns whether they were added
+        """
+        with self._lock:
+            if sequence != self.sequence:
+                return False
+
+            for relation, node, nodes in entries:
+                self._adjacent[(relation, node)] = tuple(nodes)
+
+        return True
+
+    def memoized(self, relation, node, load_func, sequence=None):
+        """
+        Memoized result of load_func(node) for a derived relation
+        """
+        key = (relation, node)
+        result = self._closures.get(key)
+        if result is None:
+            result = load_func(node)
+            with self._lock:
+                if sequence is None or sequence == self.sequence:
+                    self._closures[key] = result
+
+        return result
+
+    def closure(self, relation, node, adjacent_func, sequence=None):
+        """
+        Frozen set of all nodes transitively related to node, following
+        adjacent_func(node). Memoized per node, and memoized closures of
+        other nodes are reused while expanding
+        """
+        key = ('closure', relation)
+        result = self._closures.get((key, node))
+        if result is not None:
+            return result
+
+        seen = set()
+        frontier = [node]
+        while frontier:
+            next_frontier = []
+            for current in frontier:
+                memo = self._closures.get((key, current))
+                if current != node and memo is not None:
+                    seen.update(memo)
+                    continue
+
+                for adjacent in adjacent_func(current):
+                    if adjacent not in seen and adjacent != node:
+                        seen.add(adjacent)
+                        next_frontier.append(adjacent)
+
+            frontier = next_frontier
+
+        seen.discard(node)
+        result = frozenset(seen)
+        with self._lock:
+            if sequence is None or sequence == self.sequence:
+                self._closures[(key, node)] = result
+
+        return result
@@ -0,0 +1,355 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from collections import deque
+
+from pydentity.models.samba_ import Alias, Group, picklable_attrs, User
+
+WATCHED_MODELS = (User, Group, Alias)
+MODELS_BY_TYPE_NAME = {
+    model_cls.__name__.lower(): model_cls
+    for model_cls in WATCHED_MODELS
+}
+# Rows per display list query while scanning
+SCAN_DISPLAY_SIZE = 1024
+# Most objects whose attrs are queried by one scan to find changes that
+# aren't in the bulk listings
+SCAN_MAX_CHECKS = 256
+
+def attrs_hash(attrs):
+    """
+    Stable hash of an object's attrs
+    """
+    return hashlib.sha1(json.dumps(picklable_attrs(attrs),
+                                   sort_keys=True).encode('utf-8')).hexdigest()
+
+class DomainScanner(object):
+    """
+    Diffs the domain against the last scan of it. Names, RIDs and display
+    columns come from bulk listings: QueryDisplayInfo for types that have
+    it, and enumeration for the rest. Other attrs are only compared for
+    tracked objects, whose attrs hashes are kept: those whose attrs were
+    cached when they were scanned, or every object if track_all is set.
+    Tracked objects are re-queried only until the changes found account
+    for how far the sequence number moved, and at most max_checks per scan.
+    Any left unchecked then stop being tracked, since they may have changed
+    """
+    def __init__(self, domain, track_all=False, max_checks=SCAN_MAX_CHECKS):
+        self.domain = domain
+        self.track_all = track_all
+        self.max_checks = max_checks
+
+        # (type, rid) -> (name, display columns hash, attrs hash or None)
+        self.state = None
+        self.sequence = None
+        # Keys that stopped being tracked in the last scan
+        self.untracked = []
+        self.checks = 0
+
+    def _object(self, key, state):
+        type_name, rid = key
+        return MODELS_BY_TYPE_NAME[type_name](self.domain, rid,
+                                              name=state[key][0])
+
+    def _list(self):
+        """
+        State of every object from the bulk listings, without attrs hashes
+        """
+        state = {}
+        for model_cls in WATCHED_MODELS:
+            type_name = model_cls.__name__.lower()
+            if model_cls.display_info_level is None:
+                for obj in model_cls.all_in_domain_iter(self.domain):
+                    state[(type_name, obj.rid)] = (obj.name, None, None)
+                continue
+
+            idx = 0
+            while idx is not None:
+                page, idx = self.domain.display_page(model_cls, idx,
+                                                     SCAN_DISPLAY_SIZE)
+                for obj, display in page:
+                    state[(type_name, obj.rid)] = (obj.name,
+                                                   attrs_hash(display),
+                                                   None)
+
+        return state
+
+    def scan(self, sequence, attrs_loaded=None):
+        """
+        Scan the domain at the given sequence number. Returns a list of
+        change dicts since the last scan, or None if this is the first.
+        attrs_loaded(key, obj) is called with each object whose attrs are
+        newly tracked or have changed, with its attrs loaded
+        """
+        old = self.state
+        state = self._list()
+        changes = []
+        if old is not None:
+            for key in set(old) | set(state):
+                change = self._diff(key, old.get(key), state.get(key))
+                if change is not None:
+                    changes.append(change)
+                elif key in state:
+                    # Unchanged in the listings, so its attrs may be too
+                    state[key] = state[key][:2] + (old[key][2],)
+
+        checks, untracked = self._verify(state, changes, sequence)
+        changed = set((change['type'], change['rid']) for change in changes)
+
+        for key, (_, _, hashed) in state.items():
+            if hashed is not None:
+                continue
+
+            obj = self._object(key, state)
+            if not obj.cached:
+                if not self.track_all:
+                    continue
+                if old is not None and key not in changed and \
+                        checks >= self.max_checks:
+                    # Unchanged, so it can be tracked by a later scan
+                    continue
+                checks += 1
+
+            state[key] = state[key][:2] + (attrs_hash(obj.attrs),)
+            if attrs_loaded is not None:
+                attrs_loaded(key, obj)
+
+        self.state = state
+        self.sequence = sequence
+        self.untracked = sorted(untracked)
+        self.checks += checks
+        if old is None:
+            return None
+
+        return sorted(changes, key=lambda change: (change['type'],
+                                                   change['rid']))
+
+    def _diff(self, key, old_entry, new_entry):
+        """
+        Change dict for an object between two scans, or None if its listing
+        hasn't changed
+        """
+        type_name, rid = key
+        change = {'type': type_name, 'rid': rid}
+        if old_entry is None:
+            change['change'] = 'added'
+            change['name'] = new_entry[0]
+        elif new_entry is None:
+            change['change'] = 'removed'
+            change['name'] = old_entry[0]
+        elif old_entry[0] != new_entry[0]:
+            change['change'] = 'renamed'
+            change['name'] = new_entry[0]
+            change['old_name'] = old_entry[0]
+        elif old_entry[1] != new_entry[1]:
+            change['change'] = 'modified'
+            change['name'] = new_entry[0]
+        else:
+            return None
+
+        return change
+
+    def _verify(self, state, changes, sequence):
+        """
+        Re-query tracked objects that look unchanged, adding those that have
+        changed to changes, until the changes account for the sequence
+        number moving or the checks run out. Returns the number of checks,
+        and the set of keys that stopped being tracked
+        """
+        delta = None
+        if self.sequence is not None and sequence > self.sequence:
+            delta = sequence - self.sequence
+
+        checks = 0
+        untracked = set()
+        tracked = sorted(key for key, entry in state.items()
+                         if entry[2] is not None)
+        for key in tracked:
+            if delta is not None and len(changes) >= delta:
+                break
+
+            if checks >= self.max_checks:
+                state[key] = state[key][:2] + (None,)
+                untracked.add(key)
+                continue
+
+            checks += 1
+            obj = self._object(key, state)
+            if attrs_hash(obj.attrs) != state[key][2]:
+                state[key] = state[key][:2] + (None,)
+                changes.append({
+                    'type': key[0],
+                    'rid': key[1],
+                    'change': 'modified',
+                    'name': state[key][0],
+                })
+
+        return checks, untracked
+
+    def stats(self):
+        state = self.state or {}
+        return {
+            'sequence': self.sequence,
+            'objects': len(state),
+            'tracked': sum(1 for entry in state.values()
+                           if entry[2] is not None),
+            'checks': self.checks,
+        }
+
+class ChangeLog(object):
+    """
+    Bounded log of the changes seen at each domain sequence number. Consumers
+    ask for the changes since the last sequence number they applied; if
+    changes after that have been dropped from the log, they need to re-read
+    everything. Streams of changes each hold a server thread while they're
+    open, so at most max_streams may be open at once, if it's set
+    """
+    def __init__(self, max_changes=10000, max_streams=0):
+        self.max_changes = max_changes
+        self.max_streams = max_streams
+
+        self._condition = threading.Condition()
+        self._batches = deque()
+        self._count = 0
+        self.streams = 0
+        self.streams_refused = 0
+
+        self.sequence = None
+        # Changes after this sequence number are all in the log
+        self.complete_since = None
+
+    def start(self, sequence):
+        """
+        Set the sequence number the log starts from
+        """
+        with self._condition:
+            self.sequence = sequence
+            self.complete_since = sequence
+            self._condition.notify_all()
+
+    def append(self, sequence, changes):
+        """
+        Record the changes seen at a sequence number
+        """
+        with self._condition:
+            if changes:
+                self._batches.append((sequence, changes))
+                self._count += len(changes)
+
+            # Always keep the latest batch, even if it's over the limit
+            while self._count > self.max_changes and len(self._batches) > 1:
+                dropped_sequence, dropped = self._batches.popleft()
+                self._count -= len(dropped)
+                self.complete_since = dropped_sequence
+
+            self.sequence = sequence
+            self._condition.notify_all()
+
+    def since(self, sequence):
+        """
+        List of (sequence, changes) batches after the given sequence number,
+        or None if some of them are no longer in the log
+        """
+        with self._condition:
+            if self.complete_since is None or sequence < self.complete_since:
+                return None
+
+            return [batch for batch in self._batches if batch[0] > sequence]
+
+    def wait(self, sequence, timeout):
+        """
+        Wait up to timeout seconds for the log to move past the given
+        sequence number, then return since(sequence)
+        """
+        with self._condition:
+            if self.sequence is None or self.sequence <= sequence:
+                self._condition.wait(timeout)
+
+            return self.since(sequence)
+
+    def open_stream(self):
+        """
+        Take a stream slot, returning False if they're all taken. Must be
+        followed by close_stream if it succeeds
+        """
+        with self._condition:
+            if self.max_streams and self.streams >= self.max_streams:
+                self.streams_refused += 1
+                return False
+
+            self.streams += 1
+            return True
+
+    def close_stream(self):
+        with self._condition:
+            self.streams -= 1
+
+    def stats(self):
+        with self._condition:
+            return {
+                'sequence': self.sequence,
+                'complete_since': self.complete_since,
+                'batches': len(self._batches),
+                'changes': self._count,
+                'streams': self.streams,
+                'streams_refused': self.streams_refused,
+            }
+
+
+class ChangeWatcher(object):
+    """
+    Daemon thread that watches the domain sequence number, and when it
+    changes scans the domain for changes since the last scan, adding them to
+    a change log. Attrs outside the display columns are only compared for
+    objects that have been read through the caches
+    """
+    def __init__(self, domain, change_log, interval):
+        self.domain = domain
+        self.change_log = change_log
+        self.interval = interval
+
+        self.scanner = DomainScanner(domain)
+        self._thread = None
+
+    def poll(self):
+        """
+        Check the domain sequence number, and log changes if it's moved.
+        Returns whether it had
+        """
+        sequence = self.domain.sequence_num
+        if sequence == self.scanner.sequence:
+            return False
+
+        start = time.time()
+        checks = self.scanner.checks
+        changes = self.scanner.scan(sequence)
+        if changes is None:
+            self.change_log.start(sequence)
+        else:
+            self.change_log.append(sequence, changes)
+            logging.info("Domain sequence %d: %d changes, scanned in %.3fs "
+                         "with %d attrs checks", sequence, len(changes),
+                         time.time() - start, self.scanner.checks - checks)
+
+        return True
+
+    def start(self):
+        """
+        Poll every interval seconds from a daemon thread
+        """
+        def watch():
+            while True:
+                try:
+                    with self.domain.samr_handle.connection():
+                        self.poll()
+                except Exception:
+                    logging.exception("Error watching the domain for "
+                                      "changes")
+                time.sleep(self.interval)
+
+        self._thread = threading.Thread(target=watch, name='change-watcher')
+        self._thread.daemon = True
+        self._thread.start()
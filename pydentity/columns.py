@@ -0,0 +1,191 @@
+from array import array
+from bisect import bisect_left
+
+# Out of order RIDs buffered before they're merged into the sorted columns
+PENDING_MERGE_SIZE = 1024
+
+def intern_lower(name):
+    """
+    Lower case form of a name, sharing the name's string when it's already
+    lower case
+    """
+    lower = name.lower()
+    return name if lower == name else lower
+
+class ColumnEntries(object):
+    """
+    Read only sequence of (rid, name) tuples over a table's columns, in the
+    order given by a list of positions (or in RID order), as of when it was
+    made. Tuples are only built for the items that are read
+    """
+    __slots__ = ('rids', 'names', 'order', 'count')
+
+    def __init__(self, rids, names, order=None):
+        self.rids = rids
+        self.names = names
+        self.order = order
+        # Columns are appended to in place, so only the items that existed
+        # when the view was made are part of it
+        self.count = len(order) if order is not None else len(names)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.count))]
+
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+
+        return self.item(idx if self.order is None else self.order[idx])
+
+    def item(self, pos):
+        return (self.rids[pos], self.names[pos])
+
+
+class ColumnKeys(ColumnEntries):
+    """
+    Bisectable sort keys for a ColumnEntries view: RIDs, or
+    (lower case name, rid) tuples in name order
+    """
+    __slots__ = ()
+
+    def item(self, pos):
+        if self.order is None:
+            return self.rids[pos]
+
+        return (self.names[pos].lower(), self.rids[pos])
+
+
+class PrincipalTable(object):
+    """
+    Columns of the RIDs and names of one type of principal: an unsigned int
+    array of RIDs in order, and a parallel list of names. RIDs usually arrive
+    in order from enumeration and are appended in place; others are buffered
+    and merged into new columns in bulk, and renames copy the names, so views
+    over the old columns stay valid. Writers must be serialized by the
+    caller, but reads are safe at any time
+    """
+    __slots__ = ('_columns', '_pending', '_name_order')
+
+    def __init__(self):
+        # Replaced as a pair, so readers never see mismatched columns
+        self._columns = (array('I'), [])
+        self._pending = {}
+        self._name_order = None
+
+    def __len__(self):
+        return len(self._columns[1]) + len(self._pending)
+
+    @staticmethod
+    def _find(columns, rid):
+        rids, names = columns
+        pos = bisect_left(rids, rid, 0, len(names))
+        if pos < len(names) and rids[pos] == rid:
+            return pos
+
+        return None
+
+    def get(self, rid):
+        """
+        Name for a RID, or None
+        """
+        # Pending RIDs are merged into new columns before they're removed
+        # from pending, so check pending first
+        name = self._pending.get(rid)
+        if name is not None:
+            return name
+
+        columns = self._columns
+        pos = self._find(columns, rid)
+        return None if pos is None else columns[1][pos]
+
+    def set(self, rid, name):
+        """
+        Add or rename a RID. Returns whether the table changed
+        """
+        rids, names = columns = self._columns
+        pos = self._find(columns, rid)
+        if pos is not None:
+            if names[pos] == name:
+                return False
+            # Views over the old names may be ordered by them, so they must
+            # not change under them
+            names = list(names)
+            names[pos] = name
+            self._columns = (rids, names)
+        elif self._pending.get(rid) == name:
+            return False
+        elif not names or rid > rids[-1]:
+            # The RID goes first, since readers are bounded by the names
+            rids.append(rid)
+            names.append(name)
+        else:
+            self._pending[rid] = name
+            if len(self._pending) >= PENDING_MERGE_SIZE:
+                self._merge()
+
+        self._name_order = None
+        return True
+
+    def remove(self, rid):
+        """
+        Remove a RID. Returns whether it was there
+        """
+        if rid in self._pending:
+            self._merge(exclude=rid)
+            return True
+
+        if self._find(self._columns, rid) is None:
+            return False
+
+        self._merge(exclude=rid)
+        return True
+
+    def _merge(self, exclude=None):
+        """
+        Replace the columns with new ones including the pending RIDs
+        """
+        entries = [
+            (rid, name)
+            for rid, name in self.items()
+            if rid != exclude
+        ]
+        entries.sort()
+
+        self._columns = (array('I', (rid for rid, _ in entries)),
+                         [name for _, name in entries])
+        self._pending = {}
+        self._name_order = None
+
+    def items(self):
+        """
+        List of (rid, name) tuples, in no particular order
+        """
+        rids, names = self._columns
+        items = list(zip(rids[:len(names)], names))
+        items.extend(self._pending.items())
+        return items
+
+    def sorted_entries(self, sort):
+        """
+        Tuple of (keys, entries) views in 'rid' or 'name' order
+        """
+        if self._pending:
+            self._merge()
+
+        rids, names = self._columns
+        order = None
+        if sort == 'name':
+            order = self._name_order
+            if order is None:
+                order = self._name_order = array('I', sorted(
+                    range(len(names)),
+                    key=lambda pos: (names[pos].lower(), rids[pos]),
+                ))
+
+        return (ColumnKeys(rids, names, order),
+                ColumnEntries(rids, names, order))
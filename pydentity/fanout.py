@@ -0,0 +1,129 @@
+import heapq
+import itertools
+import sys
+import threading
+
+import six
+
+from six.moves import queue
+
+from pydentity.util import chunked
+
+# Objects read from a domain per page of a name ordered iteration
+FANOUT_PAGE_SIZE = 256
+# Items a producer sends to the merge at a time
+FANOUT_CHUNK_SIZE = 64
+# Chunks each producer may get ahead of the merge
+FANOUT_QUEUE_SIZE = 8
+# How often a blocked producer checks whether the merge was abandoned
+FANOUT_PUT_INTERVAL = 1
+
+_DONE = object()
+
+class SourceError(object):
+    """
+    Exception raised by a source, to be raised again by the merge
+    """
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def name_order_iter(domain, model_cls, prefix=None,
+                    page_size=FANOUT_PAGE_SIZE):
+    """
+    Iterator of the domain children of a model type in name order, and
+    optionally only those with names starting with prefix. Pages are read one
+    at a time, holding a SAMR connection only while each is read
+    """
+    after = None
+    while True:
+        with domain.samr_handle.connection():
+            page = domain.sorted_page(model_cls, 'name', after, prefix,
+                                      page_size)
+
+        for obj in page:
+            yield obj
+
+        if len(page) < page_size:
+            return
+
+        after = (page[-1].name.lower(), page[-1].rid)
+
+def _decorated(iterable, key, idx):
+    counter = itertools.count()
+    for item in iterable:
+        yield (key(item), idx, next(counter), item)
+
+def merge_sorted(iterables, key):
+    """
+    Merge iterables that are each sorted by key into one sorted iterator.
+    Items with equal keys come in the order of their iterables
+    """
+    return (
+        item
+        for _, _, _, item in heapq.merge(*[
+            _decorated(iterable, key, idx)
+            for idx, iterable in enumerate(iterables)
+        ])
+    )
+
+def _put(items, item, stopping):
+    """
+    Put an item on a producer's queue, waiting for room. Returns False if the
+    merge was abandoned first
+    """
+    while not stopping.is_set():
+        try:
+            items.put(item, timeout=FANOUT_PUT_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+def _produce(source, items, stopping):
+    try:
+        for chunk in chunked(source, FANOUT_CHUNK_SIZE):
+            if not _put(items, chunk, stopping):
+                return
+    except Exception:
+        _put(items, SourceError(sys.exc_info()), stopping)
+        return
+
+    _put(items, _DONE, stopping)
+
+def _consume(items):
+    while True:
+        chunk = items.get()
+        if chunk is _DONE:
+            return
+        if isinstance(chunk, SourceError):
+            six.reraise(*chunk.exc_info)
+
+        for item in chunk:
+            yield item
+
+def concurrent_merge(sources, key, name='fanout'):
+    """
+    Merge iterables that are each sorted by key into one sorted iterator,
+    reading every iterable on its own thread, so that slow sources are read
+    in parallel while the merge streams. Producers only get a few chunks
+    ahead of the merge, and stop once it's closed. An exception from a
+    source is raised by the merge when it reaches that source's items
+    """
+    stopping = threading.Event()
+    queues = []
+    try:
+        for idx, source in enumerate(sources):
+            items = queue.Queue(FANOUT_QUEUE_SIZE)
+            thread = threading.Thread(target=_produce,
+                                      args=(source, items, stopping),
+                                      name='%s-%d' % (name, idx))
+            thread.daemon = True
+            thread.start()
+            queues.append(items)
+
+        for item in merge_sorted([_consume(items) for items in queues], key):
+            yield item
+    finally:
+        stopping.set()
@@ -0,0 +1,268 @@
+import logging
+import re
+import threading
+import time
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def format_labels(labels):
+    """
+    Prometheus text format for a tuple of (name, value) label pairs
+    """
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (
+            name,
+            str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'),
+        )
+        for name, value in labels
+    )
+
+def metric_name_part(text):
+    """
+    Text made safe to use as part of a metric name
+    """
+    return re.sub(r'[^a-zA-Z0-9_]', '_', text).lower()
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+class Metric(object):
+    """
+    Base for metrics with a value per set of labels
+    """
+    metric_type = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(zip(self.label_names,
+                         (labels[name] for name in self.label_names)))
+
+    def samples(self):
+        """
+        List of (name, labels, value) tuples
+        """
+        with self._lock:
+            return [
+                (self.name, key, value)
+                for key, value in sorted(self._values.items())
+            ]
+
+    def render(self):
+        """
+        Prometheus text format lines for this metric
+        """
+        lines = [
+            '# HELP %s %s' % (self.name, self.help_text),
+            '# TYPE %s %s' % (self.name, self.metric_type),
+        ]
+        lines.extend(
+            '%s%s %s' % (name, format_labels(labels), format_value(value))
+            for name, labels, value in self.samples()
+        )
+        return lines
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count
+    """
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down
+    """
+    metric_type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, in cumulative buckets
+    """
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0),
+            )
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total))
+                for key, (counts, total) in self._values.items()
+            )
+
+        samples = []
+        for key, (counts, total) in values:
+            for bound, count in zip(self.buckets, counts):
+                samples.append(('%s_bucket' % self.name,
+                                key + (('le', format_value(bound)),),
+                                count))
+            samples.append(('%s_sum' % self.name, key, total))
+            samples.append(('%s_count' % self.name, key, counts[-1]))
+
+        return samples
+
+
+class Registry(object):
+    """
+    Collection of metrics, and of collector functions that report gauges
+    from stats kept elsewhere
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def add_collector(self, prefix, stats_func):
+        """
+        Report every number in the dict returned by stats_func as a gauge
+        named prefix_<key>
+        """
+        self._collectors.append((prefix, stats_func))
+
+    def render(self):
+        """
+        All metrics in Prometheus text format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        for prefix, stats_func in self._collectors:
+            try:
+                stats = stats_func()
+            except Exception:
+                logging.exception("Error collecting %s stats", prefix)
+                continue
+
+            for key, value in sorted(stats.items()):
+                if not isinstance(value, (int, long, float)) or \
+                        isinstance(value, bool):
+                    continue
+
+                name = '%s_%s' % (prefix, key)
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('%s %s' % (name, format_value(value)))
+
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+SAMR_CALL_SECONDS = REGISTRY.histogram(
+    'pydentity_samr_call_seconds', "Latency of SAMR calls", ('op',))
+SAMR_CALLS = REGISTRY.counter(
+    'pydentity_samr_calls_total', "SAMR calls made", ('op',))
+SAMR_ERRORS = REGISTRY.counter(
+    'pydentity_samr_errors_total', "SAMR calls that raised", ('op',))
+SAMR_IN_FLIGHT = REGISTRY.gauge(
+    'pydentity_samr_in_flight', "SAMR calls in progress", ('op',))
+SAMR_COALESCED = REGISTRY.counter(
+    'pydentity_samr_coalesced_total',
+    "SAMR reads that shared an identical read already in flight", ('op',))
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'pydentity_http_request_seconds', "Latency of HTTP requests",
+    ('endpoint', 'method', 'status'))
+HTTP_SHED = REGISTRY.counter(
+    'pydentity_http_shed_total',
+    "Connections refused with a 503 because the request queue was full")
+
+
+def timed_call(op, func, args, kwargs, slow_call_secs=None):
+    """
+    Call func, recording its latency, errors and concurrency as SAMR call op
+    """
+    SAMR_CALLS.inc(op=op)
+    SAMR_IN_FLIGHT.inc(op=op)
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        SAMR_ERRORS.inc(op=op)
+        raise
+    finally:
+        elapsed = time.time() - start
+        SAMR_IN_FLIGHT.dec(op=op)
+        SAMR_CALL_SECONDS.observe(elapsed, op=op)
+        if slow_call_secs and elapsed >= slow_call_secs:
+            logging.warning("Slow SAMR call %s took %.3fs", op, elapsed)
+
+
+class InstrumentedConnection(object):
+    """
+    Wraps a samr connection object, recording metrics for every call made
+    through it
+    """
+    def __init__(self, connection_obj, slow_call_secs=None):
+        self._connection_obj = connection_obj
+        self._slow_call_secs = slow_call_secs
+
+    def __getattr__(self, name):
+        attr = getattr(self._connection_obj, name)
+        if not callable(attr):
+            return attr
+
+        slow_call_secs = self._slow_call_secs
+        def wrapper(*args, **kwargs):
+            return timed_call(name, attr, args, kwargs, slow_call_secs)
+
+        return wrapper
@@ -1,25 +1,179 @@
+import functools
 import logging
+import threading
+import time
 
-from samba.dcerpc import lsa
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from samba.dcerpc import lsa, samr, security
 from samba.dcerpc.samr import (
     ALIASINFOALL,
+    ALIASINFODESCRIPTION,
+    ALIASINFONAME,
     DomainGeneralInformation,
     DomainGeneralInformation2,
+    DomainLockoutInformation,
+    DomainLogoffInformation,
     DomainModifiedInformation,
+    DomainNameInformation,
+    DomainOEMInformation,
     DomainPasswordInformation,
+    DomainReplicationInformation,
+    DomainServerRoleInformation,
+    DomainStateInformation,
     GROUPINFOALL,
+    GROUPINFOATTRIBUTES,
+    GROUPINFODESCRIPTION,
+    GROUPINFONAME,
+    UserAccountInformation,
+    UserAccountNameInformation,
+    UserAdminCommentInformation,
     UserAllInformation,
+    UserControlInformation,
+    UserExpiresInformation,
+    UserFullNameInformation,
+    UserGeneralInformation,
+    UserHomeInformation,
+    UserLogonHoursInformation,
+    UserLogonInformation,
+    UserNameInformation,
+    UserParametersInformation,
+    UserPreferencesInformation,
+    UserPrimaryGroupInformation,
+    UserProfileInformation,
+    UserScriptInformation,
+    UserWorkStationsInformation,
+)
+
+from pydentity.cache import AttrCache, MembershipIndex, NameIndex
+from pydentity.samba_util import (
+    LOOKUP_BATCH_SIZE,
+    run_shared,
+    SECURITY_FLAG,
+    lsa_unwrap,
+    lsa_wrap,
 )
+from pydentity.schema import model_schema, register_model_schema
+from pydentity.singleflight import SingleFlight
+from pydentity.util import chunked, SIMPLE_PRINTABLE_TYPES
+
+# Samba sizes enumeration replies in bytes, budgeting this many bytes for each
+# entry (SAMR_ENUM_USERS_MULTIPLIER in the Samba source)
+ENUM_ENTRY_SIZE = 54
+ENUM_BATCH_DEFAULT = 128
+ENUM_BATCH_MIN = 16
+ENUM_BATCH_MAX = 1024
+# Batches grow while round trips are well under this, and shrink above it
+ENUM_BATCH_TARGET_SECS = 0.25
+# Reply buffer budget per entry for QueryDisplayInfo
+DISPLAY_ENTRY_SIZE = 256
+# Columns of QueryDisplayInfo entries, other than rid and account_name
+DISPLAY_ENTRY_FIELDS = ('full_name', 'description', 'acct_flags')
+# Attributes of group memberships added by AddGroupMember: mandatory,
+# enabled by default, and enabled
+GROUP_MEMBER_ATTRIBUTES = 7
+INT_TYPES = (int, long)
+
+def enum_size(batch_size):
+    """
+    The max_size to request from EnumDomain{X} to get batch_size entries
+    """
+    return (batch_size - 1) * ENUM_ENTRY_SIZE
+
+def next_batch_size(batch_size, elapsed):
+    """
+    Adapt an enumeration batch size to the latency of the last round trip
+    """
+    if elapsed < ENUM_BATCH_TARGET_SECS / 2:
+        batch_size *= 2
+    elif elapsed > ENUM_BATCH_TARGET_SECS:
+        batch_size //= 2
+
+    return max(ENUM_BATCH_MIN, min(ENUM_BATCH_MAX, batch_size))
+
+def cover_levels(level_fields, field_names, default_levels):
+    """
+    The fewest info levels from level_fields (a sequence of (level, frozenset
+    of field names) tuples) whose fields include all of field_names,
+    preferring levels with fewer fields. Falls back to default_levels if
+    some field isn't known, or if they'd take no more queries
+    """
+    wanted = set(field_names)
+    if not wanted:
+        return ()
+
+    known = frozenset().union(*(fields for _, fields in level_fields))
+    if not wanted <= known:
+        return default_levels
+
+    covering = [
+        (len(fields), level)
+        for level, fields in level_fields
+        if wanted <= fields
+    ]
+    if covering:
+        return (min(covering)[1],)
+
+    levels = []
+    while wanted:
+        _, _, level, fields = max(
+            (len(wanted & fields), -len(fields), level, fields)
+            for level, fields in level_fields
+        )
+        levels.append(level)
+        wanted -= fields
+
+    if len(levels) >= len(default_levels):
+        return default_levels
+
+    return tuple(levels)
+
+def picklable_attrs(attrs):
+    """
+    The attrs with simple values, that can be passed between processes
+    """
+    return {
+        attr_name: value
+        for attr_name, value in attrs.items()
+        if value is None or isinstance(value, SIMPLE_PRINTABLE_TYPES)
+    }
+
+def remote(result_filter=None):
+    """
+    Decorator for model methods that make SAMR calls. When the domain has an
+    RPC broker, the call is sent to a SAMR worker process, which runs the
+    method on its own copy of the model and returns the result, passed
+    through result_filter so that it can be pickled
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            broker = self.rpc_broker
+            if broker is None:
+                return method(self, *args)
 
-from pydentity.samba_util import SECURITY_FLAG, lsa_unwrap
-from pydentity.util import SYSTEM_PROPERTY_RE
+            return broker.call(self.remote_ref, method.__name__, args)
+
+        wrapper.remote_method = method
+        wrapper.result_filter = result_filter
+        return wrapper
+
+    return decorator
 
 class PolicyHandleObject(object):
     """
     Mixin for objects that have policy_handle objects associated with them
     """
+    __slots__ = ()
     _policy_handle_obj = None
     _attrs = None
+    # Tuple of (level, frozenset of attr names) for every information class
+    # level that can be queried, for projecting attrs to the cheapest levels
+    info_level_fields = ()
+    # Levels that return a bare string, rather than a struct -> attr name
+    string_info_levels = {}
 
     @property
     def samr_handle(self):
@@ -49,53 +203,154 @@ class PolicyHandleObject(object):
         """
         raise NotImplementedError("Must override all_info_class_level")
 
+    @property
+    def rpc_broker(self):
+        """
+        Broker that sends SAMR calls for this object to worker processes, or
+        None to make them in this process
+        """
+        raise NotImplementedError("Must override rpc_broker")
+
+    @property
+    def remote_ref(self):
+        """
+        Picklable reference used by SAMR workers to rebuild this object
+        """
+        raise NotImplementedError("Must override remote_ref")
+
+    @property
+    def info_levels(self):
+        """
+        Tuple of the information class levels in all_info_class_level
+        """
+        levels = self.all_info_class_level
+        if not isinstance(levels, (list, tuple)):
+            levels = (levels,)
+
+        return tuple(levels)
+
+    def levels_for_fields(self, field_names=None):
+        """
+        Tuple of the information class levels to query for the given attr
+        names; all levels if field_names is None
+        """
+        if field_names is None or not self.info_level_fields:
+            return self.info_levels
+
+        return cover_levels(self.info_level_fields, field_names,
+                            self.info_levels)
+
+    @property
+    def handle_cache_key(self):
+        """
+        Key for this object's policy_handle in the SAMRHandle handle cache, or
+        None if the handle should only be kept by this object
+        """
+        return None
+
+    @property
+    def handle_cache(self):
+        """
+        HandleCache that handle_cache_key is kept in, on the connection the
+        SAMRHandle is using at the time
+        """
+        return self.samr_handle.handle_cache
+
     @property
     def policy_handle_obj(self):
         """
         Samba policy_handle object
         """
+        key = self.handle_cache_key
+        if key is not None:
+            # Not kept on the object, since the handle belongs to whichever
+            # connection the SAMRHandle is using at the time
+            return self.handle_cache.get(key, self._open_policy_handle_obj)
+
         if not self._policy_handle_obj:
-            self._policy_handle_obj = getattr(
-                self.samr_handle.connection_obj,
-                'Open%s' % self.__class__.__name__,
-            )(
-                self.parent_handle,
-                SECURITY_FLAG,
-                self.canonical_id,
-            )
+            self._policy_handle_obj = self._open_policy_handle_obj()
 
         return self._policy_handle_obj
 
+    def _open_policy_handle_obj(self):
+        """
+        Open a new Samba policy_handle object for this object
+        """
+        return getattr(
+            self.samr_handle.connection_obj,
+            'Open%s' % self.__class__.__name__,
+        )(
+            self.parent_handle,
+            SECURITY_FLAG,
+            self.canonical_id,
+        )
+
     @property
     def attrs(self):
         """
         Lazy loaded dict of the args from the policy object
         """
         if not self._attrs:
-            request_levels = self.all_info_class_level
-            if not isinstance(request_levels, (list, tuple)):
-                request_levels = (request_levels,)
-
             attrs = {}
-            for request_level in request_levels:
-                info_obj = getattr(
-                    self.samr_handle.connection_obj,
-                    'Query%sInfo' % self.__class__.__name__,
-                )(
-                    self.policy_handle_obj,
-                    request_level,
-                )
-
-                attrs.update({
-                    attr_name: lsa_unwrap(getattr(info_obj, attr_name))
-                    for attr_name in dir(info_obj)
-                    if not SYSTEM_PROPERTY_RE.match(attr_name)
-                })
+            for request_level in self.info_levels:
+                attrs.update(self._query_level(request_level))
 
             self._attrs = attrs
 
         return self._attrs
 
+    def attrs_for(self, field_names=None):
+        """
+        Dict of attrs including at least those named in field_names, querying
+        only the cheapest information class levels that have them. Already
+        loaded attrs are used if there are any
+        """
+        levels = self.levels_for_fields(field_names)
+        if self.loaded or levels == self.info_levels:
+            return self.attrs
+
+        attrs = {}
+        for request_level in levels:
+            attrs.update(self._query_level(request_level))
+
+        return attrs
+
+    @remote(result_filter=picklable_attrs)
+    def _query_level(self, request_level):
+        """
+        Query the server for the attrs dict of a single information class level
+        """
+        info_obj = getattr(
+            self.samr_handle.connection_obj,
+            'Query%sInfo' % self.__class__.__name__,
+        )(
+            self.policy_handle_obj,
+            request_level,
+        )
+
+        attr_name = self.string_info_levels.get(request_level)
+        if attr_name is not None:
+            return {attr_name: lsa_unwrap(info_obj)}
+
+        schema = register_model_schema(self.__class__, request_level, info_obj)
+        return schema.extract(info_obj)
+
+    @property
+    def schema(self):
+        """
+        ModelSchema for the attrs of this object, or None if it isn't known
+        yet
+        """
+        return model_schema(self.__class__, self.info_levels)
+
+    def schema_for_fields(self, field_names=None):
+        """
+        ModelSchema for the levels that would be queried for the given attr
+        names, or None if it isn't known yet
+        """
+        return model_schema(self.__class__,
+                            self.levels_for_fields(field_names))
+
     @property
     def loaded(self):
         """
@@ -116,16 +371,287 @@ class Domain(PolicyHandleObject):
     A Samba domain
     """
     _sid_obj = None
+    _sequence_checked = 0
+    _shared_sequence = None
+    modified_time = None
+    rpc_broker = None
+    _prefetch_pool = None
+    _write_pool = None
     all_info_class_level = (
         DomainGeneralInformation,
         DomainGeneralInformation2,
         DomainModifiedInformation,
         DomainPasswordInformation,
     )
+    info_level_fields = (
+        (DomainPasswordInformation, frozenset((
+            'min_password_length', 'password_history_length',
+            'password_properties', 'max_password_age', 'min_password_age',
+        ))),
+        (DomainGeneralInformation, frozenset((
+            'force_logoff_time', 'oem_information', 'domain_name', 'primary',
+            'sequence_num', 'domain_server_state', 'role', 'unknown3',
+            'num_users', 'num_groups', 'num_aliases',
+        ))),
+        (DomainLogoffInformation, frozenset(('force_logoff_time',))),
+        (DomainOEMInformation, frozenset(('oem_information',))),
+        (DomainNameInformation, frozenset(('domain_name',))),
+        (DomainReplicationInformation, frozenset(('primary',))),
+        (DomainServerRoleInformation, frozenset(('role',))),
+        (DomainModifiedInformation, frozenset((
+            'sequence_num', 'domain_create_time',
+        ))),
+        (DomainStateInformation, frozenset(('domain_server_state',))),
+        (DomainGeneralInformation2, frozenset((
+            'general', 'lockout_duration', 'lockout_window',
+            'lockout_threshold',
+        ))),
+        (DomainLockoutInformation, frozenset((
+            'lockout_duration', 'lockout_window', 'lockout_threshold',
+        ))),
+    )
 
-    def __init__(self, name, samr_handle):
+    def __init__(self,
+                 name,
+                 samr_handle,
+                 sequence_poll_interval=5,
+                 attr_cache_size=65536,
+                 prefetch_concurrency=4,
+                 rpc_broker=None,
+                 coalesce_timeout=30,
+                 shared_cache=None,
+                 write_concurrency=4,
+                 max_write_defer=30):
         self._name = name
         self._samr_handle = samr_handle
+        self.rpc_broker = rpc_broker
+        self.shared_cache = shared_cache
+        self._sequence_lock = threading.Lock()
+
+        self._write_lock = threading.Lock()
+        self._writers = 0
+        self._write_ready = None
+        self._write_base = None
+        self._own_writes = 0
+        self.max_write_defer = max_write_defer
+
+        self.sequence_poll_interval = sequence_poll_interval
+        self.prefetch_concurrency = prefetch_concurrency
+        self.write_concurrency = write_concurrency
+        self.attr_cache = AttrCache(attr_cache_size)
+        self.name_index = NameIndex()
+        self.membership = MembershipIndex()
+        self.single_flight = SingleFlight(coalesce_timeout)
+        self._level_attrs = {}
+
+    @property
+    def attrs(self):
+        self.check_sequence()
+        return super(Domain, self).attrs
+
+    @property
+    def sequence_num(self):
+        """
+        The domain modification sequence number, as of the last poll
+        """
+        self.check_sequence()
+        return self.attr_cache.sequence
+
+    def check_sequence(self):
+        """
+        Poll the domain modification sequence number if the poll interval has
+        passed. If it's changed, cached attrs for the domain and its children
+        are flushed. Polls are deferred while writes are in progress, but for
+        no more than max_write_defer seconds, so a stuck write can't stop
+        outside changes from being seen
+        """
+        if self._writers and \
+                time.time() - self._sequence_checked < self.max_write_defer:
+            return
+        if time.time() - self._sequence_checked < self.sequence_poll_interval:
+            return
+
+        with self._sequence_lock:
+            # Another thread may have polled while we waited for the lock
+            if (time.time() - self._sequence_checked <
+                    self.sequence_poll_interval):
+                return
+
+            sequence = None
+            if self.shared_cache is not None:
+                # The leader process polls the server, and publishes the
+                # sequence number with the shared cache
+                sequence = self.shared_cache.sequence()
+            self._shared_sequence = sequence
+            if sequence is None:
+                sequence = self._query_sequence()
+
+            self._set_sequence(sequence)
+            self._sequence_checked = time.time()
+
+    def _set_sequence(self, sequence):
+        """
+        Flush the caches if the sequence number has changed. Must hold the
+        sequence lock
+        """
+        if self.attr_cache.set_sequence(sequence):
+            self._domain_changed()
+        self.name_index.set_sequence(sequence)
+        self.membership.set_sequence(sequence)
+
+    def _domain_changed(self):
+        self._attrs = None
+        self._level_attrs = {}
+        # The server doesn't report when the domain was modified, so use
+        # when the change was first seen
+        self.modified_time = time.time()
+
+    @contextmanager
+    def writing(self):
+        """
+        Context manager for making writes through the models. While any
+        writes are in progress, sequence number polls are deferred, and each
+        write applies its own changes to the caches in place. When the last
+        finishes, the caches are rebased onto the server's new sequence
+        number if it moved by exactly one per write, so nothing else can
+        have changed; otherwise they're flushed as usual. With a shared
+        cache, the leader process picks the changes up instead
+        """
+        if self.shared_cache is not None:
+            yield
+            return
+
+        with self._write_lock:
+            self._writers += 1
+            starting = self._writers == 1
+            if starting:
+                self._write_ready = threading.Event()
+                self._write_base = None
+                self._own_writes = 0
+            ready = self._write_ready
+
+        try:
+            if starting:
+                try:
+                    # Start from the server's current sequence number, so
+                    # that only these writes can account for it moving. It's
+                    # queried without the write lock, which other writers
+                    # take for their bookkeeping
+                    sequence = self._query_sequence()
+                    with self._sequence_lock:
+                        self._set_sequence(sequence)
+                        self._sequence_checked = time.time()
+                    with self._write_lock:
+                        self._write_base = sequence
+                finally:
+                    ready.set()
+            else:
+                # Writes can't start until the base sequence number is known
+                ready.wait()
+
+            yield
+        finally:
+            with self._write_lock:
+                self._writers -= 1
+                finished = not self._writers
+                if finished:
+                    base, own_writes = self._write_base, self._own_writes
+            if finished:
+                self._finish_writes(base, own_writes)
+
+    def record_write(self):
+        """
+        Count a successful write, for rebasing the caches afterwards
+        """
+        with self._write_lock:
+            if self._writers:
+                self._own_writes += 1
+
+    def _finish_writes(self, base, own_writes):
+        """
+        Rebase or flush the caches once the last write in progress is done,
+        given the sequence number the writes started from and how many
+        succeeded
+        """
+        if base is None:
+            # The starting sequence number couldn't be queried, so the next
+            # check polls again, and flushes
+            self._sequence_checked = 0
+            return
+
+        try:
+            sequence = self._query_sequence()
+        except Exception:
+            logging.exception("Error checking sequence number after writes")
+            # The next check polls again, and flushes
+            self._sequence_checked = 0
+            return
+
+        with self._sequence_lock:
+            expected = base + own_writes
+            if sequence == expected and \
+                    self.attr_cache.rebase(base, sequence):
+                self.name_index.rebase(base, sequence)
+                self.membership.rebase(base, sequence)
+                # Domain attrs include object counts, and are cheap to reload
+                self._domain_changed()
+            else:
+                if sequence != expected:
+                    logging.info("Sequence number moved from %d to %d after "
+                                 "%d writes; flushing caches", base,
+                                 sequence, own_writes)
+                self._set_sequence(sequence)
+
+            self._sequence_checked = time.time()
+
+    @property
+    def current_shared_cache(self):
+        """
+        The shared directory cache, if it's been published at the domain's
+        current sequence number, otherwise None
+        """
+        if self._shared_sequence is None or \
+                self._shared_sequence != self.attr_cache.sequence:
+            return None
+
+        return self.shared_cache
+
+    def names_complete(self, sid_name_use):
+        """
+        Whether every object of a type can be listed without enumerating
+        from the server
+        """
+        self.check_sequence()
+        return self.current_shared_cache is not None or \
+            self.name_index.is_complete(sid_name_use)
+
+    def _query_level(self, request_level):
+        """
+        Attrs for each information class level are kept until the domain
+        sequence number changes
+        """
+        self.check_sequence()
+        attrs = self._level_attrs.get(request_level)
+        if attrs is None:
+            attrs = self.single_flight.do(
+                'QueryDomainInfo',
+                ('Domain', request_level, self.attr_cache.sequence),
+                functools.partial(super(Domain, self)._query_level,
+                                  request_level),
+            )
+            self._level_attrs[request_level] = attrs
+
+        return attrs
+
+    @remote()
+    def _query_sequence(self):
+        """
+        Query the server for the domain modification sequence number
+        """
+        info_obj = self.samr_handle.connection_obj.QueryDomainInfo(
+            self.policy_handle_obj, DomainModifiedInformation,
+        )
+        return info_obj.sequence_num
 
     @property
     def name(self):
@@ -138,11 +664,17 @@ class Domain(PolicyHandleObject):
     def samr_handle(self):
         return self._samr_handle
     @property
+    def remote_ref(self):
+        return (self._name, 'Domain', None)
+    @property
     def parent_handle(self):
         return self.samr_handle.policy_handle_obj
     @property
     def canonical_id(self):
         return self.sid_obj
+    @property
+    def policy_handle_obj(self):
+        return self.samr_handle.domain_handle_obj(self.sid_obj)
 
     @property
     def sid_obj(self):
@@ -150,10 +682,388 @@ class Domain(PolicyHandleObject):
         Samba dom_sid object
         """
         if not self._sid_obj:
-            self._sid_obj = self.samr_handle.get_domain_sid_obj(self.name)
+            sid_obj = self._lookup_sid()
+            if isinstance(sid_obj, basestring):
+                # From a SAMR worker process
+                sid_obj = security.dom_sid(sid_obj)
+
+            self._sid_obj = sid_obj
 
         return self._sid_obj
 
+    @remote(result_filter=str)
+    def _lookup_sid(self):
+        """
+        Query the server for the domain SID
+        """
+        return self.samr_handle.get_domain_sid_obj(self.name)
+
+    @remote()
+    def enum_domain_names(self):
+        """
+        List of the names of every domain on the server, including this one
+        """
+        return self.samr_handle.enum_domain_names()
+
+    def lookup_names(self, names):
+        """
+        Resolve a list of names to (rid, sid_name_use) tuples, or (None, None)
+        for names that don't exist. Names that aren't in the name index are
+        looked up on the server in batches, and added to the index
+        """
+        self.check_sequence()
+        index = self.name_index
+        sequence = index.sequence
+
+        # Names are case insensitive, so results are keyed by lower case name
+        found = {}
+        unknown = []
+        for name in names:
+            key = name.lower()
+            if key in found:
+                continue
+
+            if index.name_missing(name):
+                found[key] = (None, None)
+                continue
+
+            entry = index.by_name(name)
+            if entry is None:
+                unknown.append(name)
+                found[key] = None
+            else:
+                found[key] = entry
+
+        shared = self.current_shared_cache
+        if unknown and shared is not None:
+            unshared = []
+            for name in unknown:
+                entry = shared.by_name(name)
+                if entry is None:
+                    unshared.append(name)
+                else:
+                    found[name.lower()] = tuple(entry)
+            unknown = unshared
+
+        if unknown:
+            results = self._lookup_names(unknown)
+            for name, (rid, sid_name_use) in zip(unknown, results):
+                if rid is None:
+                    index.add_missing_name(name, sequence)
+                else:
+                    index.add(rid, name, sid_name_use, sequence)
+
+                found[name.lower()] = (rid, sid_name_use)
+
+        return [found[name.lower()] for name in names]
+
+    def lookup_rids(self, rids):
+        """
+        Resolve a list of RIDs to (name, sid_name_use) tuples, or
+        (None, None) for RIDs that don't exist. RIDs that aren't in the name
+        index are looked up on the server in batches, and added to the index
+        """
+        self.check_sequence()
+        index = self.name_index
+        sequence = index.sequence
+
+        found = {}
+        unknown = []
+        for rid in rids:
+            if rid in found:
+                continue
+
+            if index.rid_missing(rid):
+                found[rid] = (None, None)
+                continue
+
+            entry = index.by_rid(rid)
+            if entry is None:
+                unknown.append(rid)
+                found[rid] = None
+            else:
+                found[rid] = entry
+
+        shared = self.current_shared_cache
+        if unknown and shared is not None:
+            unshared = []
+            for rid in unknown:
+                entry = shared.by_rid(rid)
+                if entry is None:
+                    unshared.append(rid)
+                else:
+                    found[rid] = tuple(entry)
+            unknown = unshared
+
+        if unknown:
+            results = self._lookup_rids(unknown)
+            for rid, (name, sid_name_use) in zip(unknown, results):
+                if name is None:
+                    index.add_missing_rid(rid, sequence)
+                else:
+                    index.add(rid, name, sid_name_use, sequence)
+
+                found[rid] = (name, sid_name_use)
+
+        return [found[rid] for rid in rids]
+
+    @property
+    def prefetch_pool(self):
+        """
+        Thread pool used to load the attrs of many children at once
+        """
+        if not self._prefetch_pool:
+            self._prefetch_pool = ThreadPool(self.prefetch_concurrency)
+
+        return self._prefetch_pool
+
+    def prefetch_attrs(self, objects, field_names=None):
+        """
+        Load the attrs of many domain children, with at most
+        prefetch_concurrency queries in flight. Objects that are already
+        loaded, or that have cached attrs, aren't queried. The calling
+        thread queries on its own connection, helped by prefetch threads
+        that can get a spare pooled connection without waiting, so requests
+        holding every connection can't starve each other's prefetches. If
+        field_names is given, only the levels needed for them are loaded
+        """
+        self.check_sequence()
+
+        pending = [obj for obj in objects if not obj.cached_for(field_names)]
+        if len(pending) > 1 and self.prefetch_concurrency > 1:
+            run_shared(self.samr_handle, self.prefetch_pool,
+                       lambda obj: obj.attrs_for(field_names),
+                       pending, self.prefetch_concurrency - 1)
+
+        for obj in objects:
+            obj.attrs_for(field_names)
+
+    @property
+    def write_pool(self):
+        """
+        Thread pool used to make writes on several pooled connections at once
+        """
+        if not self._write_pool:
+            self._write_pool = ThreadPool(self.write_concurrency)
+
+        return self._write_pool
+
+    def create_user(self, name, acct_flags=samr.ACB_NORMAL):
+        """
+        Create a user, returning its model. The new user's policy handle is
+        kept open on the connection for the writes that usually follow.
+        Samba makes new users members of Domain Users, whose cached members
+        are dropped
+        """
+        rid = self._create_user(name, acct_flags)
+        self.record_write()
+
+        self.name_index.add(rid, name, lsa.SID_NAME_USER,
+                            self.name_index.sequence)
+        domain_users = Group(self, security.DOMAIN_RID_USERS)
+        self.membership.discard('members', domain_users.node)
+        domain_users.discard_cached_levels(('num_members',))
+
+        return User(self, rid, name=name)
+
+    @remote()
+    def _create_user(self, name, acct_flags):
+        user_handle_obj, _, rid = self.samr_handle.connection_obj.CreateUser2(
+            self.policy_handle_obj, lsa_wrap(name), acct_flags, SECURITY_FLAG,
+        )
+
+        user = User(self, rid)
+        handle_obj = user.handle_cache.get(
+            user.handle_cache_key, lambda: user_handle_obj,
+        )
+        if handle_obj is not user_handle_obj:
+            self.samr_handle.connection_obj.Close(user_handle_obj)
+
+        return rid
+
+    @remote()
+    def _lookup_names(self, names):
+        return self.samr_handle.lookup_names(self.policy_handle_obj, names)
+
+    @remote()
+    def _lookup_rids(self, rids):
+        return self.samr_handle.lookup_rids(self.policy_handle_obj, rids)
+
+    def enum_batch(self, model_name, resume_handle, size):
+        """
+        Enumerate a batch of domain children, sharing the result of an
+        identical enumeration already in flight
+        """
+        model_cls = MODELS_BY_NAME[model_name]
+        return self.single_flight.do(
+            'EnumDomain%s' % model_cls.plural_name(),
+            ('enum', model_name, resume_handle, size,
+             self.name_index.sequence),
+            functools.partial(self._enum_batch, model_name, resume_handle,
+                              size),
+        )
+
+    def fill_names(self, model_cls):
+        """
+        Fill the name index with every domain child of a model type, by a
+        full enumeration. Requests that find the index incomplete at the
+        same time share one enumeration, rather than each making their own
+        """
+        self.single_flight.do(
+            'EnumDomain%s' % model_cls.plural_name(),
+            ('fill', model_cls.__name__, self.name_index.sequence),
+            functools.partial(self._fill_names, model_cls),
+        )
+
+    def _fill_names(self, model_cls):
+        for _ in model_cls.all_in_domain_iter(self):
+            pass
+
+    @remote()
+    def _enum_batch(self, model_name, resume_handle, size):
+        """
+        Enumerate a batch of domain children of a model type. Returns the
+        new resume handle, and a list of (rid, name) tuples
+        """
+        model_cls = MODELS_BY_NAME[model_name]
+        resume_handle, entries_obj, count = model_cls._domain_enum(
+            model_cls._domain_enum_func(self.samr_handle),
+            self,
+            resume_handle,
+            size,
+        )
+        if not count:
+            return resume_handle, []
+
+        return resume_handle, [
+            (entry.idx, lsa_unwrap(entry.name))
+            for entry in entries_obj.entries
+        ]
+
+    def rid_for_name(self, model_cls, name):
+        """
+        RID of the object of the given model type with the given name, or
+        None if there isn't one
+        """
+        rid, sid_name_use = self.lookup_names([name])[0]
+        if sid_name_use != model_cls.sid_name_use:
+            return None
+
+        return rid
+
+    def sid_for_rid(self, rid):
+        """
+        Samba dom_sid object for a RID in this domain
+        """
+        return security.dom_sid('%s-%d' % (self.sid_obj, rid))
+
+    def rid_for_sid(self, sid_obj):
+        """
+        RID of a SID in this domain, or None if the SID is in another domain
+        """
+        prefix, _, rid = str(sid_obj).rpartition('-')
+        if prefix != str(self.sid_obj):
+            return None
+
+        return int(rid)
+
+    def nodes_for_rids(self, rids):
+        """
+        Membership nodes for a list of RIDs in this domain, resolving their
+        types in batches. RIDs that don't exist are skipped
+        """
+        return [
+            (sid_name_use, rid)
+            for rid, (_, sid_name_use) in zip(rids, self.lookup_rids(rids))
+            if sid_name_use is not None
+        ]
+
+    def nodes_for_sids(self, sid_objs):
+        """
+        Membership nodes for a list of SIDs. SIDs in this domain become
+        (sid_name_use, rid) nodes, and others (None, SID string) nodes
+        """
+        rids = []
+        foreign = []
+        for sid_obj in sid_objs:
+            rid = self.rid_for_sid(sid_obj)
+            if rid is None:
+                foreign.append((None, str(sid_obj)))
+            else:
+                rids.append(rid)
+
+        return self.nodes_for_rids(rids) + foreign
+
+    @remote()
+    def alias_membership(self, rids):
+        """
+        Set of RIDs of the aliases in this domain that directly contain any of
+        the given RIDs
+        """
+        alias_rids = set()
+        for batch in chunked(rids, LOOKUP_BATCH_SIZE):
+            sid_array = lsa.SidArray()
+            sid_ptrs = []
+            for rid in batch:
+                sid_ptr = lsa.SidPtr()
+                sid_ptr.sid = self.sid_for_rid(rid)
+                sid_ptrs.append(sid_ptr)
+            sid_array.sids = sid_ptrs
+            sid_array.num_sids = len(sid_ptrs)
+
+            ids_obj = self.samr_handle.connection_obj.GetAliasMembership(
+                self.policy_handle_obj, sid_array,
+            )
+            alias_rids.update(ids_obj.ids)
+
+        return alias_rids
+
+    def group_parents(self, group_rid):
+        """
+        Tuple of RIDs of the groups that directly contain the given group. The
+        first call after the domain changes indexes the members of every
+        group
+        """
+        return self.membership.memoized(
+            'group_parents', None, self._load_group_parents,
+            self.membership.sequence,
+        ).get(group_rid, ())
+
+    def _load_group_parents(self, _):
+        parents = {}
+        for group in self.groups_iter():
+            for sid_name_use, rid in group.member_nodes():
+                if sid_name_use == lsa.SID_NAME_DOM_GRP:
+                    parents.setdefault(rid, []).append(group.rid)
+
+        return {rid: tuple(group_rids) for rid, group_rids in parents.items()}
+
+    def member_nodes(self, node):
+        """
+        Nodes of the direct members of a membership node in this domain
+        """
+        model_cls = MODELS_BY_SID_NAME_USE.get(node[0])
+        if model_cls is None:
+            return ()
+
+        return model_cls(self, node[1]).member_nodes()
+
+    def objects_for_nodes(self, nodes):
+        """
+        Model objects for membership nodes in this domain, with names
+        resolved in one batch. Nodes in other domains are skipped
+        """
+        nodes = [
+            (sid_name_use, rid) for sid_name_use, rid in nodes
+            if sid_name_use in MODELS_BY_SID_NAME_USE
+        ]
+        names = self.lookup_rids([rid for _, rid in nodes])
+
+        return [
+            MODELS_BY_SID_NAME_USE[sid_name_use](self, rid, name=name)
+            for (sid_name_use, rid), (name, _) in zip(nodes, names)
+        ]
+
     @property
     def users(self):
         """
@@ -161,12 +1071,12 @@ class Domain(PolicyHandleObject):
         """
         return User.all_in_domain(self)
 
-    def users_iter(self, rid=None):
+    def users_iter(self, rid=None, limit=None):
         """
         Iterator for users associated with this domain, starting after the
-        given RID
+        given RID. The limit is a hint for sizing the first fetch
         """
-        return User.all_in_domain_iter(self, rid)
+        return User.all_in_domain_iter(self, rid, limit)
 
     @property
     def groups(self):
@@ -175,12 +1085,12 @@ class Domain(PolicyHandleObject):
         """
         return Group.all_in_domain(self)
 
-    def groups_iter(self, rid=None):
+    def groups_iter(self, rid=None, limit=None):
         """
         Iterator for groups associated with this domain, starting after the
-        given RID
+        given RID. The limit is a hint for sizing the first fetch
         """
-        return Group.all_in_domain_iter(self, rid)
+        return Group.all_in_domain_iter(self, rid, limit)
 
     @property
     def aliases(self):
@@ -189,12 +1099,160 @@ class Domain(PolicyHandleObject):
         """
         return Alias.all_in_domain(self)
 
-    def aliases_iter(self, rid=None):
+    def aliases_iter(self, rid=None, limit=None):
         """
         Iterator for aliases associated with this domain, starting after the
-        given RID
+        given RID. The limit is a hint for sizing the first fetch
+        """
+        return Alias.all_in_domain_iter(self, rid, limit)
+
+    def display_page(self, model_cls, start_idx=0, limit=20):
+        """
+        A page of domain children of a model type, with their display columns
+        (the model's display_fields), starting at an index into the server's
+        display list. Returns a list of (object, display dict) tuples, and the
+        index of the next page, or None if this is the last
+
+        Types with a QueryDisplayInfo level get the columns in bulk from the
+        server. Others are paged from the name index in RID order, and their
+        columns are prefetched from the cheapest info levels
+        """
+        self.check_sequence()
+        sequence = self.name_index.sequence
+        if model_cls.display_info_level is None:
+            rows, next_idx = self._display_page_from_index(model_cls,
+                                                           start_idx, limit)
+        else:
+            rows, next_idx = self._display_page_from_server(model_cls,
+                                                            start_idx, limit)
+
+        if self.current_shared_cache is None:
+            index = self.name_index
+            for row in rows:
+                index.add(row['rid'], row['name'], model_cls.sid_name_use,
+                          sequence)
+
+        return [
+            (model_cls(self, row['rid'], name=row['name']), row['display'])
+            for row in rows
+        ], next_idx
+
+    def _display_page_from_server(self, model_cls, start_idx, limit):
+        rows = []
+        while len(rows) < limit:
+            batch = self._query_display(model_cls.display_info_level,
+                                        start_idx + len(rows),
+                                        limit - len(rows))
+            if not batch:
+                return rows, None
+
+            rows.extend(batch)
+
+        return rows, start_idx + len(rows)
+
+    def _display_page_from_index(self, model_cls, start_idx, limit):
+        shared = self.current_shared_cache
+        if shared is not None:
+            entries = shared.page(model_cls.sid_name_use, 'rid',
+                                  limit=limit, offset=start_idx)
+            total = shared.count(model_cls.sid_name_use)
+        else:
+            index = self.name_index
+            if not index.is_complete(model_cls.sid_name_use):
+                self.fill_names(model_cls)
+
+            _, entries = index.sorted_entries(model_cls.sid_name_use, 'rid')
+            total = len(entries)
+            entries = entries[start_idx:start_idx + limit]
+
+        objects = [model_cls(self, rid, name=name) for rid, name in entries]
+        self.prefetch_attrs(objects, model_cls.display_fields)
+
+        rows = []
+        for obj in objects:
+            attrs = obj.attrs_for(model_cls.display_fields)
+            rows.append({
+                'rid': obj.rid,
+                'name': obj.name,
+                'display': {
+                    field_name: lsa_unwrap(attrs.get(field_name))
+                    for field_name in model_cls.display_fields
+                },
+            })
+
+        next_idx = start_idx + len(rows)
+        if next_idx >= total:
+            next_idx = None
+
+        return rows, next_idx
+
+    @remote()
+    def _query_display(self, level, start_idx, max_entries):
+        """
+        Query the server for a batch of display list rows at a
+        QueryDisplayInfo level
+        """
+        _, _, info_obj = self.samr_handle.connection_obj.QueryDisplayInfo(
+            self.policy_handle_obj, level, start_idx, max_entries,
+            max_entries * DISPLAY_ENTRY_SIZE,
+        )
+        return [
+            {
+                'rid': entry.rid,
+                'name': lsa_unwrap(entry.account_name),
+                'display': {
+                    field_name: lsa_unwrap(getattr(entry, field_name))
+                    for field_name in DISPLAY_ENTRY_FIELDS
+                    if hasattr(entry, field_name)
+                },
+            }
+            for entry in info_obj.entries[:info_obj.count]
+        ]
+
+    def sorted_page(self, model_cls, sort='rid', after=None, prefix=None,
+                    limit=20):
+        """
+        A page of domain children of a model type, in 'rid' or 'name' order,
+        starting after the given sort key, and optionally only those with
+        names starting with prefix. Pages are served from the sorted views of
+        the name index, which is filled by a full enumeration of the type the
+        first time it's needed after the domain changes, or from the shared
+        directory cache
         """
-        return Alias.all_in_domain_iter(self, rid)
+        self.check_sequence()
+        shared = self.current_shared_cache
+        if shared is not None:
+            return [
+                model_cls(self, rid, name=name)
+                for rid, name in shared.page(model_cls.sid_name_use, sort,
+                                             after, prefix, limit)
+            ]
+
+        index = self.name_index
+        if not index.is_complete(model_cls.sid_name_use):
+            self.fill_names(model_cls)
+
+        keys, entries = index.sorted_entries(
+            model_cls.sid_name_use, 'name' if prefix else sort,
+        )
+        start, end = 0, len(entries)
+        if prefix:
+            # Names with the prefix are a contiguous range in name order
+            prefix = prefix.lower()
+            start = bisect_left(keys, (prefix,))
+            end = bisect_left(keys, (prefix + u'\uffff',), start)
+            if sort != 'name':
+                entries = sorted(entries[start:end])
+                keys = [rid for rid, _ in entries]
+                start, end = 0, len(entries)
+
+        if after is not None:
+            start = bisect_right(keys, after, start, end)
+
+        return [
+            model_cls(self, rid, name=name)
+            for rid, name in entries[start:min(end, start + limit)]
+        ]
 
     def __repr__(self):
         return self.__unicode__()
@@ -204,14 +1262,27 @@ class Domain(PolicyHandleObject):
 
 class DomainChild(PolicyHandleObject):
     """
-    Base class for domain children
+    Base class for domain children. Many are made for each list page, so
+    they're slotted views of a RID and name, until their attrs are loaded
     """
+    __slots__ = ('_domain', '_rid', '_name', '_attrs', '_policy_handle_obj')
     name_attr = 'name'
+    sid_name_use = None
+    # QueryDisplayInfo level for listing this type with display columns, or
+    # None to load display_fields from info levels instead
+    display_info_level = None
+    display_fields = ('description',)
+    # Attr name -> tuple of the info level that sets it, the samr info struct
+    # for the level (or None for levels set with a bare string), and the
+    # types of value it accepts
+    settable_fields = {}
 
     def __init__(self, domain, rid, name=None):
         self._domain = domain
         self._rid = rid
         self._name = name
+        self._attrs = None
+        self._policy_handle_obj = None
 
     @classmethod
     def plural_name(cls):
@@ -226,10 +1297,18 @@ class DomainChild(PolicyHandleObject):
 
     @property
     def name(self):
-        if self._name and not self.loaded:
+        if self.loaded:
+            return self.attrs[self.name_attr]
+        if self._name:
             return self._name
 
-        return self.attrs[self.name_attr]
+        entry = self.domain.name_index.by_rid(self.rid)
+        if entry is None and self.domain.current_shared_cache is not None:
+            entry = self.domain.current_shared_cache.by_rid(self.rid)
+        if entry is not None and entry[1] == self.sid_name_use:
+            return entry[0]
+
+        return self.attrs_for((self.name_attr,))[self.name_attr]
 
     @property
     def rid(self):
@@ -238,15 +1317,337 @@ class DomainChild(PolicyHandleObject):
         """
         return self._rid
 
+    @property
+    def cached(self):
+        """
+        Whether this object's attrs can be loaded without querying the server
+        """
+        return self.cached_for()
+
+    def attrs_for(self, field_names=None):
+        """
+        Cached attrs for all levels are used in preference to querying
+        narrower levels
+        """
+        if self.cached:
+            return self.attrs
+
+        return super(DomainChild, self).attrs_for(field_names)
+
+    def cached_for(self, field_names=None):
+        """
+        Whether the attrs needed for the given attr names can be loaded
+        without querying the server
+        """
+        if self.loaded:
+            return True
+
+        shared = self.domain.current_shared_cache
+        if shared is not None and \
+                shared.has_attrs(self.__class__.__name__, self.rid):
+            return True
+
+        return all(
+            self._attr_cache_key(level) in self.domain.attr_cache
+            for level in self.levels_for_fields(field_names)
+        )
+
+    @property
+    def known_missing(self):
+        """
+        Whether the domain name index knows that this object doesn't exist
+        """
+        self.domain.check_sequence()
+        shared = self.domain.current_shared_cache
+        if shared is not None:
+            # Every user, group and alias is in the shared cache
+            entry = shared.by_rid(self.rid)
+            return entry is None or entry[1] != self.sid_name_use
+
+        return self.domain.name_index.rid_missing(self.rid, self.sid_name_use)
+
     @property
     def samr_handle(self):
         return self.domain.samr_handle
     @property
+    def rpc_broker(self):
+        return self.domain.rpc_broker
+    @property
+    def remote_ref(self):
+        return (self.domain.remote_ref[0], self.__class__.__name__, self.rid)
+    @property
     def parent_handle(self):
         return self.domain.policy_handle_obj
     @property
     def canonical_id(self):
         return self.rid
+    @property
+    def handle_cache_key(self):
+        return (self.__class__.__name__, self.rid)
+    @property
+    def handle_cache(self):
+        return self.samr_handle.handle_cache_for(str(self.domain.sid_obj))
+
+    @property
+    def node(self):
+        """
+        Membership node for this object
+        """
+        return (self.sid_name_use, self.rid)
+
+    @property
+    def sid_obj(self):
+        """
+        Samba dom_sid object
+        """
+        return self.domain.sid_for_rid(self.rid)
+
+    def containers(self, effective=False):
+        """
+        Groups and aliases that this object belongs to. If effective, this
+        includes those it belongs to through nested membership
+        """
+        self.domain.check_sequence()
+        membership = self.domain.membership
+        if effective:
+            nodes = membership.memoized(
+                'effective_containers', self.node,
+                lambda _: self._effective_container_nodes(),
+                membership.sequence,
+            )
+        else:
+            nodes = membership.adjacent(
+                'containers', self.node,
+                lambda _: self._direct_container_nodes(),
+                membership.sequence,
+            )
+
+        return self.domain.objects_for_nodes(sorted(nodes))
+
+    def _direct_container_nodes(self):
+        """
+        Nodes of the groups and aliases that directly contain this object
+        """
+        nodes = [
+            (lsa.SID_NAME_DOM_GRP, rid)
+            for rid in self._direct_group_rids()
+        ]
+        nodes.extend(
+            (lsa.SID_NAME_ALIAS, rid)
+            for rid in self.domain.alias_membership([self.rid])
+        )
+        return nodes
+
+    def _direct_group_rids(self):
+        """
+        RIDs of the groups that directly contain this object
+        """
+        return ()
+
+    def _effective_container_nodes(self):
+        """
+        Nodes of all groups and aliases that contain this object. Groups are
+        expanded through the domain's group nesting index, then aliases are
+        expanded from the object and all of its groups together, one batch
+        per level of nesting
+        """
+        domain = self.domain
+        group_rids = domain.membership.closure(
+            'group_parents', self.node,
+            lambda node: (
+                self._direct_group_rids() if node == self.node
+                else domain.group_parents(node)
+            ),
+            domain.membership.sequence,
+        )
+
+        alias_rids = set()
+        frontier = set(group_rids) | set([self.rid])
+        while frontier:
+            found = domain.alias_membership(frontier) - alias_rids
+            alias_rids.update(found)
+            frontier = found
+
+        return frozenset(
+            [(lsa.SID_NAME_DOM_GRP, rid) for rid in group_rids] +
+            [(lsa.SID_NAME_ALIAS, rid) for rid in alias_rids]
+        )
+
+    def member_nodes(self):
+        """
+        Nodes of the direct members of this object
+        """
+        self.domain.check_sequence()
+        membership = self.domain.membership
+        return membership.adjacent(
+            'members', self.node,
+            lambda _: self._direct_member_nodes(),
+            membership.sequence,
+        )
+
+    def _direct_member_nodes(self):
+        """
+        Query the server for the nodes of the direct members of this object
+        """
+        return ()
+
+    def _member_nodes(self, effective):
+        if not effective:
+            return self.member_nodes()
+
+        membership = self.domain.membership
+        return membership.closure(
+            'members', self.node, self.domain.member_nodes,
+            membership.sequence,
+        )
+
+    def members(self, effective=False):
+        """
+        Members of this object in its domain. If effective, this includes
+        members of nested groups and aliases
+        """
+        return self.domain.objects_for_nodes(
+            sorted(self._member_nodes(effective))
+        )
+
+    def member_sids(self, effective=False):
+        """
+        SID strings of the members of this object in other domains
+        """
+        return sorted(
+            sid for sid_name_use, sid in self._member_nodes(effective)
+            if sid_name_use is None
+        )
+
+    def set_attrs(self, values):
+        """
+        Set attrs on the server, one call per attr, applying each to the
+        cached attrs in place once it's set. Raises ValueError for attrs that
+        can't be set, or values of the wrong type
+        """
+        writes = []
+        for attr_name, value in sorted(values.items()):
+            entry = self.settable_fields.get(attr_name)
+            if entry is None:
+                raise ValueError("%s %s can't be set" % (
+                    self.__class__.__name__, attr_name,
+                ))
+
+            level, struct_name, value_types = entry
+            if not isinstance(value, value_types):
+                raise ValueError("Invalid value for %s" % attr_name)
+
+            writes.append((level, struct_name, attr_name, value))
+
+        for level, struct_name, attr_name, value in writes:
+            self._set_level(level, struct_name, attr_name, value)
+            self.domain.record_write()
+            self._attrs_written({attr_name: value})
+
+    @remote()
+    def _set_level(self, request_level, struct_name, attr_name, value):
+        """
+        Set a single attr at an information class level on the server
+        """
+        if struct_name is None:
+            info_obj = lsa_wrap(value)
+        else:
+            info_obj = getattr(samr, struct_name)()
+            setattr(info_obj, attr_name, lsa_wrap(value))
+
+        getattr(
+            self.samr_handle.connection_obj,
+            'Set%sInfo' % self.__class__.__name__,
+        )(
+            self.policy_handle_obj,
+            request_level,
+            info_obj,
+        )
+
+    def _attrs_written(self, values):
+        """
+        Apply attrs just written to the server to the cached attrs, and the
+        name index if the name changed
+        """
+        domain = self.domain
+        sequence = domain.attr_cache.sequence
+        written = frozenset(values)
+        for level, fields in self.info_level_fields:
+            if fields & written:
+                domain.attr_cache.update(self._attr_cache_key(level), values,
+                                         sequence)
+
+        if self._attrs is not None:
+            self._attrs.update(
+                (attr_name, value) for attr_name, value in values.items()
+                if attr_name in self._attrs
+            )
+
+        if self.name_attr in values:
+            self._name = values[self.name_attr]
+            domain.name_index.add(self.rid, self._name, self.sid_name_use,
+                                  domain.name_index.sequence)
+
+    def discard_cached_levels(self, field_names):
+        """
+        Drop the cached attrs of the information class levels that include
+        any of the given attrs
+        """
+        field_names = frozenset(field_names)
+        for level, fields in self.info_level_fields:
+            if fields & field_names:
+                self.domain.attr_cache.discard(self._attr_cache_key(level))
+
+        self._attrs = None
+
+    def _member_added(self, member_node):
+        """
+        Apply a new direct member to the membership index and cached attrs
+        """
+        membership = self.domain.membership
+        sequence = membership.sequence
+        membership.add_adjacent('members', self.node, member_node, sequence)
+        membership.add_adjacent('containers', member_node, self.node,
+                                sequence)
+        self.discard_cached_levels(('num_members',))
+
+    def _attr_cache_key(self, request_level):
+        """
+        Key for the attrs of an information class level in the domain attr
+        cache
+        """
+        return (self.__class__.__name__, self.rid, request_level)
+
+    def _query_level(self, request_level):
+        """
+        Attrs for an information class level are shared through the domain
+        attr cache, until the domain sequence number changes. Concurrent
+        queries for the same level share one call
+        """
+        self.domain.check_sequence()
+
+        cache = self.domain.attr_cache
+        sequence = cache.sequence
+        key = self._attr_cache_key(request_level)
+
+        attrs = cache.get(key)
+        if attrs is None:
+            shared = self.domain.current_shared_cache
+            if shared is not None:
+                # Attrs of all levels, read without keeping a copy
+                attrs = shared.attrs(self.__class__.__name__, self.rid)
+                if attrs is not None:
+                    return attrs
+
+            attrs = self.domain.single_flight.do(
+                'Query%sInfo' % self.__class__.__name__,
+                key + (sequence,),
+                functools.partial(super(DomainChild, self)._query_level,
+                                  request_level),
+            )
+            cache.set(key, attrs, sequence)
+
+        return attrs
 
     @classmethod
     def _domain_enum(cls, enum_func, domain, resume_handle=0, size=-1):
@@ -269,39 +1670,65 @@ class DomainChild(PolicyHandleObject):
         """
         Gets all objects of this type in the given domain
         """
-        # EnumDomain{X} returns (resume handle, array obj, count)
-        sam_array = cls._domain_enum(
-            cls._domain_enum_func(domain.samr_handle), domain,
-        )[1]
-
-        return [
-            cls(domain, entry.idx, name=lsa_unwrap(entry.name))
-            for entry in sam_array.entries
-        ]
+        return list(cls.all_in_domain_iter(domain))
 
     @classmethod
-    def all_in_domain_iter(cls, domain, resume_handle=None):
+    def all_in_domain_iter(cls, domain, resume_handle=None, limit=None):
         """
         Gets objects after the given RID (resume_handle) of this type in the
         given domain, as an iterator
+
+        Entries are fetched from the server in batches and buffered locally.
+        The first batch is sized to the limit (if given), and later batches
+        grow or shrink depending on how long each round trip took. Entries are
+        added to the domain name index as they're seen
         """
+        domain.check_sequence()
+        index = domain.name_index
+        sequence = index.sequence
+        complete = not resume_handle
+
+        if limit:
+            batch_size = max(1, min(ENUM_BATCH_MAX, limit))
+        else:
+            batch_size = ENUM_BATCH_DEFAULT
+
+        shared = domain.current_shared_cache
+        if shared is not None:
+            # Paged from the shared cache, rather than copied into the name
+            # index
+            after = resume_handle or 0
+            while True:
+                entries = shared.page(cls.sid_name_use, 'rid', after, None,
+                                      batch_size)
+                for rid, name in entries:
+                    yield cls(domain, rid, name=name)
+
+                if len(entries) < batch_size:
+                    return
+                after = entries[-1][0]
+                batch_size = ENUM_BATCH_MAX
+
         while resume_handle or resume_handle is None:
             # First iter default arg
             if resume_handle is None:
                 resume_handle = 0
 
-            resume_handle, entries_obj, count = cls._domain_enum(
-                cls._domain_enum_func(domain.samr_handle),
-                domain,
-                resume_handle,
-                1,
+            start = time.time()
+            resume_handle, entries = domain.enum_batch(
+                cls.__name__, resume_handle, enum_size(batch_size),
             )
+            batch_size = next_batch_size(batch_size, time.time() - start)
+
+            if not entries:
+                break
 
-            assert count <= 1, "No more than 1 object retrieved"
+            for rid, name in entries:
+                index.add(rid, name, cls.sid_name_use, sequence)
+                yield cls(domain, rid, name=name)
 
-            if count == 1:
-                entry = entries_obj.entries.pop()
-                yield cls(domain, entry.idx, name=lsa_unwrap(entry.name))
+        if complete:
+            index.mark_complete(cls.sid_name_use, sequence)
 
     def __repr__(self):
         return self.__unicode__()
@@ -315,28 +1742,202 @@ class User(DomainChild):
     """
     A Samba domain user
     """
+    __slots__ = ()
     all_info_class_level = UserAllInformation
+    info_level_fields = (
+        (UserGeneralInformation, frozenset((
+            'account_name', 'full_name', 'primary_gid', 'description',
+            'comment',
+        ))),
+        (UserPreferencesInformation, frozenset((
+            'comment', 'reserved', 'country_code', 'code_page',
+        ))),
+        (UserLogonInformation, frozenset((
+            'account_name', 'full_name', 'rid', 'primary_gid',
+            'home_directory', 'home_drive', 'logon_script', 'profile_path',
+            'workstations', 'last_logon', 'last_logoff',
+            'last_password_change', 'allow_password_change',
+            'force_password_change', 'logon_hours', 'bad_password_count',
+            'logon_count', 'acct_flags',
+        ))),
+        (UserLogonHoursInformation, frozenset(('logon_hours',))),
+        (UserAccountInformation, frozenset((
+            'account_name', 'full_name', 'rid', 'primary_gid',
+            'home_directory', 'home_drive', 'logon_script', 'profile_path',
+            'description', 'workstations', 'last_logon', 'last_logoff',
+            'logon_hours', 'bad_password_count', 'logon_count',
+            'last_password_change', 'acct_expiry', 'acct_flags',
+        ))),
+        (UserNameInformation, frozenset(('account_name', 'full_name'))),
+        (UserAccountNameInformation, frozenset(('account_name',))),
+        (UserFullNameInformation, frozenset(('full_name',))),
+        (UserPrimaryGroupInformation, frozenset(('primary_gid',))),
+        (UserHomeInformation, frozenset(('home_directory', 'home_drive'))),
+        (UserScriptInformation, frozenset(('logon_script',))),
+        (UserProfileInformation, frozenset(('profile_path',))),
+        (UserAdminCommentInformation, frozenset(('description',))),
+        (UserWorkStationsInformation, frozenset(('workstations',))),
+        (UserControlInformation, frozenset(('acct_flags',))),
+        (UserExpiresInformation, frozenset(('acct_expiry',))),
+        (UserParametersInformation, frozenset(('parameters',))),
+        (UserAllInformation, frozenset((
+            'last_logon', 'last_logoff', 'last_password_change',
+            'acct_expiry', 'allow_password_change', 'force_password_change',
+            'account_name', 'full_name', 'home_directory', 'home_drive',
+            'logon_script', 'profile_path', 'description', 'workstations',
+            'comment', 'parameters', 'lm_owf_password', 'nt_owf_password',
+            'private_data', 'buf_count', 'buffer', 'rid', 'primary_gid',
+            'acct_flags', 'fields_present', 'logon_hours',
+            'bad_password_count', 'logon_count', 'country_code', 'code_page',
+            'lm_password_set', 'nt_password_set', 'password_expired',
+            'private_data_sensitive',
+        ))),
+    )
     name_attr = 'account_name'
+    sid_name_use = lsa.SID_NAME_USER
+    display_info_level = 1
+    display_fields = ('full_name', 'description', 'acct_flags')
+    settable_fields = {
+        'account_name': (UserAccountNameInformation, 'UserInfo7', basestring),
+        'full_name': (UserFullNameInformation, 'UserInfo8', basestring),
+        'primary_gid': (UserPrimaryGroupInformation, 'UserInfo9', INT_TYPES),
+        'logon_script': (UserScriptInformation, 'UserInfo11', basestring),
+        'profile_path': (UserProfileInformation, 'UserInfo12', basestring),
+        'description': (UserAdminCommentInformation, 'UserInfo13',
+                        basestring),
+        'workstations': (UserWorkStationsInformation, 'UserInfo14',
+                         basestring),
+        'acct_flags': (UserControlInformation, 'UserInfo16', INT_TYPES),
+        'acct_expiry': (UserExpiresInformation, 'UserInfo17', INT_TYPES),
+    }
 
     @classmethod
     def _domain_enum(cls, enum_func, domain, resume_handle=0, size=-1):
         # user takes an additional arg
         return enum_func(domain.policy_handle_obj, resume_handle, 0, size)
 
+    def _attrs_written(self, values):
+        super(User, self)._attrs_written(values)
+        if 'primary_gid' in values:
+            # Both the old and new primary groups' members change
+            self.domain.membership.clear()
+
+    @remote()
+    def _direct_group_rids(self):
+        rids_obj = self.samr_handle.connection_obj.GetGroupsForUser(
+            self.policy_handle_obj,
+        )
+        return [rid_obj.rid for rid_obj in rids_obj.rids]
+
 
 class Group(DomainChild):
     """
     A Samba domain group
     """
+    __slots__ = ()
     all_info_class_level = GROUPINFOALL
+    info_level_fields = (
+        (GROUPINFOALL, frozenset((
+            'name', 'attributes', 'num_members', 'description',
+        ))),
+        (GROUPINFONAME, frozenset(('name',))),
+        (GROUPINFOATTRIBUTES, frozenset(('attributes',))),
+        (GROUPINFODESCRIPTION, frozenset(('description',))),
+    )
+    string_info_levels = {
+        GROUPINFONAME: 'name',
+        GROUPINFODESCRIPTION: 'description',
+    }
+    sid_name_use = lsa.SID_NAME_DOM_GRP
+    display_info_level = 3
+    display_fields = ('description', 'acct_flags')
+    settable_fields = {
+        'name': (GROUPINFONAME, None, basestring),
+        'description': (GROUPINFODESCRIPTION, None, basestring),
+        'attributes': (GROUPINFOATTRIBUTES, 'GroupInfoAttributes', INT_TYPES),
+    }
+
+    def _direct_group_rids(self):
+        return self.domain.group_parents(self.rid)
+
+    def add_member(self, rid):
+        """
+        Add a user or group in this domain to this group
+        """
+        self._add_member(rid)
+        self.domain.record_write()
+        for member_node in self.domain.nodes_for_rids([rid]):
+            self._member_added(member_node)
+
+    @remote()
+    def _add_member(self, rid):
+        self.samr_handle.connection_obj.AddGroupMember(
+            self.policy_handle_obj, rid, GROUP_MEMBER_ATTRIBUTES,
+        )
+
+    @remote()
+    def _direct_member_nodes(self):
+        rids_obj = self.samr_handle.connection_obj.QueryGroupMember(
+            self.policy_handle_obj,
+        )
+        return self.domain.nodes_for_rids(list(rids_obj.rids))
 
 
 class Alias(DomainChild):
     """
     A Samba domain alias
     """
+    __slots__ = ()
     all_info_class_level = ALIASINFOALL
+    info_level_fields = (
+        (ALIASINFOALL, frozenset(('name', 'num_members', 'description'))),
+        (ALIASINFONAME, frozenset(('name',))),
+        (ALIASINFODESCRIPTION, frozenset(('description',))),
+    )
+    string_info_levels = {
+        ALIASINFONAME: 'name',
+        ALIASINFODESCRIPTION: 'description',
+    }
+    sid_name_use = lsa.SID_NAME_ALIAS
+    settable_fields = {
+        'name': (ALIASINFONAME, None, basestring),
+        'description': (ALIASINFODESCRIPTION, None, basestring),
+    }
+
+    def add_member(self, sid_obj):
+        """
+        Add a SID, in this domain or another, to this alias
+        """
+        self._add_member(str(sid_obj))
+        self.domain.record_write()
+        for member_node in self.domain.nodes_for_sids([sid_obj]):
+            self._member_added(member_node)
+
+    @remote()
+    def _add_member(self, sid):
+        self.samr_handle.connection_obj.AddAliasMember(
+            self.policy_handle_obj, security.dom_sid(sid),
+        )
+
+    @remote()
+    def _direct_member_nodes(self):
+        sids_obj = self.samr_handle.connection_obj.GetMembersInAlias(
+            self.policy_handle_obj,
+        )
+        return self.domain.nodes_for_sids(
+            [sid_ptr.sid for sid_ptr in sids_obj.sids]
+        )
 
     @classmethod
     def plural_name(cls):
         return "Aliases"
+
+
+MODELS_BY_SID_NAME_USE = {
+    model_cls.sid_name_use: model_cls
+    for model_cls in (User, Group, Alias)
+}
+MODELS_BY_NAME = {
+    model_cls.__name__: model_cls
+    for model_cls in (User, Group, Alias)
+}
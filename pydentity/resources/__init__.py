@@ -1,3 +1,10 @@
 from pydentity.resources import aliases
+from pydentity.resources import batch
+from pydentity.resources import changes
+from pydentity.resources import domains
+from pydentity.resources import export
 from pydentity.resources import groups
+from pydentity.resources import membership
+from pydentity.resources import resolve
+from pydentity.resources import tokens
 from pydentity.resources import users
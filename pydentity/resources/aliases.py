@@ -6,8 +6,10 @@ from pydentity.resources.base import (
 from pydentity.server import APP
 
 class AliasListResource(PaginatedPolicyHandleObjectListResource):
-    def objects_iter(self, rid):
-        return APP.domain_model.aliases_iter(rid)
+    model_cls = Alias
+
+    def objects_iter(self, rid, limit=None):
+        return APP.domain_model.aliases_iter(rid, limit)
 
 class AliasResource(PolicyHandleObjectResource):
     def get_object(self, object_rid):
@@ -1,18 +1,198 @@
+import base64
+import calendar
+import hashlib
+import json
+
+from contextlib import contextmanager
 from itertools import islice
 
-from flask import url_for
-from flask.ext.restful import fields, marshal, Resource, reqparse
+from flask import request, url_for
+from flask.ext.restful import abort, fields, marshal, Resource, reqparse
+from werkzeug.http import http_date
 
 from pydentity.resources import fields as my_fields
-from pydentity.util import SIMPLE_PRINTABLE_TYPES
+from pydentity.samba_util import MAX_RID, ntstatus, NT_STATUS_NO_SUCH_OBJECT
+from pydentity.server import APP
+from pydentity.util import SIMPLE_PRINTABLE_TYPES, nttime_to_timestamp
+
+def positive_int(value):
+    """
+    Request argument type for integers of at least 1
+    """
+    value = int(value)
+    if value < 1:
+        raise ValueError("Must be at least 1")
+
+    return value
 
 PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER = reqparse.RequestParser()
 PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.add_argument(
     "rid", type=int, default=None, help="RID to start page after")
 PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.add_argument(
-    "limit", type=int, default=20, help="Limit objects returned")
+    "limit", type=positive_int, default=20,
+    help="Limit objects returned, at least 1")
+PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.add_argument(
+    "expand", type=str, default=None,
+    help="Set to 'attrs' to include the attrs of each object, or 'display' "
+         "to include display columns, paged by index")
+PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.add_argument(
+    "fields", type=str, default=None,
+    help="Comma separated attr names to include when expanding attrs")
+PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.add_argument(
+    "sort", type=str, default='rid', help="Order by 'rid' or 'name'")
+PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.add_argument(
+    "q", type=unicode, default=None,
+    help="Only include objects with names starting with this")
+PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.add_argument(
+    "cursor", type=str, default=None,
+    help="Cursor from the next link of the previous page")
+PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.add_argument(
+    "index", type=int, default=0,
+    help="Display list index to start the page at, with expand=display")
+
+SORT_ORDERS = ('rid', 'name')
+
+POLICY_HANDLE_OBJECT_PARSER = reqparse.RequestParser()
+POLICY_HANDLE_OBJECT_PARSER.add_argument(
+    "fields", type=str, default=None,
+    help="Comma separated attr names to include")
+
+def field_names_arg(value):
+    """
+    Parse a comma separated list of field names into a set, or None
+    """
+    if not value:
+        return None
+
+    return set(name.strip() for name in value.split(',') if name.strip())
+
+def printable_attrs(obj, field_names=None):
+    """
+    The attrs of obj that can be output as simple values, optionally limited
+    to the given set of names
+    """
+    attrs = obj.attrs_for(field_names)
+    schema = obj.schema_for_fields(field_names)
+    if schema is not None:
+        return schema.printable(attrs, field_names)
+
+    return {
+        attr_name: value
+        for attr_name, value in attrs.items()
+        if isinstance(value, SIMPLE_PRINTABLE_TYPES)
+        and (field_names is None or attr_name in field_names)
+    }
+
+def is_rid(value):
+    """
+    Whether a value decoded from JSON is a RID
+    """
+    return isinstance(value, (int, long)) and not isinstance(value, bool) \
+        and 0 <= value <= MAX_RID
+
+@contextmanager
+def missing_as_404(obj):
+    """
+    Context manager turning the server's error for an object that doesn't
+    exist into a 404, and recording the RID as missing in the name index
+    """
+    try:
+        yield
+    except RuntimeError as ex:
+        if ntstatus(ex) not in NT_STATUS_NO_SUCH_OBJECT:
+            raise
+
+        obj.domain.name_index.add_missing_rid(obj.rid)
+        abort(404, message="%s %d doesn't exist" % (
+            obj.__class__.__name__, obj.rid,
+        ))
+
+def encode_cursor(sort, prefix, after):
+    """
+    Opaque cursor for the page after the given sort key
+    """
+    return base64.urlsafe_b64encode(json.dumps([sort, prefix, after]))
+
+def decode_cursor(value):
+    """
+    Tuple of (sort, prefix, after) from a cursor, aborting the request if
+    it's not valid
+    """
+    try:
+        sort, prefix, after = json.loads(base64.urlsafe_b64decode(value))
+    except (TypeError, ValueError):
+        abort(400, message="Invalid cursor")
+
+    if sort not in SORT_ORDERS:
+        abort(400, message="Invalid cursor")
+    if prefix is not None and not isinstance(prefix, basestring):
+        abort(400, message="Invalid cursor")
+
+    if sort == 'name':
+        if not isinstance(after, list) or len(after) != 2 or \
+                not isinstance(after[0], basestring) or \
+                not is_rid(after[1]):
+            abort(400, message="Invalid cursor")
+        after = tuple(after)
+    elif not is_rid(after):
+        abort(400, message="Invalid cursor")
+
+    return sort, prefix, after
+
+def make_etag(*parts):
+    """
+    Strong ETag value from the repr of some parts
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def domain_validators(*parts):
+    """
+    Tuple of an ETag and last modified timestamp for a response that depends
+    only on the state of the domain, and the given parts
+    """
+    domain = APP.domain_model
+    etag = make_etag(
+        str(domain.sid_obj),
+        domain.sequence_num,
+        request.endpoint,
+        sorted(request.args.items(multi=True)),
+        *parts
+    )
+    return etag, domain.modified_time
+
+def validator_headers(etag, last_modified):
+    """
+    Response headers for the given validators
+    """
+    headers = {'ETag': '"%s"' % etag}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    return headers
+
+def not_modified(etag, last_modified):
+    """
+    Whether the request's conditional headers match the given validators. An
+    If-None-Match header takes precedence over If-Modified-Since
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if request.if_modified_since and last_modified is not None:
+        return int(last_modified) <= http_timestamp(request.if_modified_since)
+
+    return False
+
+def http_timestamp(value):
+    """
+    Unix timestamp of a naive UTC datetime parsed from an HTTP header
+    """
+    return calendar.timegm(value.utctimetuple())
 
 class PaginatedPolicyHandleObjectListResource(Resource):
+    # Model class of the objects, for pages served from the name index
+    model_cls = None
+
     @property
     def detail_endpoint(self):
         """
@@ -47,9 +227,10 @@ class PaginatedPolicyHandleObjectListResource(Resource):
             'objects': fields.List(fields.Nested(self.objects_fields)),
         }
 
-    def objects_iter(self, rid):
+    def objects_iter(self, rid, limit=None):
         """
-        Get an iterator for the objects in this resource, starting after RID
+        Get an iterator for the objects in this resource, starting after RID.
+        The limit is only a hint; the iterator may yield more objects
         """
         return []
 
@@ -58,31 +239,127 @@ class PaginatedPolicyHandleObjectListResource(Resource):
         Get the objects for this resource, starting after RID, and obeying the
         limit parameter
         """
-        return islice(self.objects_iter(rid), 0, limit)
+        return islice(self.objects_iter(rid, limit), 0, limit)
+
+    def sorted_objects(self, sort, after, prefix, limit):
+        """
+        Get a page of objects for this resource from the domain's sorted name
+        index
+        """
+        return APP.domain_model.sorted_page(
+            self.model_cls, sort, after, prefix, limit,
+        )
+
+    def object_data(self, obj, expand=False, field_names=None):
+        """
+        Data for a single object in the list
+        """
+        data = {
+            'rid': obj.rid,
+            'name': obj.name,
+            'detail': url_for(self.detail_endpoint, object_rid=obj.rid),
+        }
+        if expand:
+            data['attrs'] = printable_attrs(obj, field_names)
+
+        return data
 
     def get(self, **kwargs):
         args = PAGINATED_POLICY_HANDLE_OBJECT_LIST_PARSER.parse_args()
+        expand = args['expand'] == 'attrs'
+        field_names = field_names_arg(args['fields'])
+
+        etag, last_modified = domain_validators()
+        headers = validator_headers(etag, last_modified)
+        if not_modified(etag, last_modified):
+            return '', 304, headers
+
+        if args['expand'] == 'display':
+            return self.display_list(args['index'], args['limit']), 200, headers
+
+        sort, prefix, after = args['sort'], args['q'], args['rid']
+        if args['cursor']:
+            sort, prefix, after = decode_cursor(args['cursor'])
+        if sort not in SORT_ORDERS:
+            abort(400, message="Sort must be one of: %s" %
+                  ', '.join(SORT_ORDERS))
+
+        # Name order and prefix searches need the sorted index. RID order
+        # uses it too once it's complete, instead of enumerating from the
+        # server
+        keyset = bool(args['cursor'] or sort != 'rid' or prefix)
+        if self.model_cls is not None and (
+                keyset or APP.domain_model.names_complete(
+                    self.model_cls.sid_name_use)):
+            objects = self.sorted_objects(sort, after, prefix, args['limit'])
+        elif keyset:
+            abort(400, message="Sorting and searching aren't supported here")
+        else:
+            objects = list(self.objects(args['rid'], args['limit']))
+        if expand:
+            # Load all attrs for the page in one pass, rather than one object
+            # at a time while building the data
+            APP.domain_model.prefetch_attrs(objects, field_names)
 
         data = {'objects': [
-            {
-                'rid': obj.rid,
-                'name': obj.name,
-                'detail': url_for(self.detail_endpoint, object_rid=obj.rid),
-            }
-            for obj in self.objects(args['rid'], args['limit'])
+            self.object_data(obj, expand, field_names)
+            for obj in objects
         ]}
 
         if len(data['objects']) == args['limit']:
-            data['next'] = {'rid': data['objects'][-1].rid,
-                            'limit': args['limit'],
+            last = objects[-1]
+            if keyset:
+                if sort == 'name':
+                    last_key = (last.name.lower(), last.rid)
+                else:
+                    last_key = last.rid
+                data['next'] = {
+                    'cursor': encode_cursor(sort, prefix, last_key),
+                    'limit': args['limit'],
+                }
+            else:
+                data['next'] = {'rid': last.rid,
+                                'limit': args['limit'],
+                                }
+
+        list_fields = self.list_fields
+        if expand:
+            objects_fields = dict(self.objects_fields, attrs=fields.Raw)
+            list_fields['objects'] = fields.List(
+                fields.Nested(objects_fields)
+            )
+
+        return marshal(data, list_fields), 200, headers
+
+    def display_list(self, start_idx, limit):
+        """
+        Marshalled page of objects with their display columns, from the
+        domain display list
+        """
+        if self.model_cls is None:
+            abort(400, message="Display columns aren't supported here")
+
+        page, next_idx = APP.domain_model.display_page(
+            self.model_cls, start_idx, limit,
+        )
+
+        data = {'objects': []}
+        for obj, display in page:
+            obj_data = self.object_data(obj)
+            obj_data['display'] = display
+            data['objects'].append(obj_data)
+
+        if next_idx is not None:
+            data['next'] = {'index': next_idx,
+                            'limit': limit,
+                            'expand': 'display',
                             }
 
-        import logging;
-        logging.info(self.list_fields)
-        logging.info(self.list_fields['objects'].__dict__)
-        logging.info(self.list_fields['objects'].container.__dict__)
-        logging.info(data)
-        return marshal(data, self.list_fields)
+        list_fields = self.list_fields
+        list_fields['objects'] = fields.List(fields.Nested(
+            dict(self.objects_fields, display=fields.Raw)
+        ))
+        return marshal(data, list_fields)
 
 
 class PolicyHandleObjectResource(Resource):
@@ -103,23 +380,107 @@ class PolicyHandleObjectResource(Resource):
         """
         return {}
 
+    def object_validators(self, obj, field_names=None):
+        """
+        Tuple of an ETag and last modified timestamp for the object itself,
+        rather than the whole domain. The ETag is a hash of the object's
+        printable attrs, and the last modified time is its last logon or password
+        change, if it has them
+        """
+        attrs = obj.attrs_for(field_names)
+        etag = make_etag(request.endpoint, obj.rid,
+                         sorted(printable_attrs(obj, field_names).items()))
+
+        times = [
+            nttime_to_timestamp(attrs[attr_name])
+            for attr_name in ('last_logon', 'last_password_change')
+            if attrs.get(attr_name)
+        ]
+        if times:
+            return etag, max(times)
+
+        return etag, obj.domain.modified_time
+
     def get(self, object_rid):
+        args = POLICY_HANDLE_OBJECT_PARSER.parse_args()
+        field_names = field_names_arg(args['fields'])
+
         obj = self.get_object(object_rid)
-        data = obj.attrs
+        if obj.known_missing:
+            abort(404, message="%s %d doesn't exist" % (
+                obj.__class__.__name__, object_rid,
+            ))
+
+        # The name is always output, so query it along with the fields
+        query_names = None
+        if field_names is not None:
+            query_names = field_names | set([obj.name_attr])
+
+        # The name index may not know the RID, in which case opening the
+        # object is what finds it doesn't exist
+        with missing_as_404(obj):
+            if APP.config.get('ETAG_MODE') == 'object':
+                etag, last_modified = self.object_validators(obj,
+                                                             query_names)
+            else:
+                etag, last_modified = domain_validators(object_rid)
+
+            headers = validator_headers(etag, last_modified)
+            if not_modified(etag, last_modified):
+                return '', 304, headers
+
+            # Copy, since attrs may be shared through the domain attr cache
+            attrs = obj.attrs_for(query_names)
+
+        data = {
+            attr_name: value
+            for attr_name, value in attrs.items()
+            if field_names is None or attr_name in field_names
+        }
 
         # Force standard name
-        data['name'] = obj.name
+        data['name'] = attrs.get(obj.name_attr) or obj.name
         data['rid'] = object_rid
 
         # Remove blacklisted fields
         for attr_name in self.blacklisted_fields:
             data.pop(attr_name, None)
 
-        # Generate fields
+        schema = obj.schema_for_fields(query_names)
+        return marshal(data, self.object_fields(schema, data)), 200, headers
+
+    def object_fields(self, schema, data):
+        """
+        Flask-RESTful fields to marshal object data with. When the model
+        schema is known, the fields are built once for each set of printable
+        attrs and cached on the schema
+        """
+        if schema is None:
+            return self._build_fields(
+                attr_name
+                for attr_name, value in data.items()
+                if isinstance(value, SIMPLE_PRINTABLE_TYPES)
+            )
+
+        attr_names = schema.printable_names_in(data)
+        attr_names.update(('name', 'rid'))
+        attr_names.difference_update(self.blacklisted_fields)
+
+        key = (self.__class__, frozenset(attr_names))
+        obj_fields = schema.serializers.get(key)
+        if obj_fields is None:
+            obj_fields = schema.serializers[key] = self._build_fields(
+                attr_names
+            )
+
+        return obj_fields
+
+    def _build_fields(self, attr_names):
+        """
+        Resource fields, plus raw fields for the given attrs
+        """
         obj_fields = self.fields
-        raw_field_attrs = set(data.keys()) - set(obj_fields.keys())
-        for attr_name in raw_field_attrs:
-            if isinstance(data[attr_name], SIMPLE_PRINTABLE_TYPES):
-                obj_fields[attr_name] = fields.Raw
+        for attr_name in attr_names:
+            obj_fields.setdefault(attr_name, fields.Raw)
 
-        return marshal(data, obj_fields)
+        return obj_fields
@@ -0,0 +1,41 @@
+from flask import request
+from flask.ext.restful import abort, Resource
+
+from pydentity.batch import MAX_BATCH_ITEMS, run_batch
+from pydentity.server import APP
+
+class BatchResource(Resource):
+    """
+    Runs many write operations in one request, pipelined over pooled SAMR
+    connections, with a result for each. Items that fail don't stop the
+    others, and nothing is rolled back. Only trusted writer clients, with
+    HTTP basic auth, can run batches
+    """
+    def post(self):
+        if not APP.config.get('ALLOW_WRITES'):
+            abort(404, message="Writes aren't enabled")
+
+        auth = request.authorization
+        if auth is None or not auth.username or auth.password is None or \
+                not APP.writer_clients.authenticate(auth.username,
+                                                    auth.password):
+            abort(401, message="Trusted writer credentials are required")
+
+        body = request.get_json(force=True, silent=True)
+        if not isinstance(body, dict) or \
+                not isinstance(body.get('operations'), list):
+            abort(400, message="Expected an object with a list of "
+                               "operations")
+
+        operations = body['operations']
+        if len(operations) > MAX_BATCH_ITEMS:
+            abort(413, message="At most %d operations can be run in a "
+                               "batch" % MAX_BATCH_ITEMS)
+
+        results = run_batch(APP.domain_model, operations)
+        failed = sum(1 for result in results if result['status'] >= 400)
+        return {
+            'results': results,
+            'succeeded': len(results) - failed,
+            'failed': failed,
+        }
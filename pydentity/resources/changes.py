@@ -0,0 +1,96 @@
+import json
+
+from flask import request, Response
+from flask.ext.restful import abort, Resource, reqparse
+
+from pydentity.server import APP
+
+# Seconds between comments sent to keep idle streams open
+KEEPALIVE_INTERVAL = 15
+
+CHANGES_PARSER = reqparse.RequestParser()
+CHANGES_PARSER.add_argument(
+    "since", type=long, default=None,
+    help="Domain sequence number of the last changes applied")
+
+def change_events(change_log, sequence):
+    """
+    Iterator of server-sent event strings, one per batch of changes after
+    the given sequence number, with comments while idle
+    """
+    while True:
+        batches = change_log.wait(sequence, KEEPALIVE_INTERVAL)
+        if batches is None:
+            yield 'event: reset\ndata: {}\n\n'
+            return
+
+        if not batches:
+            yield ': keepalive\n\n'
+            continue
+
+        for batch_sequence, changes in batches:
+            yield 'id: %d\nevent: changes\ndata: %s\n\n' % (
+                batch_sequence,
+                json.dumps({'sequence': batch_sequence, 'changes': changes}),
+            )
+            sequence = batch_sequence
+
+class ChangesResource(Resource):
+    """
+    Changes to domain objects, by domain sequence number. With an Accept
+    header of text/event-stream, changes are streamed as server-sent events
+    """
+    def get(self):
+        change_log = APP.change_log
+        if change_log is None:
+            abort(404, message="Change watching isn't enabled")
+        if change_log.sequence is None:
+            abort(503, message="Change watcher is starting")
+
+        args = CHANGES_PARSER.parse_args()
+        since = args['since']
+        if since is None and request.headers.get('Last-Event-ID'):
+            try:
+                since = long(request.headers['Last-Event-ID'])
+            except ValueError:
+                abort(400, message="Invalid Last-Event-ID")
+
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            if since is None:
+                since = change_log.sequence
+
+            if not change_log.open_stream():
+                abort(503, message="Too many change streams are open; poll "
+                                   "with since instead")
+
+            # The stream doesn't use SAMR, so it's not kept in the request
+            # context that holds the pooled connection. The slot is given
+            # back when the server closes the response, even if it's closed
+            # before the stream starts
+            response = Response(change_events(change_log, since),
+                                mimetype='text/event-stream',
+                                headers={'Cache-Control': 'no-cache',
+                                         'X-Accel-Buffering': 'no'})
+            response.call_on_close(change_log.close_stream)
+            return response
+
+        if since is None:
+            abort(400, message="since is required")
+
+        sequence = change_log.sequence
+        batches = change_log.since(since)
+        if batches is None:
+            abort(410, message="Changes since %d are no longer available; "
+                               "re-read all objects" % since)
+        if batches:
+            # Changes may have been logged since the sequence was read
+            sequence = max(sequence, batches[-1][0])
+
+        return {
+            'sequence': sequence,
+            'changes': [
+                dict(change, sequence=batch_sequence)
+                for batch_sequence, changes in batches
+                for change in changes
+            ],
+        }
@@ -0,0 +1,169 @@
+import json
+
+from itertools import islice
+
+from flask import request, Response, stream_with_context
+from flask.ext.restful import abort, Resource, reqparse
+
+from pydentity.fanout import concurrent_merge, merge_sorted, name_order_iter
+from pydentity.models.samba_ import Alias, Group, User
+from pydentity.server import APP, release_samr_handle
+from pydentity.util import chunked, gzip_iter
+
+MODELS_BY_TYPE_NAME = {
+    model_cls.plural_name().lower(): model_cls
+    for model_cls in (User, Group, Alias)
+}
+SEARCH_TYPES = ('users', 'groups', 'aliases')
+MAX_SEARCH_LIMIT = 1000
+# Objects per flush of a streamed response
+STREAM_CHUNK_SIZE = 256
+
+SEARCH_PARSER = reqparse.RequestParser()
+SEARCH_PARSER.add_argument(
+    "q", type=unicode, default=u'', help="Name prefix to search for")
+SEARCH_PARSER.add_argument(
+    "types", type=str, default=','.join(SEARCH_TYPES),
+    help="Comma separated types of object to search")
+SEARCH_PARSER.add_argument(
+    "limit", type=int, default=100, help="Most results to return")
+
+ALL_PARSER = reqparse.RequestParser()
+ALL_PARSER.add_argument(
+    "q", type=unicode, default=u'', help="Name prefix to filter by")
+
+def entry_key(entry):
+    """
+    Sort key of cross-domain entries: by name, then domain, type and RID
+    """
+    return (entry['name'].lower(), entry['domain'], entry['type'],
+            entry['rid'])
+
+def domain_entries(domain_name, domain, model_classes, prefix):
+    """
+    Iterator of entry dicts for the objects of the given types in a domain,
+    sorted by entry_key
+    """
+    with domain.samr_handle.connection():
+        domain_sid = str(domain.sid_obj)
+
+    def entries(model_cls):
+        type_name = model_cls.__name__.lower()
+        for obj in name_order_iter(domain, model_cls, prefix or None):
+            yield {
+                'domain': domain_name,
+                'sid': '%s-%d' % (domain_sid, obj.rid),
+                'type': type_name,
+                'rid': obj.rid,
+                'name': obj.name,
+            }
+
+    return merge_sorted([entries(model_cls) for model_cls in model_classes],
+                        entry_key)
+
+def all_domain_entries(model_classes, prefix):
+    """
+    Iterator of entry dicts for the objects of the given types in every
+    domain, sorted by entry_key. Each domain is read on its own thread
+    """
+    # The domain threads check out connections of their own, so the
+    # request's is given back rather than held while they wait for them
+    release_samr_handle(None)
+    return concurrent_merge(
+        [
+            domain_entries(domain_name, domain, model_classes, prefix)
+            for domain_name, domain in APP.domain_models.items()
+        ],
+        entry_key,
+    )
+
+def parse_types(types_arg):
+    """
+    List of model classes for a comma separated types argument
+    """
+    types = [
+        type_name.strip()
+        for type_name in types_arg.split(',')
+        if type_name.strip()
+    ]
+    unknown_types = set(types) - set(MODELS_BY_TYPE_NAME)
+    if unknown_types:
+        abort(400, message="Unknown types: %s" % ', '.join(unknown_types))
+
+    return [MODELS_BY_TYPE_NAME[type_name] for type_name in types]
+
+class DomainListResource(Resource):
+    """
+    The domains served, with the primary domain first
+    """
+    def get(self):
+        domains = []
+        for domain_name, domain in APP.domain_models.items():
+            with domain.samr_handle.connection():
+                domains.append({
+                    'name': domain_name,
+                    'sid': str(domain.sid_obj),
+                    'sequence': domain.sequence_num,
+                    'primary': domain is APP.domain_model,
+                })
+
+        return {'domains': domains}
+
+class SearchResource(Resource):
+    """
+    Objects in every domain with names starting with a prefix, in name order
+    """
+    def get(self):
+        args = SEARCH_PARSER.parse_args()
+        model_classes = parse_types(args['types'])
+        if not 0 < args['limit'] <= MAX_SEARCH_LIMIT:
+            abort(400, message="limit must be from 1 to %d" %
+                  MAX_SEARCH_LIMIT)
+
+        entries = all_domain_entries(model_classes, args['q'])
+        try:
+            results = list(islice(entries, args['limit'] + 1))
+        finally:
+            entries.close()
+
+        return {
+            'results': results[:args['limit']],
+            'truncated': len(results) > args['limit'],
+        }
+
+def entry_chunks(entries):
+    """
+    Iterator of newline delimited JSON strings, one per chunk of entries
+    """
+    try:
+        for chunk in chunked(entries, STREAM_CHUNK_SIZE):
+            lines = []
+            for entry in chunk:
+                lines.append(json.dumps(entry))
+                lines.append('\n')
+
+            yield ''.join(lines)
+    finally:
+        entries.close()
+
+class AllDomainsListResource(Resource):
+    """
+    Streaming newline delimited JSON list of one type of object across every
+    domain, in name order
+    """
+    def get(self, type_name):
+        args = ALL_PARSER.parse_args()
+        model_cls = MODELS_BY_TYPE_NAME.get(type_name)
+        if model_cls is None:
+            abort(404, message="Unknown type %s" % type_name)
+
+        body = entry_chunks(all_domain_entries([model_cls], args['q']))
+        headers = {}
+        if 'gzip' in request.accept_encodings:
+            body = gzip_iter(body)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+
+        return Response(stream_with_context(body),
+                        mimetype='application/x-ndjson',
+                        headers=headers)
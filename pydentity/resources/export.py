@@ -0,0 +1,79 @@
+import json
+
+from flask import request, Response, stream_with_context
+from flask.ext.restful import abort, Resource, reqparse
+
+from pydentity.resources.base import printable_attrs
+from pydentity.server import APP
+from pydentity.util import chunked, gzip_iter
+
+EXPORT_TYPES = ('users', 'groups', 'aliases')
+# Objects per attrs prefetch, and per flush of the response
+EXPORT_CHUNK_SIZE = 256
+
+EXPORT_PARSER = reqparse.RequestParser()
+EXPORT_PARSER.add_argument(
+    "types", type=str, default=','.join(EXPORT_TYPES),
+    help="Comma separated types of object to export")
+EXPORT_PARSER.add_argument(
+    "attrs", type=int, default=0, help="Set to 1 to include object attrs")
+
+def export_objects(domain, types):
+    """
+    Iterator of all objects of the given types in the domain
+    """
+    for type_name in types:
+        for obj in getattr(domain, '%s_iter' % type_name)():
+            yield obj
+
+def export_chunks(domain, types, attrs):
+    """
+    Iterator of newline delimited JSON strings, one per chunk of objects
+    """
+    for objects in chunked(export_objects(domain, types), EXPORT_CHUNK_SIZE):
+        if attrs:
+            domain.prefetch_attrs(objects)
+
+        lines = []
+        for obj in objects:
+            data = {
+                'type': obj.__class__.__name__.lower(),
+                'rid': obj.rid,
+                'name': obj.name,
+            }
+            if attrs:
+                data['attrs'] = printable_attrs(obj)
+
+            lines.append(json.dumps(data))
+            lines.append('\n')
+
+        yield ''.join(lines)
+
+class ExportResource(Resource):
+    """
+    Streaming newline delimited JSON export of the whole domain
+    """
+    def get(self):
+        args = EXPORT_PARSER.parse_args()
+
+        types = [
+            type_name.strip()
+            for type_name in args['types'].split(',')
+            if type_name.strip()
+        ]
+        unknown_types = set(types) - set(EXPORT_TYPES)
+        if unknown_types:
+            abort(400, message="Unknown types: %s" % ', '.join(unknown_types))
+
+        body = export_chunks(APP.domain_model, types, args['attrs'])
+        headers = {}
+        if 'gzip' in request.accept_encodings:
+            body = gzip_iter(body)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+
+        # Keep the request context, and its pooled SAMR connection, while
+        # the response streams
+        return Response(stream_with_context(body),
+                        mimetype='application/x-ndjson',
+                        headers=headers)
@@ -6,8 +6,10 @@ from pydentity.resources.base import (
 from pydentity.server import APP
 
 class GroupListResource(PaginatedPolicyHandleObjectListResource):
-    def objects_iter(self, rid):
-        return APP.domain_model.groups_iter(rid)
+    model_cls = Group
+
+    def objects_iter(self, rid, limit=None):
+        return APP.domain_model.groups_iter(rid, limit)
 
 class GroupResource(PolicyHandleObjectResource):
     def get_object(self, object_rid):
@@ -0,0 +1,73 @@
+from flask import url_for
+from flask.ext.restful import abort, Resource, reqparse
+
+from pydentity.models.samba_ import Alias, Group, User
+from pydentity.server import APP
+
+MEMBERSHIP_PARSER = reqparse.RequestParser()
+MEMBERSHIP_PARSER.add_argument(
+    "effective", type=int, default=0,
+    help="Set to 1 to include membership through nested groups and aliases")
+
+def membership_object_data(obj):
+    """
+    Data for an object in a membership list
+    """
+    type_name = obj.__class__.__name__.lower()
+    return {
+        'rid': obj.rid,
+        'name': obj.name,
+        'type': type_name,
+        'detail': url_for('%sresource' % type_name, object_rid=obj.rid),
+    }
+
+class MembershipResource(Resource):
+    """
+    Base for membership lists of a domain child
+    """
+    model = None
+
+    def get_object(self, object_rid):
+        obj = self.model(APP.domain_model, object_rid)
+        if obj.known_missing:
+            abort(404, message="%s %d doesn't exist" % (
+                self.model.__name__, object_rid,
+            ))
+
+        return obj
+
+    def membership(self, obj, effective):
+        """
+        Tuple of the related objects, and SIDs of related objects in other
+        domains
+        """
+        raise NotImplementedError("Must override membership")
+
+    def get(self, object_rid):
+        args = MEMBERSHIP_PARSER.parse_args()
+        obj = self.get_object(object_rid)
+
+        objects, sids = self.membership(obj, args['effective'])
+        return {
+            'objects': [membership_object_data(related)
+                        for related in objects],
+            'sids': sids,
+        }
+
+class UserGroupsResource(MembershipResource):
+    model = User
+
+    def membership(self, obj, effective):
+        return obj.containers(effective), []
+
+class GroupMembersResource(MembershipResource):
+    model = Group
+
+    def membership(self, obj, effective):
+        return obj.members(effective), obj.member_sids(effective)
+
+class AliasMembersResource(MembershipResource):
+    model = Alias
+
+    def membership(self, obj, effective):
+        return obj.members(effective), obj.member_sids(effective)
@@ -0,0 +1,49 @@
+from flask import request
+from flask.ext.restful import abort, Resource
+
+from pydentity.models.samba_ import MODELS_BY_SID_NAME_USE
+from pydentity.resources.base import is_rid
+from pydentity.samba_util import MAX_RID
+from pydentity.server import APP
+
+def type_name(sid_name_use):
+    """
+    API type name for a SID_NAME_USE value
+    """
+    model_cls = MODELS_BY_SID_NAME_USE.get(sid_name_use)
+    if model_cls is None:
+        return None
+
+    return model_cls.__name__.lower()
+
+class ResolveResource(Resource):
+    """
+    Bulk resolution of names to RIDs, and RIDs to names
+    """
+    def post(self):
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict):
+            abort(400, message="Expected a JSON object of names and rids")
+
+        names = data.get('names', [])
+        rids = data.get('rids', [])
+        if not isinstance(names, list) or \
+                not all(isinstance(name, basestring) for name in names):
+            abort(400, message="names must be a list of strings")
+        if not isinstance(rids, list) or not all(is_rid(rid) for rid in rids):
+            abort(400, message="rids must be a list of RIDs from 0 to %d" %
+                               MAX_RID)
+
+        domain = APP.domain_model
+        return {
+            'names': [
+                {'name': name, 'rid': rid, 'type': type_name(sid_name_use)}
+                for name, (rid, sid_name_use)
+                in zip(names, domain.lookup_names(names))
+            ],
+            'rids': [
+                {'rid': rid, 'name': name, 'type': type_name(sid_name_use)}
+                for rid, (name, sid_name_use)
+                in zip(rids, domain.lookup_rids(rids))
+            ],
+        }
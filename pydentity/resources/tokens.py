@@ -0,0 +1,71 @@
+import logging
+
+from flask import request
+from flask.ext.restful import abort, Resource
+
+from pydentity.models.samba_ import Alias, Group, User
+from pydentity.server import APP
+
+# Attrs carried in identity tokens
+TOKEN_ATTR_FIELDS = ('account_name', 'acct_flags')
+
+def identity_claims(user):
+    """
+    Claims dict asserting who a user is, and the groups and aliases they
+    belong to, including through nested membership
+    """
+    attrs = user.attrs_for(TOKEN_ATTR_FIELDS)
+    containers = user.containers(effective=True)
+    return {
+        'domain': str(user.domain.sid_obj),
+        'rid': user.rid,
+        'account_name': attrs['account_name'],
+        'acct_flags': attrs['acct_flags'],
+        'groups': [obj.rid for obj in containers if isinstance(obj, Group)],
+        'aliases': [obj.rid for obj in containers if isinstance(obj, Alias)],
+    }
+
+def token_keys():
+    """
+    The app's token key set, or a 404 if tokens aren't enabled
+    """
+    if APP.token_keys is None:
+        abort(404, message="Identity tokens aren't enabled")
+
+    return APP.token_keys
+
+class UserTokenResource(Resource):
+    """
+    Issues signed, time limited identity tokens for a user to trusted
+    clients, which authenticate with HTTP basic auth. Relying services
+    verify tokens locally with the published keys
+    """
+    def post(self, object_rid):
+        keys = token_keys()
+        auth = request.authorization
+        if auth is None or not auth.username or auth.password is None or \
+                not APP.token_clients.authenticate(auth.username,
+                                                   auth.password):
+            abort(401, message="Trusted client credentials are required")
+
+        user = User(APP.domain_model, object_rid)
+        if user.known_missing:
+            abort(404, message="User %d doesn't exist" % object_rid)
+
+        token, key = keys.issue(identity_claims(user))
+        logging.info("Issued identity token for user %d to client %s",
+                     object_rid, auth.username)
+        return {
+            'token': token,
+            'kid': key.kid,
+            'expires_in': keys.token_ttl,
+        }, 200, {'Cache-Control': 'no-store'}
+
+class TokenKeysResource(Resource):
+    """
+    Published JSON Web Key set of the public keys for verifying identity
+    tokens. Relying services fetch it again when a token has a key ID they
+    don't know
+    """
+    def get(self):
+        return {'keys': token_keys().published()}
@@ -1,3 +1,5 @@
+from flask.ext.restful import abort
+
 from pydentity.models.samba_ import User
 from pydentity.resources.base import (
     PaginatedPolicyHandleObjectListResource,
@@ -6,9 +8,19 @@ from pydentity.resources.base import (
 from pydentity.server import APP
 
 class UserListResource(PaginatedPolicyHandleObjectListResource):
-    def objects_iter(self, rid):
-        return APP.domain_model.users_iter(rid)
+    model_cls = User
+
+    def objects_iter(self, rid, limit=None):
+        return APP.domain_model.users_iter(rid, limit)
 
 class UserResource(PolicyHandleObjectResource):
     def get_object(self, object_rid):
         return User(APP.domain_model, object_rid)
+
+class UserByNameResource(UserResource):
+    def get(self, name):
+        object_rid = APP.domain_model.rid_for_name(User, name)
+        if object_rid is None:
+            abort(404, message="User %s doesn't exist" % name)
+
+        return super(UserByNameResource, self).get(object_rid)
@@ -1,20 +1,51 @@
 import logging
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+import six
 
 from samba.dcerpc import lsa, samr, security
+from six.moves import queue
+
+from pydentity.cache import HandleCache
+from pydentity.util import chunked
 
 SECURITY_FLAG = security.SEC_FLAG_MAXIMUM_ALLOWED
 CONNECTIONS = {}
 
+NT_STATUS_NONE_MAPPED = 0xC0000073
+# Errors opening a domain child whose RID doesn't exist
+NT_STATUS_NO_SUCH_OBJECT = frozenset((
+    0xC0000064,  # NT_STATUS_NO_SUCH_USER
+    0xC0000066,  # NT_STATUS_NO_SUCH_GROUP
+    0xC0000151,  # NT_STATUS_NO_SUCH_ALIAS
+))
+# Largest value a RID can have
+MAX_RID = 0xFFFFFFFF
+# Samba refuses LookupNames/LookupRids requests for more than this many items
+LOOKUP_BATCH_SIZE = 1000
+# Reply buffer budget for EnumDomains, enough for every domain a server has
+ENUM_DOMAINS_BUFFER_SIZE = 0x10000
+
 def get_connection_obj(conf_file):
     """
     Get the SAMR connection for the given conf file, via ncalrpc. Reuse cache
     where possible.
     """
     if conf_file not in CONNECTIONS:
-        CONNECTIONS[conf_file] = samr.samr('ncalrpc:', conf_file)
+        CONNECTIONS[conf_file] = new_connection_obj(conf_file)
 
     return CONNECTIONS[conf_file]
 
+def new_connection_obj(conf_file):
+    """
+    Open a new SAMR connection for the given conf file, via ncalrpc
+    """
+    return samr.samr('ncalrpc:', conf_file)
+
 def lsa_unwrap(value):
     """
     Unwraps a possible LSA value as best we can
@@ -29,13 +60,42 @@ def lsa_unwrap(value):
 
     return value
 
+def lsa_wrap(value):
+    """
+    Wraps a string in an LSA String for passing to samr calls, leaving other
+    values as they are
+    """
+    if isinstance(value, basestring):
+        string_obj = lsa.String()
+        string_obj.string = unicode(value)
+        return string_obj
+
+    return value
+
+def ntstatus(error):
+    """
+    The NTSTATUS code from an error raised by a Samba RPC call, or None
+    """
+    args = getattr(error, 'args', ())
+    if args and isinstance(args[0], (int, long)):
+        return args[0]
+
+    return None
+
 class SAMRHandle(object):
     """
     Wrapper around low level Samba/SAMR API operations
     """
     _handle_obj = None
+    _handle_cache = None
+    _domain_handle_caches = None
+    _domain_handles = None
 
-    def __init__(self, connection_obj=None, conf_file=None):
+    def __init__(self,
+                 connection_obj=None,
+                 conf_file=None,
+                 handle_cache_size=1024,
+                 handle_cache_ttl=300):
         assert filter(bool, (connection_obj, conf_file)), \
                "One of connection_obj, or conf_file is provided"
 
@@ -44,6 +104,9 @@ class SAMRHandle(object):
         elif conf_file:
             self._connection_obj = get_connection_obj(conf_file)
 
+        self._handle_cache_size = handle_cache_size
+        self._handle_cache_ttl = handle_cache_ttl
+
     @property
     def policy_handle_obj(self):
         """
@@ -63,6 +126,95 @@ class SAMRHandle(object):
         """
         return self._connection_obj
 
+    @property
+    def handle_cache(self):
+        """
+        HandleCache of policy_handle objects opened on this connection
+        """
+        if not self._handle_cache:
+            self._handle_cache = HandleCache(
+                self.connection_obj.Close,
+                max_size=self._handle_cache_size,
+                ttl=self._handle_cache_ttl,
+            )
+
+        return self._handle_cache
+
+    def handle_cache_for(self, domain_key):
+        """
+        HandleCache of policy_handle objects opened on this connection for
+        the children of one domain, so that busy domains don't evict the
+        handles of others
+        """
+        if self._domain_handle_caches is None:
+            self._domain_handle_caches = {}
+
+        handle_cache = self._domain_handle_caches.get(domain_key)
+        if handle_cache is None:
+            handle_cache = self._domain_handle_caches[domain_key] = \
+                HandleCache(
+                    self.connection_obj.Close,
+                    max_size=self._handle_cache_size,
+                    ttl=self._handle_cache_ttl,
+                )
+
+        return handle_cache
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager giving the SAMRHandle to make calls with. For
+        compatibility with SAMRHandlePool
+        """
+        yield self
+
+    @contextmanager
+    def spare_connection(self):
+        """
+        For compatibility with SAMRHandlePool. There's only the one
+        connection, so there's never a spare
+        """
+        yield None
+
+    def domain_handle_obj(self, sid_obj):
+        """
+        Samba policy_handle object for the domain with the given SID, opened
+        once per connection
+        """
+        if self._domain_handles is None:
+            self._domain_handles = {}
+
+        key = str(sid_obj)
+        if key not in self._domain_handles:
+            self._domain_handles[key] = self.connection_obj.OpenDomain(
+                self.policy_handle_obj, SECURITY_FLAG, sid_obj,
+            )
+
+        return self._domain_handles[key]
+
+    def ping(self):
+        """
+        Make a cheap call to check that the connection is still usable
+        """
+        self.connection_obj.EnumDomains(self.policy_handle_obj, 0, 1)
+
+    def close(self):
+        """
+        Close all policy handles opened through this object
+        """
+        if self._handle_cache:
+            self._handle_cache.close_all()
+        for handle_cache in (self._domain_handle_caches or {}).values():
+            handle_cache.close_all()
+
+        for domain_handle_obj in (self._domain_handles or {}).values():
+            self.connection_obj.Close(domain_handle_obj)
+        self._domain_handles = None
+
+        if self._handle_obj:
+            self.connection_obj.Close(self._handle_obj)
+            self._handle_obj = None
+
     def get_domain_sid_obj(self, domainname):
         """
         Get a Samba dom_sid object for the given domain name
@@ -72,3 +224,457 @@ class SAMRHandle(object):
         return self.connection_obj.LookupDomain(
             self.policy_handle_obj, domainname_lsa,
         )
+
+    def enum_domain_names(self):
+        """
+        List of the names of the domains on the server
+        """
+        _, domains_obj, count = self.connection_obj.EnumDomains(
+            self.policy_handle_obj, 0, ENUM_DOMAINS_BUFFER_SIZE,
+        )
+        return [lsa_unwrap(entry.name)
+                for entry in domains_obj.entries[:count]]
+
+    def lookup_names(self, domain_handle_obj, names):
+        """
+        Look up a list of names in a domain, batching requests to the server.
+        Returns a list of (rid, sid_name_use) tuples in the same order as the
+        names, with (None, None) for names that don't exist
+        """
+        results = []
+        for batch in chunked(names, LOOKUP_BATCH_SIZE):
+            names_lsa = []
+            for name in batch:
+                name_lsa = lsa.String()
+                name_lsa.string = unicode(name)
+                names_lsa.append(name_lsa)
+
+            try:
+                rids_obj, types_obj = self.connection_obj.LookupNames(
+                    domain_handle_obj, names_lsa,
+                )
+            except RuntimeError as ex:
+                if ntstatus(ex) != NT_STATUS_NONE_MAPPED:
+                    raise
+
+                results.extend((None, None) for _ in batch)
+                continue
+
+            for rid, sid_name_use in zip(rids_obj.ids, types_obj.ids):
+                if sid_name_use == lsa.SID_NAME_UNKNOWN:
+                    results.append((None, None))
+                else:
+                    results.append((rid, sid_name_use))
+
+        return results
+
+    def lookup_rids(self, domain_handle_obj, rids):
+        """
+        Look up a list of RIDs in a domain, batching requests to the server.
+        Returns a list of (name, sid_name_use) tuples in the same order as the
+        RIDs, with (None, None) for RIDs that don't exist
+        """
+        results = []
+        for batch in chunked(rids, LOOKUP_BATCH_SIZE):
+            try:
+                names_obj, types_obj = self.connection_obj.LookupRids(
+                    domain_handle_obj, batch,
+                )
+            except RuntimeError as ex:
+                if ntstatus(ex) != NT_STATUS_NONE_MAPPED:
+                    raise
+
+                results.extend((None, None) for _ in batch)
+                continue
+
+            for name, sid_name_use in zip(names_obj.names, types_obj.ids):
+                if sid_name_use == lsa.SID_NAME_UNKNOWN:
+                    results.append((None, None))
+                else:
+                    results.append((lsa_unwrap(name), sid_name_use))
+
+        return results
+
+
+class PoolTimeout(Exception):
+    """
+    No pooled SAMR connection became available in time
+    """
+    # HTTP status for Flask-RESTful to respond with
+    code = 503
+
+
+class SAMRHandlePool(object):
+    """
+    Thread safe pool of SAMRHandle objects, each with its own connection and
+    policy handles. Threads check a SAMRHandle out with acquire() or
+    connection(), and while they hold it the pool can be used in place of a
+    SAMRHandle
+    """
+    def __init__(self,
+                 conf_file,
+                 size=4,
+                 checkout_timeout=30,
+                 health_check_interval=60,
+                 handle_cache_size=1024,
+                 handle_cache_ttl=300,
+                 connection_factory=new_connection_obj):
+        self.conf_file = conf_file
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+
+        self._handle_cache_size = handle_cache_size
+        self._handle_cache_ttl = handle_cache_ttl
+        self._connection_factory = connection_factory
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Idle (samr_handle, last checked time) tuples
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._closed = False
+
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.reconnects = 0
+
+    def _new_samr_handle(self):
+        return SAMRHandle(
+            connection_obj=self._connection_factory(self.conf_file),
+            handle_cache_size=self._handle_cache_size,
+            handle_cache_ttl=self._handle_cache_ttl,
+        )
+
+    def checkout(self, timeout=None, wait=True):
+        """
+        Take a SAMRHandle from the pool, opening a new connection if the pool
+        isn't full, and waiting for one to be checked in otherwise. Raises
+        PoolTimeout if none is available within the timeout. If wait is
+        False, returns None rather than waiting
+        """
+        if timeout is None:
+            timeout = self.checkout_timeout
+
+        start = time.time()
+        try:
+            samr_handle, last_checked = self._idle.get_nowait()
+        except queue.Empty:
+            samr_handle = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+
+            if create:
+                try:
+                    samr_handle = self._new_samr_handle()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+
+                last_checked = time.time()
+            elif not wait:
+                return None
+            else:
+                try:
+                    samr_handle, last_checked = self._idle.get(
+                        timeout=timeout,
+                    )
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise PoolTimeout(
+                        "No SAMR connection available after %ss" % timeout
+                    )
+
+        waited = time.time() - start
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+        if time.time() - last_checked >= self.health_check_interval:
+            samr_handle = self._health_check(samr_handle)
+
+        return samr_handle
+
+    def checkin(self, samr_handle, failed=False):
+        """
+        Return a SAMRHandle to the pool. If the caller had a failure while
+        using it, it's health checked on its next checkout
+        """
+        if self._closed:
+            self._close(samr_handle)
+            return
+
+        self._idle.put((samr_handle, 0 if failed else time.time()))
+
+    def _health_check(self, samr_handle):
+        """
+        Ping the connection, closing it and replacing it with a new one if
+        it's broken
+        """
+        try:
+            samr_handle.ping()
+            return samr_handle
+        except RuntimeError:
+            logging.warning("Pooled SAMR connection failed health check; "
+                            "reconnecting", exc_info=True)
+
+        # Drop its policy handles and handle caches, as far as the broken
+        # connection allows
+        self._close(samr_handle)
+        with self._lock:
+            self.reconnects += 1
+
+        try:
+            return self._new_samr_handle()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _close(self, samr_handle):
+        try:
+            samr_handle.close()
+        except RuntimeError:
+            logging.exception("Error closing pooled SAMR connection")
+
+    def acquire(self):
+        """
+        Check out a SAMRHandle for the current thread. Nested calls in the
+        same thread share the SAMRHandle
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if not depth:
+            self._local.samr_handle = self.checkout()
+            self._local.failed = False
+
+        self._local.depth = depth + 1
+        return self._local.samr_handle
+
+    def release(self, failed=False):
+        """
+        Release the current thread's SAMRHandle, checking it back in to the
+        pool if this is the outermost acquire
+        """
+        self._local.failed = self._local.failed or failed
+        self._local.depth -= 1
+        if not self._local.depth:
+            samr_handle = self._local.samr_handle
+            self._local.samr_handle = None
+            self.checkin(samr_handle, self._local.failed)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager holding a SAMRHandle for the current thread
+        """
+        samr_handle = self.acquire()
+        failed = False
+        try:
+            yield samr_handle
+        except RuntimeError:
+            failed = True
+            raise
+        finally:
+            self.release(failed)
+
+    @contextmanager
+    def spare_connection(self):
+        """
+        Context manager holding a SAMRHandle for the current thread if one is
+        idle, or can be opened, without waiting, and giving None otherwise.
+        For threads helping a caller that already holds a connection: if
+        they waited on the pool, callers holding every connection could all
+        be waiting on helpers that are waiting for a connection
+        """
+        if self.acquired:
+            with self.connection() as samr_handle:
+                yield samr_handle
+            return
+
+        samr_handle = self.checkout(wait=False)
+        if samr_handle is None:
+            yield None
+            return
+
+        self._local.samr_handle = samr_handle
+        self._local.failed = False
+        self._local.depth = 1
+        failed = False
+        try:
+            yield samr_handle
+        except RuntimeError:
+            failed = True
+            raise
+        finally:
+            self.release(failed)
+
+    @property
+    def acquired(self):
+        """
+        Whether the current thread has a SAMRHandle checked out
+        """
+        return bool(getattr(self._local, 'depth', 0))
+
+    @property
+    def current(self):
+        """
+        The SAMRHandle checked out by the current thread
+        """
+        samr_handle = getattr(self._local, 'samr_handle', None)
+        if samr_handle is None:
+            raise RuntimeError("No pooled SAMR connection checked out for "
+                               "this thread")
+
+        return samr_handle
+
+    @property
+    def connection_obj(self):
+        return self.current.connection_obj
+    @property
+    def policy_handle_obj(self):
+        return self.current.policy_handle_obj
+    @property
+    def handle_cache(self):
+        return self.current.handle_cache
+
+    def handle_cache_for(self, domain_key):
+        return self.current.handle_cache_for(domain_key)
+
+    def domain_handle_obj(self, sid_obj):
+        return self.current.domain_handle_obj(sid_obj)
+    def get_domain_sid_obj(self, domainname):
+        return self.current.get_domain_sid_obj(domainname)
+    def enum_domain_names(self):
+        return self.current.enum_domain_names()
+    def lookup_names(self, domain_handle_obj, names):
+        return self.current.lookup_names(domain_handle_obj, names)
+    def lookup_rids(self, domain_handle_obj, rids):
+        return self.current.lookup_rids(domain_handle_obj, rids)
+
+    def close(self):
+        """
+        Close the idle connections' policy handles. Connections checked out
+        when this is called are closed when they're checked in
+        """
+        self._closed = True
+        while True:
+            try:
+                samr_handle, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+            self._close(samr_handle)
+
+    def stats(self):
+        """
+        Dict of pool statistics
+        """
+        return {
+            'size': self.size,
+            'created': self._created,
+            'idle': self._idle.qsize(),
+            'checkouts': self.checkouts,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+            'wait_avg': (self.wait_total / self.checkouts
+                         if self.checkouts else 0.0),
+            'timeouts': self.timeouts,
+            'reconnects': self.reconnects,
+        }
+
+
+class SharedWork(object):
+    """
+    Items worked through by a caller on its SAMR connection, helped by
+    threads that can get spare connections without waiting. The caller
+    never waits on the pool while it holds a connection, so the work always
+    finishes, on the caller's connection alone if need be
+    """
+    def __init__(self, func, items):
+        self.func = func
+        self.items = list(items)
+        # Threads that have run items
+        self.threads = 0
+
+        self._condition = threading.Condition()
+        self._next = 0
+        self._running = 0
+        self._error = None
+
+    def work(self):
+        """
+        Run items on the current thread until there are none left
+        """
+        counted = False
+        while True:
+            with self._condition:
+                if self._error is not None or self._next >= len(self.items):
+                    return
+
+                item = self.items[self._next]
+                self._next += 1
+                self._running += 1
+                if not counted:
+                    self.threads += 1
+                    counted = True
+
+            try:
+                self.func(item)
+            except Exception:
+                with self._condition:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    self._condition.notify_all()
+
+    def help(self, samr_handle):
+        """
+        Run items on a spare connection, if there is one
+        """
+        try:
+            with samr_handle.spare_connection() as spare:
+                if spare is not None:
+                    self.work()
+        except Exception:
+            logging.warning("Error getting a spare SAMR connection",
+                            exc_info=True)
+
+    def wait(self):
+        """
+        Wait for items running on other threads, then raise the first error
+        any item raised
+        """
+        with self._condition:
+            while self._running:
+                self._condition.wait()
+
+            if self._error is not None:
+                six.reraise(*self._error)
+
+def run_shared(samr_handle, thread_pool, func, items, helpers):
+    """
+    Call func on every item, on the calling thread's connection and on up to
+    helpers threads from thread_pool that can get spare connections without
+    waiting. Returns the number of threads that ran items. If an item
+    raises, the rest are skipped and the error is raised once the items
+    already running have finished
+    """
+    work = SharedWork(func, items)
+    for _ in range(min(helpers, len(work.items) - 1)):
+        thread_pool.apply_async(work.help, (samr_handle,))
+
+    with samr_handle.connection():
+        work.work()
+    work.wait()
+    return work.threads
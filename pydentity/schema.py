@@ -0,0 +1,162 @@
+import logging
+import threading
+
+from samba.dcerpc import lsa
+
+from pydentity.samba_util import lsa_unwrap
+from pydentity.util import SIMPLE_PRINTABLE_TYPES, SYSTEM_PROPERTY_RE
+
+# info object type -> InfoSchema
+INFO_SCHEMAS = {}
+# (model class, info level) -> InfoSchema
+LEVEL_SCHEMAS = {}
+# (model class, tuple of info levels) -> ModelSchema
+MODEL_SCHEMAS = {}
+SCHEMAS_LOCK = threading.Lock()
+
+def unwrap_string(value):
+    return value.string
+def unwrap_binary_string(value):
+    return value.array
+def unwrap_none(value):
+    return value
+
+UNWRAPPERS = {
+    lsa.String: unwrap_string,
+    lsa.BinaryString: unwrap_binary_string,
+}
+
+class InfoSchema(object):
+    """
+    Attribute layout of a samr info class, introspected once from the first
+    info object of that class that's seen
+    """
+    def __init__(self, info_obj):
+        self.info_cls = type(info_obj)
+
+        extractors = []
+        printable_names = set()
+        dynamic_names = set()
+        for attr_name in dir(info_obj):
+            if SYSTEM_PROPERTY_RE.match(attr_name):
+                continue
+
+            value = getattr(info_obj, attr_name)
+            if value is None:
+                # Unset pointer, so the type isn't known. Fall back to
+                # checking the value every time
+                extractors.append((attr_name, lsa_unwrap))
+                dynamic_names.add(attr_name)
+                continue
+
+            unwrapper = UNWRAPPERS.get(type(value), unwrap_none)
+            extractors.append((attr_name, unwrapper))
+
+            if unwrapper is not unwrap_none:
+                printable_names.add(attr_name)
+            elif isinstance(value, SIMPLE_PRINTABLE_TYPES):
+                printable_names.add(attr_name)
+            elif value.__class__.__module__ == 'lsa':
+                logging.warn("Unknown LSA type: %s", value.__class__.__name__)
+
+        self.extractors = tuple(extractors)
+        self.attr_names = frozenset(name for name, _ in extractors)
+        self.printable_names = frozenset(printable_names)
+        self.dynamic_names = frozenset(dynamic_names)
+
+    def extract(self, info_obj):
+        """
+        Dict of the unwrapped attrs of an info object
+        """
+        return {
+            attr_name: unwrapper(getattr(info_obj, attr_name))
+            for attr_name, unwrapper in self.extractors
+        }
+
+
+class ModelSchema(object):
+    """
+    Combined attribute layout of the info classes queried for a model
+    """
+    def __init__(self, info_schemas):
+        self.info_schemas = tuple(info_schemas)
+
+        self.printable_names = frozenset().union(*(
+            info_schema.printable_names for info_schema in self.info_schemas
+        ))
+        self.dynamic_names = frozenset().union(*(
+            info_schema.dynamic_names for info_schema in self.info_schemas
+        )) - self.printable_names
+
+        # Cache for serializers built from this schema
+        self.serializers = {}
+
+    def printable_names_in(self, attrs):
+        """
+        Names of the attrs that can be output as simple values
+        """
+        names = set(self.printable_names)
+        names.update(
+            attr_name
+            for attr_name in self.dynamic_names
+            if isinstance(attrs.get(attr_name), SIMPLE_PRINTABLE_TYPES)
+        )
+        return names
+
+    def printable(self, attrs, field_names=None):
+        """
+        The attrs that can be output as simple values, optionally limited to
+        the given set of names
+        """
+        names = self.printable_names_in(attrs)
+        if field_names is not None:
+            names &= field_names
+
+        return {
+            attr_name: attrs[attr_name]
+            for attr_name in names
+            if attr_name in attrs
+        }
+
+
+def info_schema(info_obj):
+    """
+    Get the InfoSchema for an info object, compiling it on first use
+    """
+    info_cls = type(info_obj)
+    schema = INFO_SCHEMAS.get(info_cls)
+    if schema is None:
+        with SCHEMAS_LOCK:
+            schema = INFO_SCHEMAS.get(info_cls)
+            if schema is None:
+                schema = INFO_SCHEMAS[info_cls] = InfoSchema(info_obj)
+
+    return schema
+
+def register_model_schema(model_cls, level, info_obj):
+    """
+    Record the info class returned by a model's info level query, and get its
+    InfoSchema
+    """
+    schema = info_schema(info_obj)
+    LEVEL_SCHEMAS.setdefault((model_cls, level), schema)
+    return schema
+
+def model_schema(model_cls, levels):
+    """
+    Get the ModelSchema for the given info levels of a model, or None if any
+    of the levels hasn't been queried yet
+    """
+    key = (model_cls, tuple(levels))
+    schema = MODEL_SCHEMAS.get(key)
+    if schema is not None:
+        return schema
+
+    info_schemas = [LEVEL_SCHEMAS.get((model_cls, level)) for level in levels]
+    if None in info_schemas:
+        return None
+
+    with SCHEMAS_LOCK:
+        schema = MODEL_SCHEMAS.setdefault(key, ModelSchema(info_schemas))
+
+    return schema
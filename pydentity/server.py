@@ -1,4 +1,10 @@
-from flask import Flask, redirect
+import atexit
+import logging
+import time
+
+from collections import OrderedDict
+
+from flask import Flask, g, redirect, request
 from flask.ext.admin import Admin, AdminIndexView, expose
 from flask.ext.restful import Api
 
@@ -21,6 +27,36 @@ def index():
     """
     return redirect(ADMIN.url)
 
+@APP.route('/metrics')
+def metrics():
+    """
+    Metrics in Prometheus text format
+    """
+    from pydentity.metrics import REGISTRY
+    return REGISTRY.render(), 200, {
+        'Content-Type': 'text/plain; version=0.0.4',
+    }
+
+@APP.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+@APP.after_request
+def record_request_time(response):
+    """
+    Record the time taken to produce the response. Streamed response bodies
+    aren't included
+    """
+    from pydentity.metrics import HTTP_REQUEST_SECONDS
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        HTTP_REQUEST_SECONDS.observe(time.time() - start,
+                                     endpoint=request.endpoint,
+                                     method=request.method,
+                                     status=response.status_code)
+
+    return response
+
 def add_admin_views(app_args):
     from pydentity.views.admin_samba import AdminObjectsListView
     ADMIN.add_view(AdminObjectsListView(name="Users", endpoint="users"))
@@ -41,22 +77,250 @@ def add_api_resources(_):
     API1.add_resource(resources.aliases.AliasResource, '/aliases/<int:object_rid>')
     API1.add_resource(resources.groups.GroupResource, '/groups/<int:object_rid>')
     API1.add_resource(resources.users.UserResource, '/users/<int:object_rid>')
+    API1.add_resource(resources.users.UserByNameResource,
+                      '/users/by-name/<string:name>')
+
+    API1.add_resource(resources.membership.UserGroupsResource,
+                      '/users/<int:object_rid>/groups')
+    API1.add_resource(resources.membership.GroupMembersResource,
+                      '/groups/<int:object_rid>/members')
+    API1.add_resource(resources.membership.AliasMembersResource,
+                      '/aliases/<int:object_rid>/members')
+
+    API1.add_resource(resources.resolve.ResolveResource, '/resolve')
+    API1.add_resource(resources.export.ExportResource, '/export')
+    API1.add_resource(resources.changes.ChangesResource, '/changes')
+    API1.add_resource(resources.batch.BatchResource, '/batch')
 
-def setup_samba(app_args):
-    from pydentity.samba_util import SAMRHandle
+    API1.add_resource(resources.tokens.UserTokenResource,
+                      '/users/<int:object_rid>/token')
+    API1.add_resource(resources.tokens.TokenKeysResource, '/tokens/keys')
+
+    API1.add_resource(resources.domains.DomainListResource, '/domains')
+    API1.add_resource(resources.domains.SearchResource, '/search')
+    API1.add_resource(resources.domains.AllDomainsListResource,
+                      '/all/<string:type_name>')
+
+def setup_samba(app_args, connection_factory=None):
+    """
+    Connect the app to the Samba domain. connection_factory(conf_file) makes
+    the samr connection objects for the pool, and defaults to connecting to
+    the local server
+    """
+    from pydentity.metrics import (
+        InstrumentedConnection,
+        metric_name_part,
+        REGISTRY,
+    )
+    from pydentity.samba_util import (
+        new_connection_obj,
+        PoolTimeout,
+        SAMRHandlePool,
+    )
     from pydentity.models.samba_ import Domain
 
-    APP.samr_handle = SAMRHandle(conf_file=app_args['smbconf'])
-    APP.domain_model = Domain(app_args['smbdomain'], APP.samr_handle)
+    if connection_factory is None:
+        connection_factory = new_connection_obj
+
+    slow_call_secs = None
+    if app_args['slow_call_ms']:
+        slow_call_secs = app_args['slow_call_ms'] / 1000.0
+
+    rpc_broker = None
+    if app_args['samr_workers']:
+        from pydentity.workers import RemoteSAMRHandle, SAMRWorkerPool
+        rpc_broker = SAMRWorkerPool(
+            app_args['smbconf'],
+            app_args['smbdomain'],
+            processes=app_args['samr_workers'],
+            slow_call_secs=slow_call_secs,
+        )
+        APP.samr_handle = RemoteSAMRHandle(rpc_broker)
+    else:
+        APP.samr_handle = SAMRHandlePool(
+            app_args['smbconf'],
+            size=app_args['samr_pool_size'],
+            checkout_timeout=app_args['samr_pool_timeout'],
+            handle_cache_size=app_args['handle_cache_size'],
+            handle_cache_ttl=app_args['handle_cache_ttl'],
+            connection_factory=lambda conf_file: InstrumentedConnection(
+                connection_factory(conf_file), slow_call_secs,
+            ),
+        )
+
+    shared_cache = None
+    if app_args['shared_cache']:
+        from pydentity.shared_cache import SharedCacheReader
+        shared_cache = SharedCacheReader(app_args['shared_cache'])
+
+    def make_domain(name, shared_cache=None):
+        # Every domain has its own caches, but they share the connections
+        return Domain(
+            name,
+            APP.samr_handle,
+            sequence_poll_interval=app_args['sequence_poll_interval'],
+            attr_cache_size=app_args['attr_cache_size'],
+            prefetch_concurrency=app_args['expand_concurrency'],
+            rpc_broker=rpc_broker,
+            coalesce_timeout=app_args['coalesce_timeout'],
+            shared_cache=shared_cache,
+            write_concurrency=app_args['write_concurrency'],
+            max_write_defer=app_args['max_write_defer'],
+        )
+
+    APP.domain_model = make_domain(app_args['smbdomain'], shared_cache)
+    APP.domain_models = OrderedDict([(app_args['smbdomain'],
+                                      APP.domain_model)])
+    if app_args['discover_domains']:
+        with APP.samr_handle.connection():
+            names = APP.domain_model.enum_domain_names()
+        for name in names:
+            if name.lower() != app_args['smbdomain'].lower():
+                APP.domain_models[name] = make_domain(name)
+        logging.info("Serving domains: %s", ", ".join(APP.domain_models))
+
+    REGISTRY.add_collector('pydentity_samr', APP.samr_handle.stats)
+    REGISTRY.add_collector('pydentity_attr_cache',
+                           APP.domain_model.attr_cache.stats)
+    REGISTRY.add_collector('pydentity_single_flight',
+                           APP.domain_model.single_flight.stats)
+    for name, domain in APP.domain_models.items():
+        if domain is not APP.domain_model:
+            REGISTRY.add_collector(
+                'pydentity_attr_cache_%s' % metric_name_part(name),
+                domain.attr_cache.stats,
+            )
+
+    APP.snapshot = None
+    if app_args['snapshot']:
+        from pydentity.snapshot import Snapshot
+        APP.snapshot = Snapshot(app_args['snapshot'])
+        with APP.samr_handle.connection():
+            APP.snapshot.load(APP.domain_model)
+        if app_args['snapshot_interval']:
+            APP.snapshot.start_autosave(APP.domain_model,
+                                        app_args['snapshot_interval'])
+
+    APP.change_log = None
+    if app_args['change_watch_interval']:
+        from pydentity.changes import ChangeLog, ChangeWatcher
+        APP.change_log = ChangeLog(app_args['change_log_size'],
+                                   app_args['max_streams'])
+        ChangeWatcher(APP.domain_model,
+                      APP.change_log,
+                      app_args['change_watch_interval']).start()
+        REGISTRY.add_collector('pydentity_change_log', APP.change_log.stats)
+
+    APP.token_keys = None
+    if app_args['token_key_file']:
+        from pydentity.tokens import TokenClients, TokenKeySet
+        APP.token_keys = TokenKeySet(
+            app_args['token_key_file'],
+            token_ttl=app_args['token_ttl'],
+            rotate_interval=app_args['token_key_rotation'],
+        )
+        APP.token_clients = TokenClients(app_args['token_client_file'])
+        APP.config['HTTP_BASIC_AUTH_REALM'] = 'pydentity'
+        REGISTRY.add_collector('pydentity_tokens', APP.token_keys.stats)
+        REGISTRY.add_collector('pydentity_token_clients',
+                               APP.token_clients.stats)
+
+    APP.config['ETAG_MODE'] = app_args['etag_mode']
+    APP.config['ALLOW_WRITES'] = app_args['allow_writes']
+    APP.writer_clients = None
+    if app_args['allow_writes']:
+        from pydentity.tokens import TokenClients
+        APP.writer_clients = TokenClients(app_args['writer_client_file'])
+        APP.config['HTTP_BASIC_AUTH_REALM'] = 'pydentity'
+        REGISTRY.add_collector('pydentity_writer_clients',
+                               APP.writer_clients.stats)
+
+    APP.before_request(acquire_samr_handle)
+    APP.teardown_request(release_samr_handle)
+    APP.register_error_handler(PoolTimeout, pool_timeout)
+
+def acquire_samr_handle():
+    """
+    Check out a pooled SAMR connection for the request
+    """
+    APP.samr_handle.acquire()
+
+def release_samr_handle(exc):
+    """
+    Check the request's SAMR connection back in to the pool
+    """
+    if APP.samr_handle.acquired:
+        APP.samr_handle.release(failed=isinstance(exc, RuntimeError))
+
+def pool_timeout(_):
+    """
+    Requests that time out waiting for a SAMR connection are unavailable
+    """
+    return "No SAMR connection available", 503
+
+def teardown_samba():
+    """
+    Close the policy handles held open for the app
+    """
+    logging.info("SAMR connection stats: %s",
+                 APP.samr_handle.stats())
+    for name, domain in APP.domain_models.items():
+        logging.info("Attribute cache stats for %s: %s",
+                     name, domain.attr_cache.stats())
+        logging.info("Coalesced call stats for %s: %s",
+                     name, domain.single_flight.stats())
+    if APP.snapshot:
+        try:
+            with APP.samr_handle.connection():
+                APP.snapshot.save(APP.domain_model)
+        except Exception:
+            logging.exception("Error saving snapshot")
+    APP.samr_handle.close()
+
+def run_shared_cache_leader(app_args, stopping):
+    """
+    Keep the shared cache file up to date with the domain until the stopping
+    event is set. This is the only process that polls the domain for changes
+    """
+    from pydentity.shared_cache import SharedCacheWriter
+
+    setup_samba(dict(app_args,
+                     shared_cache=None,
+                     snapshot=None,
+                     change_watch_interval=0))
+    try:
+        SharedCacheWriter(app_args['shared_cache']).run(
+            APP.domain_model, app_args['sequence_poll_interval'], stopping,
+        )
+    finally:
+        teardown_samba()
 
 def run(app_args):
-    setup_samba(app_args)
     add_admin_views(app_args)
     add_api_resources(app_args)
 
+    if app_args['server'] == 'production':
+        # Each worker process sets up its own SAMR connections, and tears
+        # them down once its requests have drained
+        from pydentity.serving import run_production
+        leader_func = None
+        if app_args['shared_cache']:
+            leader_func = lambda stopping: run_shared_cache_leader(app_args,
+                                                                   stopping)
+
+        run_production(APP, app_args,
+                       lambda: setup_samba(app_args),
+                       teardown_samba,
+                       leader_func)
+        return
+
+    setup_samba(app_args)
+    atexit.register(teardown_samba)
+
     server_args = {
         key: val
         for key, val in app_args.items()
         if key in ('host', 'port', 'debug')
     }
-    APP.run(**server_args)
+    # Change streams are long lived, so each request needs its own thread
+    APP.run(threaded=True, **server_args)
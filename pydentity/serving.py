@@ -0,0 +1,300 @@
+import errno
+import logging
+import os
+import signal
+import threading
+import time
+
+from six.moves import queue
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from pydentity.metrics import HTTP_SHED, REGISTRY
+
+SHED_RESPONSE = (
+    "HTTP/1.1 503 Service Unavailable\r\n"
+    "Content-Type: text/plain\r\n"
+    "Content-Length: 12\r\n"
+    "Retry-After: 1\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+    "Server busy\n"
+)
+# How often a worker process supervisor checks its children
+SUPERVISE_INTERVAL = 1
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    HTTP/1.1 request handler, so that responses with a length keep the
+    connection open for more requests. Idle connections are closed after
+    the server's keepalive_timeout, and once the server is draining. Once a
+    request has started, socket reads and writes get the longer
+    request_timeout instead, so slow clients of streamed responses aren't
+    cut off
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def handle_one_request(self):
+        if self.server.draining:
+            self.close_connection = 1
+            return
+
+        self.connection.settimeout(self.server.keepalive_timeout)
+        self.raw_requestline = self.rfile.readline()
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+
+        self.connection.settimeout(self.server.request_timeout)
+        if self.parse_request():
+            return self.run_wsgi()
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server that handles connections on a fixed number of threads, fed
+    from a bounded queue. When the queue is full, new connections get a 503
+    straight away, rather than waiting behind requests that will time out.
+    Threads are started by serve_forever, so the server can be created
+    before forking worker processes that share its socket
+    """
+    def __init__(self, host, port, app,
+                 threads=16,
+                 queue_size=64,
+                 keepalive_timeout=5,
+                 request_timeout=60):
+        BaseWSGIServer.__init__(self, host, port, app,
+                                handler=KeepAliveRequestHandler)
+        self.thread_count = threads
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+
+        self.draining = False
+        self.shed = 0
+        self._connections = queue.Queue(queue_size)
+        self._threads = []
+
+    def start_threads(self):
+        for idx in range(self.thread_count):
+            thread = threading.Thread(target=self._handle_connections,
+                                      name='http-%d' % idx)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def serve_forever(self):
+        if not self._threads:
+            self.start_threads()
+
+        BaseWSGIServer.serve_forever(self)
+
+    def process_request(self, request, client_address):
+        try:
+            self._connections.put_nowait((request, client_address))
+        except queue.Full:
+            self._shed(request)
+
+    def _shed(self, request):
+        """
+        Refuse a connection with a 503
+        """
+        self.shed += 1
+        HTTP_SHED.inc()
+        try:
+            request.sendall(SHED_RESPONSE)
+        except Exception:
+            pass
+        self.shutdown_request(request)
+
+    def _handle_connections(self):
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def drain(self, timeout):
+        """
+        Stop accepting connections, and wait up to timeout seconds for
+        queued and in progress requests to finish. Returns whether they all
+        did. Must be called from a different thread to serve_forever
+        """
+        self.draining = True
+        self.shutdown()
+
+        for _ in self._threads:
+            self._connections.put(None)
+
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.time()))
+
+        finished = not any(thread.is_alive() for thread in self._threads)
+        if not finished:
+            logging.warning("Requests still running after draining for %ds",
+                            timeout)
+
+        return finished
+
+    def stats(self):
+        return {
+            'threads': self.thread_count,
+            'queued': self._connections.qsize(),
+            'shed': self.shed,
+            'draining': self.draining,
+        }
+
+
+def serve_until_signalled(server, drain_timeout):
+    """
+    Serve until SIGTERM or SIGINT, then drain the server
+    """
+    stopping = threading.Event()
+
+    def stop(signum, _):
+        logging.info("Got signal %d, draining", signum)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    serve_thread = threading.Thread(target=server.serve_forever,
+                                    name='http-accept')
+    serve_thread.daemon = True
+    serve_thread.start()
+
+    # Signals are only handled by the main thread, between waits
+    while not stopping.is_set():
+        stopping.wait(SUPERVISE_INTERVAL)
+
+    server.drain(drain_timeout)
+    serve_thread.join(drain_timeout)
+
+def run_worker(server, setup_func, teardown_func, drain_timeout):
+    """
+    Set up the app in this process, serve until signalled, then drain and
+    tear it down
+    """
+    setup_func()
+    try:
+        serve_until_signalled(server, drain_timeout)
+    finally:
+        teardown_func()
+
+def run_leader(leader_func):
+    """
+    Run leader_func(stopping) until SIGTERM or SIGINT sets the stopping event
+    """
+    stopping = threading.Event()
+
+    def stop(signum, _):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    leader_thread = threading.Thread(target=leader_func, args=(stopping,),
+                                     name='leader')
+    leader_thread.daemon = True
+    leader_thread.start()
+
+    # Signals are only handled by the main thread, between waits
+    while leader_thread.is_alive():
+        leader_thread.join(SUPERVISE_INTERVAL)
+
+def run_production(app, app_args, setup_func, teardown_func,
+                   leader_func=None):
+    """
+    Serve the app with a pooled threaded server in each of
+    app_args['workers'] processes. setup_func and teardown_func are called
+    in each worker process, so that SAMR connections and caches aren't
+    shared across forks. If leader_func is given, it's run in one more
+    process, with an event that's set when it should stop
+    """
+    server = PooledWSGIServer(
+        app_args['host'] or '127.0.0.1',
+        app_args['port'] or 5000,
+        app,
+        threads=app_args['threads'],
+        queue_size=app_args['queue_size'],
+        keepalive_timeout=app_args['keepalive_timeout'],
+        request_timeout=app_args['request_timeout'],
+    )
+    REGISTRY.add_collector('pydentity_http_server', server.stats)
+    logging.info("Listening on %s:%d with %d workers of %d threads",
+                 server.server_address[0], server.server_address[1],
+                 app_args['workers'], app_args['threads'])
+
+    if app_args['workers'] <= 1 and leader_func is None:
+        run_worker(server, setup_func, teardown_func,
+                   app_args['drain_timeout'])
+        return
+
+    # Workers race to accept connections; the losers get EAGAIN and go back
+    # to waiting
+    server.socket.setblocking(0)
+
+    def fork_worker(leader=False):
+        pid = os.fork()
+        if pid:
+            return pid
+
+        code = 0
+        try:
+            if leader:
+                server.server_close()
+                run_leader(leader_func)
+            else:
+                run_worker(server, setup_func, teardown_func,
+                           app_args['drain_timeout'])
+        except Exception:
+            logging.exception("Worker %d failed", os.getpid())
+            code = 1
+        os._exit(code)
+
+    stopping = threading.Event()
+
+    def stop(signum, _):
+        logging.info("Got signal %d, stopping workers", signum)
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # PID -> whether it's the leader
+    pids = {}
+    if leader_func is not None:
+        pids[fork_worker(leader=True)] = True
+    for _ in range(max(1, app_args['workers'])):
+        pids[fork_worker()] = False
+
+    while not stopping.is_set():
+        stopping.wait(SUPERVISE_INTERVAL)
+        for pid, leader in list(pids.items()):
+            if os.waitpid(pid, os.WNOHANG)[0] and not stopping.is_set():
+                logging.warning("%s %d exited, restarting",
+                                "Leader" if leader else "Worker", pid)
+                del pids[pid]
+                pids[fork_worker(leader)] = leader
+
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except OSError as ex:
+            if ex.errno != errno.ECHILD:
+                raise
+
+    server.server_close()
@@ -0,0 +1,285 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from pydentity.changes import DomainScanner, MODELS_BY_TYPE_NAME
+from pydentity.models.samba_ import picklable_attrs
+
+SHARED_CACHE_FORMAT_VERSION = 1
+# Bytes of the file readers map into memory, so that reads come straight
+# from the page cache shared by all processes
+SHARED_CACHE_MMAP_SIZE = 1 << 30
+
+SHARED_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS principals (
+    rid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    lname TEXT NOT NULL,
+    sid_name_use INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS principals_by_name
+    ON principals (sid_name_use, lname, rid);
+CREATE INDEX IF NOT EXISTS principals_by_lname ON principals (lname);
+CREATE TABLE IF NOT EXISTS attrs (
+    model TEXT NOT NULL,
+    rid INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (model, rid)
+);
+"""
+
+class SharedCacheReader(object):
+    """
+    Read side of a directory cache file shared by worker processes: names,
+    RIDs and attrs of every user, group and alias as of one domain sequence
+    number. Rows are read on demand, rather than copied into each process
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def _conn(self):
+        """
+        SQLite connection for the current thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA mmap_size=%d" % SHARED_CACHE_MMAP_SIZE)
+            conn.execute("PRAGMA query_only=1")
+            self._local.conn = conn
+
+        return conn
+
+    def sequence(self):
+        """
+        Domain sequence number the cache was published at, or None if it
+        hasn't been published yet
+        """
+        try:
+            meta = dict(self._conn.execute(
+                "SELECT key, value FROM meta WHERE key IN "
+                "('version', 'sequence')"
+            ))
+        except sqlite3.OperationalError:
+            # The leader hasn't created the tables yet
+            return None
+
+        if not meta or \
+                int(meta['version']) != SHARED_CACHE_FORMAT_VERSION:
+            return None
+
+        return long(meta['sequence'])
+
+    def by_rid(self, rid):
+        """
+        Tuple of (name, sid_name_use) for a RID, or None if it's not cached
+        """
+        return self._conn.execute(
+            "SELECT name, sid_name_use FROM principals WHERE rid = ?", (rid,),
+        ).fetchone()
+
+    def by_name(self, name):
+        """
+        Tuple of (rid, sid_name_use) for a name, or None if it's not cached
+        """
+        return self._conn.execute(
+            "SELECT rid, sid_name_use FROM principals WHERE lname = ?",
+            (name.lower(),),
+        ).fetchone()
+
+    def count(self, sid_name_use):
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM principals WHERE sid_name_use = ?",
+            (sid_name_use,),
+        ).fetchone()[0]
+
+    def page(self, sid_name_use, sort='rid', after=None, prefix=None,
+             limit=20, offset=0):
+        """
+        List of (rid, name) tuples of a type, in 'rid' or 'name' order,
+        after the given sort key (a RID, or a (lower case name, rid) tuple),
+        and optionally only those with names starting with prefix
+        """
+        where = ["sid_name_use = ?"]
+        params = [sid_name_use]
+        if prefix:
+            prefix = prefix.lower()
+            where.append("lname >= ? AND lname < ?")
+            params.extend((prefix, prefix + u'\uffff'))
+        if after is not None:
+            if sort == 'name':
+                where.append("(lname > ? OR (lname = ? AND rid > ?))")
+                params.extend((after[0], after[0], after[1]))
+            else:
+                where.append("rid > ?")
+                params.append(after)
+
+        order = "lname, rid" if sort == 'name' else "rid"
+        params.extend((limit, offset))
+        return self._conn.execute(
+            "SELECT rid, name FROM principals WHERE %s ORDER BY %s "
+            "LIMIT ? OFFSET ?" % (' AND '.join(where), order),
+            params,
+        ).fetchall()
+
+    def has_attrs(self, model_name, rid):
+        return self._conn.execute(
+            "SELECT 1 FROM attrs WHERE model = ? AND rid = ?",
+            (model_name, rid),
+        ).fetchone() is not None
+
+    def attrs(self, model_name, rid):
+        """
+        Attrs dict of all information class levels of an object, or None if
+        it's not cached
+        """
+        row = self._conn.execute(
+            "SELECT data FROM attrs WHERE model = ? AND rid = ?",
+            (model_name, rid),
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+
+class SharedCacheWriter(object):
+    """
+    Write side of the shared directory cache, used by the single leader
+    process that polls the domain. The first publish writes every user,
+    group and alias with its attrs. After that, whenever the domain sequence
+    number changes, only the differences found by a DomainScanner are
+    written. Each publish is a single transaction, so readers see either the
+    old contents or the new. Attrs rows are dropped for objects the scanner
+    couldn't check, and readers query the server for those
+    """
+    def __init__(self, path):
+        self.path = path
+        self.published_sequence = None
+        self._scanner = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SHARED_CACHE_SCHEMA)
+        return conn
+
+    def publish(self, domain):
+        """
+        Publish the domain if its sequence number has changed since it was
+        last published. Returns whether it had
+        """
+        sequence = domain.sequence_num
+        if sequence == self.published_sequence:
+            return False
+
+        if self._scanner is None or self._scanner.domain is not domain:
+            self._scanner = DomainScanner(domain, track_all=True)
+        scanner = self._scanner
+        full = scanner.state is None
+
+        start = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                if full:
+                    for table in ('meta', 'principals', 'attrs'):
+                        conn.execute("DELETE FROM %s" % table)
+
+                def attrs_loaded(_, obj):
+                    # Written as they're loaded, rather than kept until the
+                    # scan is done
+                    conn.execute(
+                        "INSERT OR REPLACE INTO attrs (model, rid, data) "
+                        "VALUES (?, ?, ?)",
+                        (obj.__class__.__name__, obj.rid,
+                         json.dumps(picklable_attrs(obj.attrs))),
+                    )
+
+                changes = scanner.scan(sequence, attrs_loaded)
+                if full:
+                    written = len(scanner.state)
+                    conn.executemany(
+                        "INSERT INTO principals (rid, name, lname, "
+                        "sid_name_use) VALUES (?, ?, ?, ?)",
+                        (
+                            (rid, name, name.lower(),
+                             MODELS_BY_TYPE_NAME[type_name].sid_name_use)
+                            for (type_name, rid), (name, _, _)
+                            in scanner.state.items()
+                        ),
+                    )
+                else:
+                    written = len(changes)
+                    self._apply_changes(conn, changes, scanner.untracked)
+
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    (
+                        ('version', str(SHARED_CACHE_FORMAT_VERSION)),
+                        ('domain_sid', str(domain.sid_obj)),
+                        ('sequence', str(sequence)),
+                        ('published_time', str(time.time())),
+                    ),
+                )
+        except Exception:
+            # The scanner's state may be ahead of the file, so start over
+            self._scanner = None
+            raise
+        finally:
+            conn.close()
+
+        self.published_sequence = sequence
+        logging.info("Published shared cache %s at sequence %d in %.3fs: "
+                     "%d principals %s", self.path, sequence,
+                     time.time() - start, written,
+                     "written" if full else "changed")
+        return True
+
+    def _apply_changes(self, conn, changes, untracked):
+        """
+        Write the changes found by a scan, and drop the attrs of objects
+        that stopped being tracked
+        """
+        for change in changes:
+            model_cls = MODELS_BY_TYPE_NAME[change['type']]
+            if change['change'] == 'removed':
+                conn.execute("DELETE FROM principals WHERE rid = ?",
+                             (change['rid'],))
+                conn.execute("DELETE FROM attrs WHERE model = ? AND rid = ?",
+                             (model_cls.__name__, change['rid']))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO principals (rid, name, lname, "
+                    "sid_name_use) VALUES (?, ?, ?, ?)",
+                    (change['rid'], change['name'], change['name'].lower(),
+                     model_cls.sid_name_use),
+                )
+
+        conn.executemany(
+            "DELETE FROM attrs WHERE model = ? AND rid = ?",
+            (
+                (MODELS_BY_TYPE_NAME[type_name].__name__, rid)
+                for type_name, rid in untracked
+            ),
+        )
+
+    def run(self, domain, interval, stopping):
+        """
+        Publish the domain every interval seconds, until the stopping event
+        is set
+        """
+        while not stopping.is_set():
+            try:
+                with domain.samr_handle.connection():
+                    self.publish(domain)
+            except Exception:
+                logging.exception("Error publishing shared cache %s",
+                                  self.path)
+
+            stopping.wait(interval)
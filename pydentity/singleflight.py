@@ -0,0 +1,95 @@
+import logging
+import threading
+
+from pydentity.metrics import SAMR_COALESCED
+
+class FlightCall(object):
+    """
+    A call in flight, and its outcome once it's done
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent calls: while a call for a key is in
+    flight, other callers with the same key wait for it and share its result
+    or exception, rather than making the call again. Keys must include
+    anything that would make the results differ, such as the domain sequence
+    number
+    """
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def do(self, op, key, func, timeout=None):
+        """
+        Return func(), or the result of a call in flight for the same key.
+        Waiters that give up after timeout seconds (default self.timeout)
+        make the call themselves
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = FlightCall()
+                self.calls += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if leader:
+            return self._lead(key, call, func)
+
+        SAMR_COALESCED.inc(op=op)
+        if timeout is None:
+            timeout = self.timeout
+        if not call.done.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+            logging.warning("Gave up waiting %.1fs for in flight %s call",
+                            timeout, op)
+            return func()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+    def _lead(self, key, call, func):
+        """
+        Make the call for a key, and hand its outcome to any waiters
+        """
+        try:
+            call.result = func()
+            return call.result
+        except Exception as exc:
+            call.error = exc
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+                'in_flight': len(self._calls),
+            }
@@ -0,0 +1,212 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from pydentity.models.samba_ import picklable_attrs
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS principals (
+    rid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    sid_name_use INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS complete_types (
+    sid_name_use INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS attrs (
+    position INTEGER PRIMARY KEY,
+    model TEXT NOT NULL,
+    rid INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS membership (
+    relation TEXT NOT NULL,
+    node TEXT NOT NULL,
+    nodes TEXT NOT NULL
+);
+"""
+
+def node_tuple(node):
+    """
+    Membership node from its JSON form
+    """
+    return tuple(node)
+
+class Snapshot(object):
+    """
+    SQLite file holding a domain's name index, attr cache and membership
+    index, with the sequence number they were read at. Loading a snapshot
+    that's still current for the domain warms the caches without any SAMR
+    calls beyond the sequence number check
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._autosave_thread = None
+
+        self.saved_sequence = None
+        self.saved_time = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript(SNAPSHOT_SCHEMA)
+        return conn
+
+    def load(self, domain):
+        """
+        Load the snapshot into the domain's caches if it was taken at the
+        domain's current sequence number. Returns whether it was loaded
+        """
+        start = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                meta = dict(conn.execute("SELECT key, value FROM meta"))
+                if not meta:
+                    logging.info("Snapshot %s is empty", self.path)
+                    return False
+
+                if int(meta['version']) != SNAPSHOT_FORMAT_VERSION or \
+                        meta['domain_sid'] != str(domain.sid_obj):
+                    logging.info("Snapshot %s is for a different domain or "
+                                 "version", self.path)
+                    return False
+
+                sequence = long(meta['sequence'])
+                if sequence != domain.sequence_num:
+                    logging.info("Snapshot %s is out of date (sequence %d, "
+                                 "domain is at %d)",
+                                 self.path, sequence, domain.sequence_num)
+                    return False
+
+                principals = conn.execute(
+                    "SELECT rid, name, sid_name_use FROM principals"
+                ).fetchall()
+                complete_types = [
+                    sid_name_use for sid_name_use, in
+                    conn.execute("SELECT sid_name_use FROM complete_types")
+                ]
+                attrs = [
+                    ((model, rid, level), json.loads(data))
+                    for model, rid, level, data in conn.execute(
+                        "SELECT model, rid, level, data FROM attrs "
+                        "ORDER BY position"
+                    )
+                ]
+                membership = [
+                    (relation, node_tuple(json.loads(node)),
+                     [node_tuple(member) for member in json.loads(nodes)])
+                    for relation, node, nodes in conn.execute(
+                        "SELECT relation, node, nodes FROM membership"
+                    )
+                ]
+            finally:
+                conn.close()
+
+        loaded = (
+            domain.name_index.load(principals, complete_types, sequence) and
+            domain.attr_cache.load(attrs, sequence) and
+            domain.membership.load(membership, sequence)
+        )
+        if loaded:
+            self.saved_sequence = sequence
+            logging.info("Loaded snapshot %s in %.3fs: %d principals, %d "
+                         "attribute sets, %d memberships",
+                         self.path, time.time() - start, len(principals),
+                         len(attrs), len(membership))
+
+        return loaded
+
+    def save(self, domain):
+        """
+        Write the domain's caches to the snapshot, if they're all valid for
+        the same sequence number. Returns whether it was written
+        """
+        attr_sequence, attrs = domain.attr_cache.dump()
+        index_sequence, principals, complete_types = domain.name_index.dump()
+        membership_sequence, membership = domain.membership.dump()
+        if attr_sequence is None or \
+                not attr_sequence == index_sequence == membership_sequence:
+            return False
+
+        start = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    for table in ('meta', 'principals', 'complete_types',
+                                  'attrs', 'membership'):
+                        conn.execute("DELETE FROM %s" % table)
+
+                    conn.executemany(
+                        "INSERT INTO meta (key, value) VALUES (?, ?)",
+                        (
+                            ('version', str(SNAPSHOT_FORMAT_VERSION)),
+                            ('domain_sid', str(domain.sid_obj)),
+                            ('sequence', str(attr_sequence)),
+                            ('saved_time', str(time.time())),
+                        ),
+                    )
+                    conn.executemany(
+                        "INSERT INTO principals (rid, name, sid_name_use) "
+                        "VALUES (?, ?, ?)",
+                        principals,
+                    )
+                    conn.executemany(
+                        "INSERT INTO complete_types (sid_name_use) "
+                        "VALUES (?)",
+                        ((sid_name_use,) for sid_name_use in complete_types),
+                    )
+                    conn.executemany(
+                        "INSERT INTO attrs (position, model, rid, level, "
+                        "data) VALUES (?, ?, ?, ?, ?)",
+                        (
+                            (position, model, rid, level,
+                             json.dumps(picklable_attrs(value)))
+                            for position, ((model, rid, level), value)
+                            in enumerate(attrs)
+                        ),
+                    )
+                    conn.executemany(
+                        "INSERT INTO membership (relation, node, nodes) "
+                        "VALUES (?, ?, ?)",
+                        (
+                            (relation, json.dumps(node), json.dumps(nodes))
+                            for relation, node, nodes in membership
+                        ),
+                    )
+            finally:
+                conn.close()
+
+        self.saved_sequence = attr_sequence
+        self.saved_time = time.time()
+        logging.info("Saved snapshot %s in %.3fs", self.path,
+                     self.saved_time - start)
+        return True
+
+    def start_autosave(self, domain, interval):
+        """
+        Save the snapshot every interval seconds from a daemon thread
+        """
+        def autosave():
+            while True:
+                time.sleep(interval)
+                try:
+                    with domain.samr_handle.connection():
+                        self.save(domain)
+                except Exception:
+                    logging.exception("Error saving snapshot %s", self.path)
+
+        self._autosave_thread = threading.Thread(target=autosave,
+                                                 name='snapshot-autosave')
+        self._autosave_thread.daemon = True
+        self._autosave_thread.start()
@@ -3,17 +3,43 @@ var pydentity = angular.module('pydentity', []);
 pydentity.controller('ObjectsListController', function ($scope, $http) {
     $scope.load_endpoint = function(endpoint) {
         $scope.endpoint = endpoint
-        $http.get('/api/v1/' + endpoint).success(function(data) {
+        $scope.load()
+    }
+    $scope.load = function() {
+        $scope.loading = true
+        // The display list has description columns in bulk, but is only in
+        // RID order
+        var params = {expand: 'display'}
+        if ($scope.orderProp != 'rid' || $scope.query) {
+            params = {
+                expand: 'attrs',
+                sort: $scope.orderProp,
+                q: $scope.query || undefined
+            }
+        }
+        $http.get('/api/v1/' + $scope.endpoint, {params: params}).success(function(data) {
             $scope.loading = false
             $scope.objects = data.objects;
         });
     }
-    $scope.load_detail = function(rid, url) {
-        $http.get(url).success(function(data) {
+    $scope.set_order = function(prop) {
+        $scope.orderProp = prop
+        $scope.load()
+    }
+    $scope.load_detail = function(object) {
+        if (object.attrs) {
+            $scope.detail = angular.extend({}, object.attrs, {
+                rid: object.rid,
+                name: object.name
+            })
+            return
+        }
+        $http.get(object.detail).success(function(data) {
             $scope.detail = data
         });
     }
     $scope.orderProp = 'rid'
+    $scope.query = ''
     $scope.loading = true
     $scope.detail = null
 })
@@ -0,0 +1,436 @@
+import base64
+import binascii
+import fcntl
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import (
+    decode_dss_signature,
+    encode_dss_signature,
+)
+
+TOKEN_ALGORITHM = 'ES256'
+TOKEN_CURVE = ec.SECP256R1
+# Bytes in each of the two integers of an ES256 signature, and in each
+# coordinate of a published public key
+TOKEN_INT_BYTES = 32
+KEY_ID_BYTES = 8
+
+class BadToken(Exception):
+    """
+    Token that's malformed, or wasn't signed by a current key
+    """
+
+class TokenExpired(BadToken):
+    """
+    Token that was signed by a current key, but has expired
+    """
+
+
+def b64url_encode(data):
+    """
+    Unpadded URL safe base64 of bytes, as text
+    """
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def b64url_decode(text):
+    """
+    Bytes of unpadded URL safe base64 text. Raises BadToken if it's
+    malformed
+    """
+    try:
+        data = text.encode('ascii')
+        return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+    except (TypeError, ValueError, binascii.Error):
+        raise BadToken("Malformed token")
+
+def int_bytes(value):
+    """
+    Big endian TOKEN_INT_BYTES bytes of a non-negative int
+    """
+    return binascii.unhexlify('%0*x' % (TOKEN_INT_BYTES * 2, value))
+
+def bytes_int(data):
+    return int(binascii.hexlify(data), 16)
+
+def json_segment(data):
+    return b64url_encode(json.dumps(data, sort_keys=True,
+                                    separators=(',', ':')).encode('utf-8'))
+
+class TokenKey(object):
+    """
+    An ECDSA P-256 private key identity tokens are signed with, and its key
+    ID. Only its public key is published
+    """
+    def __init__(self, kid, private_key, created):
+        self.kid = kid
+        self.private_key = private_key
+        self.created = created
+
+    @classmethod
+    def generate(cls):
+        return cls(binascii.hexlify(os.urandom(KEY_ID_BYTES)).decode('ascii'),
+                   ec.generate_private_key(TOKEN_CURVE(), default_backend()),
+                   int(time.time()))
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(
+            data['kid'],
+            serialization.load_pem_private_key(
+                data['private_key'].encode('ascii'), None, default_backend(),
+            ),
+            data['created'],
+        )
+
+    def data(self):
+        return {
+            'kid': self.kid,
+            'private_key': self.private_key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            ).decode('ascii'),
+            'created': self.created,
+        }
+
+    def sign(self, claims):
+        """
+        Compact JWS of a claims dict
+        """
+        signing_input = '%s.%s' % (
+            json_segment({'alg': TOKEN_ALGORITHM, 'typ': 'JWT',
+                          'kid': self.kid}),
+            json_segment(claims),
+        )
+        r, s = decode_dss_signature(self.private_key.sign(
+            signing_input.encode('ascii'), ec.ECDSA(hashes.SHA256()),
+        ))
+        return '%s.%s' % (signing_input,
+                          b64url_encode(int_bytes(r) + int_bytes(s)))
+
+    def verify_signature(self, signing_input, signature):
+        """
+        Raise BadToken unless signature is this key's over signing_input
+        """
+        if len(signature) != TOKEN_INT_BYTES * 2:
+            raise BadToken("Malformed token signature")
+
+        try:
+            self.private_key.public_key().verify(
+                encode_dss_signature(bytes_int(signature[:TOKEN_INT_BYTES]),
+                                     bytes_int(signature[TOKEN_INT_BYTES:])),
+                signing_input.encode('ascii'),
+                ec.ECDSA(hashes.SHA256()),
+            )
+        except InvalidSignature:
+            raise BadToken("Token signature doesn't match")
+
+    def public_jwk(self):
+        """
+        JSON Web Key dict of the public key
+        """
+        numbers = self.private_key.public_key().public_numbers()
+        return {
+            'kty': 'EC',
+            'crv': 'P-256',
+            'x': b64url_encode(int_bytes(numbers.x)),
+            'y': b64url_encode(int_bytes(numbers.y)),
+        }
+
+
+def split_token(token):
+    """
+    Tuple of the unverified header dict, signing input, claims segment and
+    signature bytes of a compact JWS
+    """
+    parts = token.split('.')
+    if len(parts) != 3:
+        raise BadToken("Malformed token")
+
+    try:
+        header = json.loads(b64url_decode(parts[0]).decode('utf-8'))
+    except ValueError:
+        raise BadToken("Malformed token header")
+
+    if not isinstance(header, dict):
+        raise BadToken("Malformed token header")
+
+    return (header, '%s.%s' % (parts[0], parts[1]), parts[1],
+            b64url_decode(parts[2]))
+
+class TokenClients(object):
+    """
+    Clients trusted to get identity tokens for any user, kept in a JSON file
+    of client IDs and the SHA-256 hex digests of their secrets:
+    {"clients": {"<id>": "<digest>"}}. The file is reloaded when it changes
+    """
+    def __init__(self, path):
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._mtime = None
+
+        self.authenticated = 0
+        self.refused = 0
+
+        # Fail at startup, rather than on the first request, if it's missing
+        self._load()
+
+    def _load(self):
+        """
+        Reload the clients if the file has changed. Must hold the lock
+        """
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return
+
+        with open(self.path) as handle:
+            self._digests = json.load(handle)['clients']
+        self._mtime = mtime
+
+    def authenticate(self, client_id, secret):
+        """
+        Whether a client ID and secret belong to a trusted client
+        """
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+
+        digest = hashlib.sha256(secret).hexdigest()
+        with self._lock:
+            self._load()
+            expected = self._digests.get(client_id)
+            # Compared in constant time, so the digest can't be guessed a
+            # character at a time
+            ok = expected is not None and \
+                hmac.compare_digest(expected.encode('ascii'),
+                                    digest.encode('ascii'))
+            if ok:
+                self.authenticated += 1
+            else:
+                self.refused += 1
+
+        return ok
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._digests),
+                'authenticated': self.authenticated,
+                'refused': self.refused,
+            }
+
+
+class TokenKeySet(object):
+    """
+    Private keys for signing and verifying identity tokens, kept in a JSON
+    file readable only by this user; relying services verify tokens locally
+    with the published public keys. The newest key signs until it's
+    rotate_interval seconds old, when a new one is generated; older keys are
+    kept until every token they signed has expired. The file is shared by
+    all processes using it, and reloaded when it changes
+    """
+    def __init__(self, path, token_ttl=300, rotate_interval=86400):
+        self.path = path
+        self.token_ttl = token_ttl
+        self.rotate_interval = rotate_interval
+
+        self._lock = threading.Lock()
+        self._keys = []
+        self._mtime = None
+
+        self.issued = 0
+        self.verified = 0
+        self.rejected = 0
+        self.rotations = 0
+
+    def _load(self):
+        """
+        Reload the keys if the file has changed. Must hold the lock
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self._keys = []
+            self._mtime = None
+            return
+
+        if mtime == self._mtime:
+            return
+
+        with open(self.path) as handle:
+            data = json.load(handle)
+
+        self._keys = sorted(
+            # HMAC secrets from older versions can't sign ES256 tokens, so
+            # they're dropped, and replaced at the next rotation
+            (TokenKey.from_data(key) for key in data['keys']
+             if 'private_key' in key),
+            key=lambda key: key.created,
+            reverse=True,
+        )
+        self._mtime = mtime
+
+    def _save(self):
+        """
+        Atomically replace the file with the current keys, readable only by
+        this user. Must hold the lock
+        """
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as handle:
+            json.dump({'keys': [key.data() for key in self._keys]}, handle)
+        os.rename(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime
+
+    def _retire_after(self):
+        """
+        Seconds after a key is created that tokens it signed may be valid
+        """
+        return self.rotate_interval + self.token_ttl
+
+    def _needs_rotation(self, now):
+        return not self._keys or \
+            now - self._keys[0].created >= self.rotate_interval
+
+    def _rotate(self, now):
+        """
+        Add a new signing key and drop retired ones, unless another process
+        already has. Must hold the lock
+        """
+        with open('%s.lock' % self.path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another process may have rotated while we waited
+                self._load()
+                if not self._needs_rotation(now):
+                    return
+
+                self._keys.insert(0, TokenKey.generate())
+                self._keys = [
+                    key for key in self._keys
+                    if now - key.created < self._retire_after()
+                ]
+                self._save()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self.rotations += 1
+        logging.info("Rotated identity token keys in %s; signing with %s",
+                     self.path, self._keys[0].kid)
+
+    def signing_key(self):
+        """
+        Current key to sign tokens with, rotating if it's due
+        """
+        now = time.time()
+        with self._lock:
+            self._load()
+            if self._needs_rotation(now):
+                self._rotate(now)
+
+            return self._keys[0]
+
+    def keys(self):
+        """
+        List of the keys tokens may currently be signed with, newest first
+        """
+        with self._lock:
+            self._load()
+            return list(self._keys)
+
+    def issue(self, claims):
+        """
+        Tuple of a signed token for the claims dict, and the key it was
+        signed with. The token expires after token_ttl seconds
+        """
+        key = self.signing_key()
+        now = int(time.time())
+        token = key.sign(dict(claims, iat=now, exp=now + self.token_ttl))
+        with self._lock:
+            self.issued += 1
+
+        return token, key
+
+    def verify(self, token):
+        """
+        Claims dict of a token. Raises BadToken if it wasn't signed by a
+        current key, and TokenExpired (a subclass) if it has expired
+        """
+        try:
+            header, signing_input, claims_segment, signature = \
+                split_token(token)
+            if header.get('alg') != TOKEN_ALGORITHM:
+                raise BadToken("Unsupported algorithm %r" %
+                                   (header.get('alg'),))
+
+            kid = header.get('kid')
+            key = None
+            with self._lock:
+                self._load()
+                for candidate in self._keys:
+                    if candidate.kid == kid:
+                        key = candidate
+                        break
+
+            if key is None:
+                raise BadToken("Unknown key ID %r" % (kid,))
+
+            key.verify_signature(signing_input, signature)
+            try:
+                claims = json.loads(b64url_decode(claims_segment)
+                                    .decode('utf-8'))
+            except ValueError:
+                raise BadToken("Malformed token claims")
+            if not isinstance(claims, dict) or \
+                    not isinstance(claims.get('exp'), (int, long)):
+                raise BadToken("Malformed token claims")
+            if claims['exp'] <= time.time():
+                raise TokenExpired("Token expired at %d" % claims['exp'])
+        except BadToken:
+            with self._lock:
+                self.rejected += 1
+            raise
+
+        with self._lock:
+            self.verified += 1
+
+        return claims
+
+    def published(self):
+        """
+        Verification key set: each key's public JSON Web Key, and the times
+        it signs until and tokens it signed are valid until
+        """
+        return [
+            dict(
+                key.public_jwk(),
+                kid=key.kid,
+                alg=TOKEN_ALGORITHM,
+                use='sig',
+                created=key.created,
+                signs_until=key.created + self.rotate_interval,
+                verifies_until=key.created + self._retire_after(),
+            )
+            for key in self.keys()
+        ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._keys),
+                'issued': self.issued,
+                'verified': self.verified,
+                'rejected': self.rejected,
+                'rotations': self.rotations,
+            }
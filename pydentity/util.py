@@ -1,4 +1,41 @@
 import re
+import zlib
 
 SYSTEM_PROPERTY_RE = re.compile(r'^__(.+)__$')
 SIMPLE_PRINTABLE_TYPES = (str, unicode, int, long, float)
+
+# Seconds between the NTTIME epoch (1601-01-01) and the Unix epoch
+NTTIME_EPOCH_OFFSET = 11644473600
+
+def nttime_to_timestamp(value):
+    """
+    Convert an NTTIME (100ns intervals since 1601) to a Unix timestamp
+    """
+    return value / 10000000.0 - NTTIME_EPOCH_OFFSET
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most size items, lazily
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def gzip_iter(chunks, level=6):
+    """
+    Gzip compress an iterable of string chunks, lazily. Output is flushed
+    after each chunk so that streamed responses aren't held up
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+
+    yield compressor.flush()
@@ -0,0 +1,283 @@
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+
+from contextlib import contextmanager
+
+from six.moves import queue
+
+from pydentity.metrics import timed_call
+from pydentity.models.samba_ import Domain, MODELS_BY_NAME
+from pydentity.samba_util import SAMRHandle
+
+# Most requests a worker takes from the queue at once
+WORKER_BATCH_SIZE = 32
+# How often the broker checks for dead workers
+WORKER_CHECK_INTERVAL = 1
+
+def remote_method(obj, method_name):
+    """
+    The decorated model method, and its result filter, that a remote call to
+    method_name on obj refers to. Overrides that aren't remote themselves
+    (such as cache layers) are skipped, since the caller already ran them
+    """
+    for cls in type(obj).__mro__:
+        attr = cls.__dict__.get(method_name)
+        if attr is not None and hasattr(attr, 'remote_method'):
+            return attr.remote_method, attr.result_filter
+
+    raise AttributeError("%s has no remote method %s" % (
+        type(obj).__name__, method_name,
+    ))
+
+def picklable_error(ex):
+    """
+    An exception that can be sent back to the broker in place of ex. Samba
+    RPC errors keep their (NTSTATUS, message) args
+    """
+    if isinstance(ex, RuntimeError):
+        return RuntimeError(*ex.args)
+
+    return RuntimeError("%s: %s" % (ex.__class__.__name__, ex))
+
+def worker_main(conf_file, domain_name, requests, responses, batch_size):
+    """
+    SAMR worker process main loop. Requests are taken from the queue in
+    batches, and run grouped by method so that consecutive calls of the same
+    kind reuse handles and stay warm. Requests may be for any domain on the
+    server; domain_name is the one opened first
+    """
+    samr_handle = SAMRHandle(conf_file=conf_file)
+    domains = {domain_name: Domain(domain_name, samr_handle)}
+    running = True
+    while running:
+        batch = [requests.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(requests.get_nowait())
+            except queue.Empty:
+                break
+
+        if None in batch:
+            running = False
+            batch = [request for request in batch if request is not None]
+
+        batch.sort(key=lambda request: request[2])
+        for request_id, ref, method_name, args in batch:
+            try:
+                ref_domain_name, model_name, rid = ref
+                domain = domains.get(ref_domain_name)
+                if domain is None:
+                    domain = domains[ref_domain_name] = \
+                        Domain(ref_domain_name, samr_handle)
+
+                if model_name == 'Domain':
+                    obj = domain
+                else:
+                    obj = MODELS_BY_NAME[model_name](domain, rid)
+
+                method, result_filter = remote_method(obj, method_name)
+                result = method(obj, *args)
+                if result_filter is not None:
+                    result = result_filter(result)
+
+                responses.put((request_id, True, result))
+
+            except Exception as ex:
+                responses.put((request_id, False, picklable_error(ex)))
+
+    samr_handle.close()
+
+
+class PendingCall(object):
+    """
+    A call waiting for its response from a worker
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.ok = None
+        self.result = None
+
+
+class SAMRWorkerPool(object):
+    """
+    Broker for SAMR calls made by worker processes, each with its own
+    connection and handles. Calls from any number of threads are pipelined
+    through a shared request queue, and responses are dispatched back to the
+    waiting threads
+    """
+    def __init__(self,
+                 conf_file,
+                 domain_name,
+                 processes=4,
+                 batch_size=WORKER_BATCH_SIZE,
+                 timeout=60,
+                 slow_call_secs=None):
+        self.conf_file = conf_file
+        self.domain_name = domain_name
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.slow_call_secs = slow_call_secs
+
+        self._requests = multiprocessing.Queue()
+        self._responses = multiprocessing.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending = {}
+        self._closed = False
+
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+        self._processes = [self._start_worker() for _ in range(processes)]
+
+        self._reader = threading.Thread(target=self._read_responses,
+                                        name="samr-broker")
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _start_worker(self):
+        process = multiprocessing.Process(
+            target=worker_main,
+            args=(self.conf_file,
+                  self.domain_name,
+                  self._requests,
+                  self._responses,
+                  self.batch_size),
+        )
+        process.daemon = True
+        process.start()
+        return process
+
+    def call(self, ref, method_name, args):
+        """
+        Run a remote model method in a worker, and return its result. Metrics
+        are recorded for the whole round trip, under the method name
+        """
+        return timed_call(method_name, self._call, (ref, method_name, args),
+                          {}, self.slow_call_secs)
+
+    def _call(self, ref, method_name, args):
+        pending = PendingCall()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = pending
+            self.calls += 1
+
+        self._requests.put((request_id, ref, method_name, tuple(args)))
+
+        if not pending.event.wait(self.timeout):
+            with self._lock:
+                self._pending.pop(request_id, None)
+                self.timeouts += 1
+            raise RuntimeError("SAMR worker call %s timed out" % method_name)
+
+        if not pending.ok:
+            raise pending.result
+
+        return pending.result
+
+    def _read_responses(self):
+        last_checked = time.time()
+        while True:
+            try:
+                response = self._responses.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                response = ()
+
+            if response is None:
+                break
+
+            if response:
+                request_id, ok, result = response
+                with self._lock:
+                    pending = self._pending.pop(request_id, None)
+                    if not ok:
+                        self.errors += 1
+
+                if pending is not None:
+                    pending.ok = ok
+                    pending.result = result
+                    pending.event.set()
+
+            if time.time() - last_checked >= WORKER_CHECK_INTERVAL:
+                self._check_workers()
+                last_checked = time.time()
+
+    def _check_workers(self):
+        """
+        Restart any workers that have died. Calls they were running time out
+        """
+        if self._closed:
+            return
+
+        for idx, process in enumerate(self._processes):
+            if not process.is_alive():
+                logging.warning("SAMR worker %d exited with %s; restarting",
+                                process.pid, process.exitcode)
+                self._processes[idx] = self._start_worker()
+                self.restarts += 1
+
+    def close(self):
+        """
+        Stop the workers once they've finished queued requests
+        """
+        self._closed = True
+        for _ in self._processes:
+            self._requests.put(None)
+        for process in self._processes:
+            process.join(self.timeout)
+
+        self._responses.put(None)
+
+    def stats(self):
+        """
+        Dict of broker statistics
+        """
+        return {
+            'processes': len(self._processes),
+            'in_flight': len(self._pending),
+            'calls': self.calls,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'restarts': self.restarts,
+        }
+
+
+class RemoteSAMRHandle(object):
+    """
+    Stands in for the app's SAMRHandlePool when SAMR calls are made by a
+    SAMRWorkerPool. There are no connections to check out in this process
+    """
+    def __init__(self, worker_pool):
+        self.worker_pool = worker_pool
+
+    def acquire(self):
+        return self
+    def release(self, failed=False):
+        pass
+
+    @property
+    def acquired(self):
+        return False
+
+    @contextmanager
+    def connection(self):
+        yield self
+    @contextmanager
+    def spare_connection(self):
+        yield self
+
+    @property
+    def connection_obj(self):
+        raise RuntimeError("SAMR calls are made by worker processes")
+
+    def close(self):
+        self.worker_pool.close()
+
+    def stats(self):
+        return self.worker_pool.stats()
@@ -0,0 +1,95 @@
+import pytest
+
+@pytest.fixture
+def fake_domain():
+    from bench.fake_samr import FakeDomain
+    return FakeDomain(users=200, seed=0)
+
+@pytest.fixture
+def make_domain(request, fake_domain):
+    """
+    Factory for Domain models over a pool of FakeSAMR connections to
+    fake_domain. make.calls(name) counts the SAMR calls made
+    """
+    from bench.fake_samr import FakeSAMR
+    from pydentity.models.samba_ import Domain
+    from pydentity.samba_util import SAMRHandlePool
+
+    pools = []
+    connections = []
+
+    def make(size=4, checkout_timeout=30, latency=0, **kwargs):
+        def connect(_):
+            connection_obj = FakeSAMR(fake_domain, latency=latency)
+            connections.append(connection_obj)
+            return connection_obj
+
+        pool = SAMRHandlePool(
+            None,
+            size=size,
+            checkout_timeout=checkout_timeout,
+            connection_factory=connect,
+        )
+        pools.append(pool)
+        return Domain(fake_domain.name, pool, **kwargs)
+
+    def calls(name):
+        """
+        Calls of a SAMR function made so far, over every connection
+        """
+        return sum(connection_obj.calls[name]
+                   for connection_obj in connections)
+
+    make.calls = calls
+
+    def close_pools():
+        for pool in pools:
+            pool.close()
+
+    request.addfinalizer(close_pools)
+    return make
+
+@pytest.fixture(scope='session')
+def api(request):
+    """
+    Flask test client for the API, served from its own fake domain, which is
+    the client's fake_domain attribute. The app is set up once per session
+    """
+    pytest.importorskip('flask')
+    from pydentity import server
+    from bench.fake_samr import FakeDomain, FakeSAMR
+
+    fake_domain = FakeDomain(users=200, seed=1)
+    server.setup_samba({
+        'smbconf': None,
+        'smbdomain': fake_domain.name,
+        'samr_pool_size': 4,
+        'samr_pool_timeout': 30,
+        'samr_workers': 0,
+        'handle_cache_size': 1024,
+        'handle_cache_ttl': 300,
+        'attr_cache_size': 65536,
+        'sequence_poll_interval': 0,
+        'expand_concurrency': 4,
+        'coalesce_timeout': 30,
+        'etag_mode': 'domain',
+        'slow_call_ms': 0,
+        'snapshot': None,
+        'snapshot_interval': 0,
+        'change_watch_interval': 0,
+        'change_log_size': 0,
+        'shared_cache': None,
+        'token_key_file': None,
+        'token_client_file': None,
+        'discover_domains': False,
+        'allow_writes': False,
+        'write_concurrency': 4,
+        'writer_client_file': None,
+        'max_write_defer': 30,
+    }, connection_factory=lambda _: FakeSAMR(fake_domain))
+    server.add_api_resources(None)
+    request.addfinalizer(server.APP.samr_handle.close)
+
+    client = server.APP.test_client()
+    client.fake_domain = fake_domain
+    return client
@@ -0,0 +1,145 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('samba.dcerpc.samr')
+
+from bench.fake_samr import lsa_string
+from pydentity.batch import run_batch
+from pydentity.models.samba_ import User
+
+@pytest.fixture
+def domain(make_domain):
+    return make_domain(sequence_poll_interval=0)
+
+def batch(domain, items):
+    with domain.samr_handle.connection():
+        return run_batch(domain, items)
+
+def test_failures_are_reported_per_item(domain, fake_domain):
+    user_rid = fake_domain.rids['User'][0]
+    group_rid = fake_domain.rids['Group'][0]
+    results = batch(domain, [
+        {'id': 'new', 'op': 'create_user', 'name': u'newuser',
+         'groups': [group_rid]},
+        {'id': 'taken', 'op': 'create_user', 'name': u'user1'},
+        {'op': 'set_user', 'rid': user_rid,
+         'attrs': {'description': u'updated'}},
+        {'op': 'set_user', 'rid': 999999, 'attrs': {'description': u'x'}},
+        {'op': 'set_user', 'rid': user_rid, 'attrs': {'sid': u'x'}},
+        {'op': 'explode'},
+        'not an object',
+    ])
+
+    assert [result['index'] for result in results] == list(range(7))
+    assert [result['status'] for result in results] == [
+        201, 409, 200, 404, 400, 400, 400,
+    ]
+    assert results[0]['id'] == 'new'
+    assert results[1]['id'] == 'taken'
+    assert results[1]['ntstatus'] == '0xC0000063'
+    assert 'error' not in results[2]
+
+    new_rid = results[0]['rid']
+    assert fake_domain.objects[new_rid] == ('User', u'newuser')
+    assert new_rid in fake_domain.group_members[group_rid]
+
+def test_writes_rebase_caches(domain, make_domain, fake_domain):
+    user_rid, other_rid = fake_domain.rids['User'][:2]
+    with domain.samr_handle.connection():
+        User(domain, user_rid).attrs_for(('description',))
+        User(domain, other_rid).attrs_for(('description',))
+        sequence = domain.sequence_num
+
+    batch(domain, [{'op': 'set_user', 'rid': user_rid,
+                    'attrs': {'description': u'updated'}}])
+    queries = make_domain.calls('QueryUserInfo')
+
+    with domain.samr_handle.connection():
+        assert domain.sequence_num == sequence + 1
+        assert User(domain, user_rid).attrs_for(
+            ('description',))['description'] == u'updated'
+        User(domain, other_rid).attrs_for(('description',))
+
+    assert make_domain.calls('QueryUserInfo') == queries
+
+def test_outside_changes_flush_caches(domain, make_domain, fake_domain):
+    user_rid, other_rid = fake_domain.rids['User'][:2]
+    with domain.samr_handle.connection():
+        User(domain, other_rid).attrs_for(('description',))
+
+    items = [{'op': 'set_user', 'rid': user_rid,
+              'attrs': {'description': u'updated'}}]
+    with domain.samr_handle.connection():
+        with domain.writing():
+            fake_domain.modify()
+            run_batch(domain, items)
+    queries = make_domain.calls('QueryUserInfo')
+
+    with domain.samr_handle.connection():
+        User(domain, other_rid).attrs_for(('description',))
+
+    assert make_domain.calls('QueryUserInfo') > queries
+
+def test_sequence_is_queried_without_the_write_lock(domain):
+    query_sequence = domain._query_sequence
+    locked = []
+
+    def checked_query():
+        acquired = domain._write_lock.acquire(False)
+        if acquired:
+            domain._write_lock.release()
+        locked.append(not acquired)
+        return query_sequence()
+
+    domain._query_sequence = checked_query
+    with domain.samr_handle.connection():
+        with domain.writing():
+            pass
+
+    assert locked == [False, False]
+
+def test_stuck_writes_only_defer_polls_for_a_while(make_domain, fake_domain):
+    domain = make_domain(sequence_poll_interval=0, max_write_defer=0.2)
+    rid = fake_domain.rids['User'][0]
+
+    def description():
+        return User(domain, rid).attrs_for(('description',))['description']
+
+    with domain.samr_handle.connection():
+        with domain.writing():
+            original = description()
+            fake_domain.overrides[rid]['description'] = lsa_string(u'changed')
+            fake_domain.sequence += 1
+            assert description() == original
+
+            time.sleep(0.3)
+            assert description() == u'changed'
+
+def test_batches_finish_with_every_other_connection_held(make_domain,
+                                                         fake_domain):
+    domain = make_domain(size=2, checkout_timeout=1, write_concurrency=4)
+    rids = fake_domain.rids['User'][:8]
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with domain.samr_handle.connection():
+            holding.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    try:
+        holding.wait(10)
+        results = batch(domain, [
+            {'op': 'set_user', 'rid': rid,
+             'attrs': {'description': u'batch %d' % rid}}
+            for rid in rids
+        ])
+    finally:
+        release.set()
+        holder.join()
+
+    assert [result['status'] for result in results] == [200] * len(rids)
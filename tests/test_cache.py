@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip('samba.dcerpc.samr')
+
+from bench.fake_samr import lsa_string
+from pydentity.models.samba_ import User
+
+@pytest.fixture
+def domain(make_domain):
+    return make_domain(sequence_poll_interval=0)
+
+def description(domain, rid):
+    with domain.samr_handle.connection():
+        return User(domain, rid).attrs_for(('description',))['description']
+
+def test_attrs_are_cached_until_the_domain_changes(domain, make_domain,
+                                                   fake_domain):
+    rid = fake_domain.rids['User'][0]
+    original = description(domain, rid)
+    queries = make_domain.calls('QueryUserInfo')
+    assert description(domain, rid) == original
+    assert make_domain.calls('QueryUserInfo') == queries
+
+    fake_domain.overrides[rid]['description'] = lsa_string(u'changed')
+    fake_domain.sequence += 1
+
+    assert description(domain, rid) == u'changed'
+    assert make_domain.calls('QueryUserInfo') > queries
+
+def test_names_are_enumerated_again_after_a_change(domain, make_domain,
+                                                   fake_domain):
+    rid = fake_domain.rids['User'][0]
+    with domain.samr_handle.connection():
+        domain.sorted_page(User, 'rid', limit=1)
+    enums = make_domain.calls('EnumDomainUsers')
+
+    fake_domain.modify(rid)
+    with domain.samr_handle.connection():
+        page = domain.sorted_page(User, 'rid', limit=1)
+
+    assert make_domain.calls('EnumDomainUsers') > enums
+    assert page[0].name == fake_domain.objects[rid][1]
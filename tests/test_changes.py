@@ -0,0 +1,112 @@
+import pytest
+
+pytest.importorskip('samba.dcerpc.samr')
+
+from pydentity.changes import ChangeLog, ChangeWatcher, DomainScanner
+from bench.fake_samr import lsa_string
+from pydentity.models.samba_ import User
+
+def set_attr(fake_domain, rid, attr_name, value):
+    """
+    Change an attr of an object on the fake server, as a write would
+    """
+    fake_domain.overrides[rid][attr_name] = lsa_string(value)
+    fake_domain.sequence += 1
+
+def scan(scanner):
+    with scanner.domain.samr_handle.connection():
+        return scanner.scan(scanner.domain.sequence_num)
+
+@pytest.fixture
+def domain(make_domain):
+    return make_domain(sequence_poll_interval=0)
+
+def test_first_scan_has_no_changes(domain):
+    scanner = DomainScanner(domain)
+    assert scan(scanner) is None
+    assert scan(scanner) == []
+
+def test_listing_changes_need_no_attrs_queries(domain, make_domain,
+                                               fake_domain):
+    scanner = DomainScanner(domain)
+    scan(scanner)
+    rids = fake_domain.rids['User']
+
+    fake_domain.modify(rids[0])
+    set_attr(fake_domain, rids[1], 'description', 'moved')
+    queries = make_domain.calls('QueryUserInfo')
+    changes = scan(scanner)
+
+    assert [(change['rid'], change['change']) for change in changes] == [
+        (rids[0], 'renamed'), (rids[1], 'modified'),
+    ]
+    assert make_domain.calls('QueryUserInfo') == queries
+    assert scanner.checks == 0
+
+def test_tracked_attrs_changes_are_found(domain, make_domain, fake_domain):
+    rids = fake_domain.rids['User']
+    with domain.samr_handle.connection():
+        User(domain, rids[5]).attrs
+    scanner = DomainScanner(domain)
+    scan(scanner)
+    assert scanner.stats()['tracked'] == 1
+
+    set_attr(fake_domain, rids[5], 'profile_path', r'\\server\profiles')
+    changes = scan(scanner)
+
+    assert [(change['rid'], change['change']) for change in changes] == [
+        (rids[5], 'modified'),
+    ]
+    assert scanner.stats()['tracked'] == 1
+
+def test_checks_stop_once_changes_account_for_sequence(domain, fake_domain):
+    rids = fake_domain.rids['User']
+    scanner = DomainScanner(domain, track_all=True)
+    scan(scanner)
+    checks = scanner.checks
+
+    fake_domain.modify(rids[3])
+    assert [change['rid'] for change in scan(scanner)] == [rids[3]]
+    # Only the renamed user was queried again
+    assert scanner.checks == checks + 1
+
+def test_unchecked_objects_stop_being_tracked(domain, fake_domain):
+    rids = fake_domain.rids['User']
+    with domain.samr_handle.connection():
+        for rid in rids[:3]:
+            User(domain, rid).attrs
+    scanner = DomainScanner(domain, max_checks=1)
+    scan(scanner)
+
+    # Two changes that aren't in the listings, with one check per scan
+    set_attr(fake_domain, rids[0], 'profile_path', 'a')
+    set_attr(fake_domain, rids[1], 'profile_path', 'b')
+    changes = scan(scanner)
+
+    assert [change['rid'] for change in changes] == [rids[0]]
+    assert scanner.untracked == [('user', rids[1]), ('user', rids[2])]
+
+def test_watcher_logs_changes(domain, fake_domain):
+    change_log = ChangeLog()
+    watcher = ChangeWatcher(domain, change_log, interval=0)
+    with domain.samr_handle.connection():
+        assert watcher.poll()
+        assert not watcher.poll()
+
+        fake_domain.modify(fake_domain.rids['Group'][0])
+        assert watcher.poll()
+
+    batches = change_log.since(watcher.scanner.sequence - 1)
+    assert [change['change'] for _, changes in batches
+            for change in changes] == ['renamed']
+
+def test_change_log_limits_open_streams():
+    change_log = ChangeLog(max_streams=2)
+    assert change_log.open_stream()
+    assert change_log.open_stream()
+    assert not change_log.open_stream()
+
+    change_log.close_stream()
+    assert change_log.open_stream()
+    assert change_log.stats()['streams'] == 2
+    assert change_log.stats()['streams_refused'] == 1
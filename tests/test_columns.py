@@ -0,0 +1,47 @@
+from pydentity.columns import PrincipalTable
+
+def make_table(names):
+    table = PrincipalTable()
+    for rid, name in enumerate(names, 1000):
+        table.set(rid, name)
+
+    return table
+
+def test_rename_does_not_change_existing_views():
+    table = make_table([u'alice', u'bob', u'carol'])
+    keys, entries = table.sorted_entries('name')
+
+    assert table.set(1000, u'zed')
+    assert table.get(1000) == u'zed'
+
+    assert list(entries) == [(1000, u'alice'), (1001, u'bob'),
+                             (1002, u'carol')]
+    assert list(keys) == sorted(keys)
+
+    _, entries = table.sorted_entries('name')
+    assert list(entries) == [(1001, u'bob'), (1002, u'carol'),
+                             (1000, u'zed')]
+
+def test_appends_after_rename_share_rids():
+    table = make_table([u'alice', u'bob'])
+    _, old_entries = table.sorted_entries('rid')
+    table.set(1001, u'robert')
+    table.set(1005, u'dave')
+
+    assert list(old_entries) == [(1000, u'alice'), (1001, u'bob')]
+    _, entries = table.sorted_entries('rid')
+    assert list(entries) == [(1000, u'alice'), (1001, u'robert'),
+                             (1005, u'dave')]
+
+def test_out_of_order_rids_are_merged():
+    table = make_table([u'alice', u'bob'])
+    table.set(10, u'admin')
+    assert table.get(10) == u'admin'
+    assert len(table) == 3
+
+    _, entries = table.sorted_entries('rid')
+    assert list(entries) == [(10, u'admin'), (1000, u'alice'),
+                             (1001, u'bob')]
+    assert table.remove(10)
+    assert not table.remove(10)
+    assert table.get(10) is None
@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+pytest.importorskip('samba.dcerpc.samr')
+
+from pydentity.fanout import concurrent_merge, name_order_iter
+from pydentity.models.samba_ import Domain, User
+
+def cold_page(domain):
+    with domain.samr_handle.connection():
+        return domain.sorted_page(User, 'name', limit=10)
+
+def test_cold_pages_share_one_enumeration(make_domain):
+    cold_page(make_domain(sequence_poll_interval=0))
+    single = make_domain.calls('EnumDomainUsers')
+
+    domain = make_domain(size=4, latency=0.01, sequence_poll_interval=0)
+    barrier = threading.Barrier(4) if hasattr(threading, 'Barrier') else None
+    pages = []
+
+    def read():
+        if barrier is not None:
+            barrier.wait()
+        pages.append(cold_page(domain))
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(pages) == 4
+    assert all([obj.rid for obj in page] == [obj.rid for obj in pages[0]]
+               for page in pages)
+    assert make_domain.calls('EnumDomainUsers') == 2 * single
+
+def test_domains_are_merged_over_one_connection(make_domain, fake_domain):
+    first = make_domain(size=1, checkout_timeout=2)
+    second = Domain(first.name, first.samr_handle)
+
+    entries = concurrent_merge(
+        [
+            ((obj.name.lower(), idx, obj.rid)
+             for obj in name_order_iter(domain, User, page_size=32))
+            for idx, domain in enumerate((first, second))
+        ],
+        lambda entry: entry,
+    )
+    merged = list(entries)
+
+    assert merged == sorted(merged)
+    assert len(merged) == 2 * len(fake_domain.rids['User'])
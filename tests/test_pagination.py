@@ -0,0 +1,94 @@
+import base64
+import json
+
+import pytest
+
+pytest.importorskip('samba.dcerpc.samr')
+
+from pydentity.models.samba_ import User
+
+def page_through(domain, sort, prefix=None, limit=7):
+    """
+    Every page of users in an order, following each page's last key
+    """
+    seen = []
+    after = None
+    while True:
+        with domain.samr_handle.connection():
+            page = domain.sorted_page(User, sort, after, prefix, limit)
+        seen.extend((obj.rid, obj.name) for obj in page)
+        if len(page) < limit:
+            return seen
+
+        last = page[-1]
+        after = (last.name.lower(), last.rid) if sort == 'name' else last.rid
+
+def test_rid_pages_cover_every_user_once(make_domain, fake_domain):
+    seen = page_through(make_domain(), 'rid')
+    assert [rid for rid, _ in seen] == list(fake_domain.rids['User'])
+
+def test_name_pages_are_in_name_order(make_domain, fake_domain):
+    seen = page_through(make_domain(), 'name')
+    assert len(seen) == len(fake_domain.rids['User'])
+    assert seen == sorted(seen, key=lambda entry: (entry[1].lower(),
+                                                   entry[0]))
+
+def test_prefix_pages_only_match_prefix(make_domain, fake_domain):
+    seen = page_through(make_domain(), 'name', prefix=u'USER1', limit=4)
+    expected = sorted(
+        rid for rid in fake_domain.rids['User']
+        if fake_domain.objects[rid][1].startswith('user1')
+    )
+    assert sorted(rid for rid, _ in seen) == expected
+
+def test_page_after_the_end_is_empty(make_domain, fake_domain):
+    domain = make_domain()
+    with domain.samr_handle.connection():
+        assert domain.sorted_page(User, 'rid',
+                                  fake_domain.rids['User'][-1]) == []
+        assert domain.sorted_page(User, 'name', (u'\uffff', 0)) == []
+        assert domain.sorted_page(User, 'name', prefix=u'nobody') == []
+
+
+def cursor(*parts):
+    return base64.urlsafe_b64encode(json.dumps(list(parts)).encode('utf-8'))
+
+@pytest.mark.parametrize('value', [
+    'not base64!',
+    base64.urlsafe_b64encode(b'not json'),
+    cursor('rid', None),
+    cursor('size', None, 5),
+    cursor('rid', None, 'abc'),
+    cursor('rid', None, True),
+    cursor('rid', None, -1),
+    cursor('rid', 5, 10),
+    cursor('name', None, 'abc'),
+    cursor('name', None, ['abc']),
+    cursor('name', None, [5, 10]),
+    cursor('name', None, ['abc', 'def']),
+])
+def test_invalid_cursors_are_rejected(value):
+    pytest.importorskip('flask')
+    from werkzeug.exceptions import HTTPException
+    from pydentity.resources.base import decode_cursor
+
+    with pytest.raises(HTTPException) as excinfo:
+        decode_cursor(value)
+    assert excinfo.value.code == 400
+
+def test_valid_cursors_round_trip():
+    pytest.importorskip('flask')
+    from pydentity.resources.base import decode_cursor, encode_cursor
+
+    assert decode_cursor(encode_cursor('rid', None, 1005)) == \
+        ('rid', None, 1005)
+    assert decode_cursor(encode_cursor('name', u'us', (u'user1', 1001))) == \
+        ('name', u'us', (u'user1', 1001))
+
+@pytest.mark.parametrize('value', ['0', '-5', 'ten'])
+def test_limit_must_be_positive(value):
+    pytest.importorskip('flask')
+    from pydentity.resources.base import positive_int
+
+    with pytest.raises(ValueError):
+        positive_int(value)
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('samba.dcerpc.samr')
+
+from pydentity.models.samba_ import User
+from pydentity.samba_util import PoolTimeout, run_shared
+
+def test_nested_checkout_shares_connection(make_domain):
+    domain = make_domain(size=1, checkout_timeout=1)
+    pool = domain.samr_handle
+    with pool.connection() as outer:
+        with pool.connection() as inner:
+            assert inner is outer
+
+    assert pool.stats()['checkouts'] == 1
+
+def test_checkout_times_out_when_pool_is_held(make_domain):
+    pool = make_domain(size=1, checkout_timeout=0.1).samr_handle
+    held = pool.checkout()
+    with pytest.raises(PoolTimeout):
+        pool.checkout()
+    assert pool.checkout(wait=False) is None
+
+    pool.checkin(held)
+    assert pool.checkout(wait=False) is held
+
+def test_spare_connection_never_waits(make_domain):
+    pool = make_domain(size=1, checkout_timeout=5).samr_handle
+    held = pool.checkout()
+    results = []
+
+    def helper():
+        with pool.spare_connection() as spare:
+            results.append(spare)
+
+    thread = threading.Thread(target=helper)
+    start = time.time()
+    thread.start()
+    thread.join(5)
+    assert results == [None]
+    assert time.time() - start < 1
+
+    pool.checkin(held)
+
+def test_run_shared_finishes_without_spare_connections(make_domain):
+    from multiprocessing.pool import ThreadPool
+
+    pool = make_domain(size=1).samr_handle
+    done = []
+    with pool.connection():
+        threads = run_shared(pool, ThreadPool(2), done.append, range(10), 2)
+
+    assert sorted(done) == list(range(10))
+    assert threads == 1
+
+def test_run_shared_raises_first_error(make_domain):
+    from multiprocessing.pool import ThreadPool
+
+    pool = make_domain(size=2).samr_handle
+
+    def fail(item):
+        if item == 3:
+            raise RuntimeError(0xC0000064, "No such user")
+
+    with pytest.raises(RuntimeError):
+        run_shared(pool, ThreadPool(2), fail, range(10), 1)
+
+def test_concurrent_prefetches_with_every_connection_held(make_domain,
+                                                          fake_domain):
+    """
+    Requests each hold a pooled connection while prefetching attrs. With as
+    many requests as connections, prefetch threads that waited on the pool
+    would time out
+    """
+    size = 4
+    domain = make_domain(size=size, checkout_timeout=2, latency=0.005,
+                         prefetch_concurrency=4)
+    rids = list(fake_domain.rids['User'])
+    barrier = threading.Barrier(size) if hasattr(threading, 'Barrier') \
+        else None
+    errors = []
+
+    def request(idx):
+        try:
+            with domain.samr_handle.connection():
+                if barrier is not None:
+                    barrier.wait()
+                objects = [User(domain, rid)
+                           for rid in rids[idx * 40:(idx + 1) * 40]]
+                domain.prefetch_attrs(objects)
+                assert all(obj.cached for obj in objects)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=request, args=(idx,))
+               for idx in range(size)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert errors == []
+    assert domain.samr_handle.stats()['timeouts'] == 0
+    assert time.time() - start < 2
+
+def test_broken_connections_are_closed_when_replaced(fake_domain):
+    from bench.fake_samr import FakeSAMR
+    from pydentity.samba_util import SAMRHandlePool
+
+    connections = []
+
+    def connect(_):
+        connections.append(FakeSAMR(fake_domain))
+        return connections[-1]
+
+    pool = SAMRHandlePool(None, size=1, connection_factory=connect)
+    samr_handle = pool.checkout()
+    handle_cache = samr_handle.handle_cache
+    handle_cache.get('open', lambda: samr_handle.policy_handle_obj)
+    pool.checkin(samr_handle, failed=True)
+
+    def broken(*args):
+        raise RuntimeError(0xC0000020, "Invalid connection")
+
+    connections[0].EnumDomains = broken
+    replacement = pool.checkout()
+
+    assert replacement is not samr_handle
+    assert pool.stats()['reconnects'] == 1
+    assert connections[0].calls['Close'] >= 1
+    assert handle_cache.stats()['size'] == 0
+    pool.checkin(replacement)
+    pool.close()
@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import json
+
+import pytest
+
+pytest.importorskip('samba.dcerpc.samr')
+
+def get_json(response):
+    return json.loads(response.data.decode('utf-8'))
+
+def resolve(api, data):
+    return api.post('/api/v1/resolve', data=json.dumps(data),
+                    content_type='application/json')
+
+def post_batch(api, operations, credentials=None):
+    headers = {}
+    if credentials is not None:
+        headers['Authorization'] = 'Basic %s' % base64.b64encode(
+            credentials.encode('utf-8')).decode('ascii')
+    return api.post('/api/v1/batch',
+                    data=json.dumps({'operations': operations}),
+                    content_type='application/json', headers=headers)
+
+@pytest.fixture
+def writes(api, tmpdir, monkeypatch):
+    """
+    Enable writes on the api app for the test, with "loader" as the only
+    trusted writer, whose secret is "s3cret"
+    """
+    from pydentity.server import APP
+    from pydentity.tokens import TokenClients
+
+    path = tmpdir.join('writers.json')
+    path.write(json.dumps({'clients': {
+        'loader': hashlib.sha256(b's3cret').hexdigest(),
+    }}))
+    monkeypatch.setitem(APP.config, 'ALLOW_WRITES', True)
+    monkeypatch.setitem(APP.config, 'HTTP_BASIC_AUTH_REALM', 'pydentity')
+    monkeypatch.setattr(APP, 'writer_clients', TokenClients(str(path)))
+    return APP.writer_clients
+
+@pytest.mark.parametrize('path,rid', [
+    ('users', 900001),
+    ('groups', 900002),
+    ('aliases', 900003),
+])
+def test_unindexed_missing_objects_are_404s(api, path, rid):
+    from pydentity.server import APP
+
+    assert APP.domain_model.name_index.by_rid(rid) is None
+    response = api.get('/api/v1/%s/%d' % (path, rid))
+
+    assert response.status_code == 404
+    assert rid in APP.domain_model.name_index._missing_rids
+    assert api.get('/api/v1/%s/%d' % (path, rid)).status_code == 404
+
+def test_existing_objects_are_found(api):
+    rid = api.fake_domain.rids['User'][0]
+    response = api.get('/api/v1/users/%d' % rid)
+
+    assert response.status_code == 200
+    assert get_json(response)['rid'] == rid
+
+@pytest.mark.parametrize('data', [
+    {'names': u'alice'},
+    {'names': 5},
+    {'names': [u'alice', 5]},
+    {'rids': 5},
+    {'rids': u'1000'},
+    {'rids': [True]},
+    {'rids': [-1]},
+    {'rids': [0x100000000]},
+    {'rids': [1000.5]},
+])
+def test_resolve_rejects_invalid_input(api, data):
+    assert resolve(api, data).status_code == 400
+
+def test_resolve_looks_up_names_and_rids(api):
+    rid = api.fake_domain.rids['User'][0]
+    name = api.fake_domain.objects[rid][1]
+    response = resolve(api, {'names': [name], 'rids': [rid, 0xFFFFFFFF]})
+
+    assert response.status_code == 200
+    data = get_json(response)
+    assert data['names'] == [{'name': name, 'rid': rid, 'type': 'user'}]
+    assert data['rids'][0]['name'] == name
+    assert data['rids'][1]['name'] is None
+
+def test_batches_need_writes_enabled(api):
+    assert post_batch(api, [], 'loader:s3cret').status_code == 404
+
+@pytest.mark.parametrize('credentials', [
+    None,
+    'loader:guess',
+    'other:s3cret',
+    'loader:',
+])
+def test_batches_need_writer_credentials(api, writes, credentials):
+    response = post_batch(api, [{'op': 'explode'}], credentials)
+
+    assert response.status_code == 401
+    assert 'WWW-Authenticate' in response.headers
+    assert 'results' not in get_json(response)
+
+def test_trusted_writers_run_batches(api, writes):
+    response = post_batch(api, [{'op': 'explode'}], 'loader:s3cret')
+
+    assert response.status_code == 200
+    data = get_json(response)
+    assert data['failed'] == 1
+    assert data['results'][0]['status'] == 400
+    assert writes.stats()['authenticated'] == 1
@@ -0,0 +1,46 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('werkzeug')
+
+from six.moves import http_client
+
+from pydentity.serving import PooledWSGIServer
+
+def slow_stream_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+
+    def chunks():
+        for idx in range(3):
+            time.sleep(0.3)
+            yield b'chunk'
+
+    return chunks()
+
+@pytest.fixture
+def server(request):
+    server = PooledWSGIServer('127.0.0.1', 0, slow_stream_app, threads=2,
+                              keepalive_timeout=0.1, request_timeout=5)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        server.drain(1)
+        server.server_close()
+
+    request.addfinalizer(stop)
+    return server
+
+def test_keepalive_timeout_does_not_cut_off_slow_responses(server):
+    conn = http_client.HTTPConnection(*server.server_address, timeout=5)
+    conn.request('GET', '/')
+    assert conn.getresponse().read() == b'chunk' * 3
+
+def test_idle_connections_are_closed_after_keepalive_timeout(server):
+    conn = http_client.HTTPConnection(*server.server_address, timeout=5)
+    conn.connect()
+    time.sleep(0.5)
+    assert conn.sock.recv(1) == b''
@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip('samba.dcerpc.samr')
+
+from bench.fake_samr import lsa_string
+from pydentity.models.samba_ import User
+from pydentity.shared_cache import SharedCacheReader, SharedCacheWriter
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return str(tmpdir.join('shared.sqlite'))
+
+def publish(writer, domain):
+    with domain.samr_handle.connection():
+        return writer.publish(domain)
+
+def test_publish_writes_every_object(make_domain, fake_domain, cache_path):
+    domain = make_domain(sequence_poll_interval=0)
+    writer = SharedCacheWriter(cache_path)
+    assert publish(writer, domain)
+    assert not publish(writer, domain)
+
+    reader = SharedCacheReader(cache_path)
+    assert reader.sequence() == fake_domain.sequence
+    assert reader.count(User.sid_name_use) == len(fake_domain.rids['User'])
+    rid = fake_domain.rids['User'][0]
+    assert reader.by_rid(rid) == (fake_domain.objects[rid][1],
+                                  User.sid_name_use)
+    assert reader.attrs('User', rid)['rid'] == rid
+
+def test_republish_only_writes_changes(make_domain, fake_domain,
+                                       cache_path):
+    domain = make_domain(sequence_poll_interval=0)
+    writer = SharedCacheWriter(cache_path)
+    publish(writer, domain)
+
+    rids = fake_domain.rids['User']
+    fake_domain.modify(rids[0])
+    fake_domain.overrides[rids[1]]['description'] = lsa_string('moved')
+    fake_domain.sequence += 1
+    removed = rids[2]
+    del fake_domain.objects[removed]
+    fake_domain.rids['User'] = [rid for rid in rids if rid != removed]
+    fake_domain.sequence += 1
+
+    queries = make_domain.calls('QueryUserInfo')
+    assert publish(writer, domain)
+    # Only the renamed and modified users were queried again, for each of
+    # their info levels
+    levels = len(User(domain, rids[0]).info_levels)
+    assert make_domain.calls('QueryUserInfo') - queries == 2 * levels
+
+    reader = SharedCacheReader(cache_path)
+    assert reader.sequence() == fake_domain.sequence
+    assert reader.by_rid(rids[0])[0] == fake_domain.objects[rids[0]][1]
+    assert reader.attrs('User', rids[1])['description'] == 'moved'
+    assert reader.by_rid(removed) is None
+    assert reader.attrs('User', removed) is None
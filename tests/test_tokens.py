@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import stat
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import (
+    encode_dss_signature,
+)
+
+from pydentity.tokens import (
+    b64url_decode,
+    bytes_int,
+    BadToken,
+    TokenClients,
+    TokenExpired,
+    TokenKeySet,
+)
+
+@pytest.fixture
+def key_set(tmpdir):
+    return TokenKeySet(str(tmpdir.join('keys.json')), token_ttl=60)
+
+def verify_with_jwk(jwk, token):
+    """
+    Verify a token with only a published public key, as a relying service
+    would
+    """
+    public_key = ec.EllipticCurvePublicNumbers(
+        bytes_int(b64url_decode(jwk['x'])),
+        bytes_int(b64url_decode(jwk['y'])),
+        ec.SECP256R1(),
+    ).public_key(default_backend())
+    header, claims, signature = token.split('.')
+    signature = b64url_decode(signature)
+    public_key.verify(
+        encode_dss_signature(bytes_int(signature[:32]),
+                             bytes_int(signature[32:])),
+        ('%s.%s' % (header, claims)).encode('ascii'),
+        ec.ECDSA(hashes.SHA256()),
+    )
+    return json.loads(b64url_decode(claims).decode('utf-8'))
+
+def test_issued_tokens_verify(key_set):
+    token, key = key_set.issue({'rid': 1000})
+    claims = key_set.verify(token)
+    assert claims['rid'] == 1000
+    assert claims['exp'] - claims['iat'] == 60
+    assert stat.S_IMODE(os.stat(key_set.path).st_mode) == 0o600
+
+def test_published_keys_verify_without_secrets(key_set):
+    token, key = key_set.issue({'rid': 1000})
+    published = key_set.published()
+
+    assert [jwk['kid'] for jwk in published] == [key.kid]
+    assert set(published[0]) >= {'kty', 'crv', 'x', 'y', 'alg'}
+    assert 'd' not in published[0]
+    assert 'private_key' not in published[0]
+    assert verify_with_jwk(published[0], token)['rid'] == 1000
+
+def test_tampered_and_expired_tokens_are_rejected(key_set, tmpdir):
+    token, _ = key_set.issue({'rid': 1000})
+    header, claims, signature = token.split('.')
+    forged = '%s.%s.%s' % (header, claims[:-2] + 'xx', signature)
+    with pytest.raises(BadToken):
+        key_set.verify(forged)
+    with pytest.raises(BadToken):
+        key_set.verify('not a token')
+
+    expired_set = TokenKeySet(key_set.path, token_ttl=-1)
+    expired, _ = expired_set.issue({'rid': 1000})
+    with pytest.raises(TokenExpired):
+        key_set.verify(expired)
+    assert key_set.stats()['rejected'] == 3
+
+def test_hmac_keys_are_replaced(tmpdir):
+    path = str(tmpdir.join('keys.json'))
+    with open(path, 'w') as handle:
+        json.dump({'keys': [{'kid': 'old', 'secret': 'ab' * 32,
+                             'created': 0}]}, handle)
+
+    key_set = TokenKeySet(path)
+    token, key = key_set.issue({'rid': 1000})
+    assert key.kid != 'old'
+    assert [jwk['kid'] for jwk in key_set.published()] == [key.kid]
+
+def test_clients_authenticate_with_their_secret(tmpdir):
+    path = tmpdir.join('clients.json')
+    path.write(json.dumps({'clients': {
+        'portal': hashlib.sha256(b's3cret').hexdigest(),
+    }}))
+    clients = TokenClients(str(path))
+
+    assert clients.authenticate('portal', u's3cret')
+    assert not clients.authenticate('portal', u'guess')
+    assert not clients.authenticate('other', u's3cret')
+    assert clients.stats() == {'clients': 1, 'authenticated': 1,
+                               'refused': 2}